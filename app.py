@@ -1,27 +1,38 @@
 from flask import Flask, render_template, request, jsonify, session
-import pandas as pd
+from openpyxl import Workbook
 import fitz  # PyMuPDF
 import random
-from PIL import Image
+from PIL import Image, ImageChops
 import google.generativeai as genai
 from dotenv import load_dotenv
 import os
 import json
 import io
+import csv
 import base64
 import re
 import logging
 from datetime import datetime, timedelta
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, as_completed, Future
 import time
 import threading
-from collections import deque
+from collections import deque, OrderedDict
+from collections.abc import Sequence
+import asyncio
 import uuid
 import pickle
+import sqlite3
+import zlib
+import hashlib
+import bisect
+import math
+import sys
 from pathlib import Path
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy import inspect
 from types import SimpleNamespace
+from contextlib import contextmanager
+import contextvars
 
 # Load environment variables
 load_dotenv()
@@ -39,6 +50,11 @@ app.secret_key = os.getenv('SECRET_KEY', 'your-secret-key-change-in-production')
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB max file size
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['SESSION_FOLDER'] = 'sessions'
+app.config['CACHE_FOLDER'] = 'cache'
+app.config['IMAGE_FOLDER'] = 'images'
+app.config['JOB_FOLDER'] = 'jobs'
+app.config['METRICS_FOLDER'] = 'metrics'
+app.config['EXPORT_FOLDER'] = 'exports'
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0
 
 # Database Configuration
@@ -88,6 +104,18 @@ class UsageStats(db.Model):
             'is_limit_reached': self.total_calls >= MAX_TRIAL_INVOICES
         }
 
+class ProcessingJob(db.Model):
+    __tablename__ = 'processing_jobs'
+    session_id = db.Column(db.String(36), primary_key=True)
+    status = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ProcessingTrace(db.Model):
+    __tablename__ = 'processing_traces'
+    session_id = db.Column(db.String(36), primary_key=True)
+    events = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 # Initialize Database and Seed Data
 def init_db():
     with app.app_context():
@@ -141,6 +169,23 @@ if api_key:
 else:
     logger.error("GEMINI_API_KEY not found in environment variables")
 
+# Gemini model used for extraction
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+logger.info(f"Gemini model: {GEMINI_MODEL}")
+
+# Extraction backend: 'gemini' (real API) or 'fake' (offline stand-in for load tests and benchmarks)
+EXTRACTION_BACKEND = os.getenv('EXTRACTION_BACKEND', 'gemini').lower()
+FAKE_LATENCY_MS = float(os.getenv('FAKE_LATENCY_MS', 800))
+FAKE_LATENCY_SIGMA = float(os.getenv('FAKE_LATENCY_SIGMA', 0.4))
+FAKE_RATE_LIMIT_RATE = float(os.getenv('FAKE_RATE_LIMIT_RATE', 0))
+FAKE_MALFORMED_RATE = float(os.getenv('FAKE_MALFORMED_RATE', 0))
+FAKE_CONFIDENCE = int(os.getenv('FAKE_CONFIDENCE', 90))
+FAKE_FIELD_CONFIDENCE = json.loads(os.getenv('FAKE_FIELD_CONFIDENCE', '{}') or '{}')
+FAKE_SEED = os.getenv('FAKE_SEED')
+logger.info(f"Extraction backend: {EXTRACTION_BACKEND}"
+            + (f" (latency {FAKE_LATENCY_MS:.0f}ms, 429 rate {FAKE_RATE_LIMIT_RATE}, "
+               f"malformed rate {FAKE_MALFORMED_RATE})" if EXTRACTION_BACKEND == 'fake' else ""))
+
 # Get max invoices per session limit (0 = unlimited)
 MAX_INVOICES_PER_SESSION = int(os.getenv('MAX_INVOICES_PER_SESSION', 0))
 logger.info(f"Max invoices per session: {MAX_INVOICES_PER_SESSION if MAX_INVOICES_PER_SESSION > 0 else 'Unlimited'}")
@@ -153,6 +198,103 @@ logger.info(f"Max trial invoices: {MAX_TRIAL_INVOICES}")
 MAX_WORKERS = int(os.getenv('MAX_WORKERS', 10))
 logger.info(f"Max parallel workers: {MAX_WORKERS}")
 
+# Image normalization applied to the copy of each page sent to the model (stored page images are untouched)
+PDF_RENDER_DPI = int(os.getenv('PDF_RENDER_DPI', 0))               # 0 = native resolution (72 dpi)
+IMAGE_MAX_EDGE = int(os.getenv('IMAGE_MAX_EDGE', 0))               # Longest edge in px, 0 = no cap
+IMAGE_GRAYSCALE = os.getenv('IMAGE_GRAYSCALE', 'False').lower() == 'true'       # Only for monochrome pages
+IMAGE_TRIM_WHITESPACE = os.getenv('IMAGE_TRIM_WHITESPACE', 'False').lower() == 'true'
+IMAGE_FORMAT = os.getenv('IMAGE_FORMAT', 'png').lower()           # png, jpeg or webp
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 85))                # jpeg/webp quality
+logger.info(f"Model image format: {IMAGE_FORMAT}"
+            + (f" q{IMAGE_QUALITY}" if IMAGE_FORMAT != 'png' else "")
+            + (f", max edge {IMAGE_MAX_EDGE}px" if IMAGE_MAX_EDGE else "")
+            + (", grayscale" if IMAGE_GRAYSCALE else "")
+            + (", trimmed" if IMAGE_TRIM_WHITESPACE else ""))
+
+# Pages sent per Gemini request (1 = one request per page); applies to the threads engine
+GEMINI_BATCH_SIZE = max(1, int(os.getenv('GEMINI_BATCH_SIZE', 1)))
+logger.info(f"Gemini batch size: {GEMINI_BATCH_SIZE} page(s) per request")
+
+# Text-layer fast path: born-digital PDF pages are sent to Gemini as their text layer instead of an image
+TEXT_FAST_PATH = os.getenv('TEXT_FAST_PATH', 'False').lower() == 'true'
+TEXT_MIN_CHARS = int(os.getenv('TEXT_MIN_CHARS', 200))
+logger.info(f"Text-layer fast path: {'enabled' if TEXT_FAST_PATH else 'disabled'}"
+            + (f" (min {TEXT_MIN_CHARS} chars)" if TEXT_FAST_PATH else ""))
+
+# Structured output: send a response schema built from the active fields so Gemini returns JSON only
+STRUCTURED_OUTPUT = os.getenv('STRUCTURED_OUTPUT', 'False').lower() == 'true'
+logger.info(f"Structured output: {'enabled' if STRUCTURED_OUTPUT else 'disabled'}")
+
+# Response format: 'full' ({value, confidence, visual_clarity, visual_evidence} per field) or
+# 'compact' ([value, confidence, clarity code] per field, evidence only below the threshold)
+RESPONSE_FORMAT = os.getenv('RESPONSE_FORMAT', 'full').lower()
+COMPACT_EVIDENCE_THRESHOLD = int(os.getenv('COMPACT_EVIDENCE_THRESHOLD', 70))
+logger.info(f"Response format: {RESPONSE_FORMAT}"
+            + (f" (evidence below {COMPACT_EVIDENCE_THRESHOLD}% confidence)" if RESPONSE_FORMAT == 'compact' else ""))
+
+# Threads per upload that render files; extraction itself is capped by MAX_WORKERS per process
+UPLOAD_FILE_WORKERS = int(os.getenv('UPLOAD_FILE_WORKERS', 2))
+
+# Extraction engine: 'threads' (thread pools, one OS thread per in-flight call) or 'asyncio'
+EXTRACTION_ENGINE = os.getenv('EXTRACTION_ENGINE', 'threads').lower()
+ASYNC_MAX_CONCURRENCY = int(os.getenv('ASYNC_MAX_CONCURRENCY', 100))
+logger.info(f"Extraction engine: {EXTRACTION_ENGINE}"
+            + (f" (max {ASYNC_MAX_CONCURRENCY} in-flight requests)" if EXTRACTION_ENGINE == 'asyncio' else ""))
+
+# Gemini request budgets enforced by the shared rate limiter (0 TPM = no token budget)
+GEMINI_RPM = int(os.getenv('GEMINI_RPM', 500))
+GEMINI_TPM = int(os.getenv('GEMINI_TPM', 800000))
+logger.info(f"Gemini rate limits: {GEMINI_RPM} RPM, {GEMINI_TPM if GEMINI_TPM > 0 else 'unlimited'} TPM")
+
+# Where job progress is shared between gunicorn workers: 'file', 'db' or 'memory' (single process only)
+JOB_REGISTRY_BACKEND = os.getenv('JOB_REGISTRY', 'file').lower()
+logger.info(f"Job registry backend: {JOB_REGISTRY_BACKEND}")
+
+# Per-page stage spans served as a Chrome trace from /api/trace/<session_id>
+TRACE_ENABLED = os.getenv('TRACE_ENABLED', 'True').lower() == 'true'
+TRACE_MAX_EVENTS = int(os.getenv('TRACE_MAX_EVENTS', 20000))     # Per session; later spans are dropped
+TRACE_PERSIST_SECONDS = float(os.getenv('TRACE_PERSIST_SECONDS', 5))
+logger.info(f"Job tracing: {'enabled' if TRACE_ENABLED else 'disabled'} (max {TRACE_MAX_EVENTS} spans per session)")
+
+# Longest a single progress stream stays open before the browser reconnects
+SSE_MAX_STREAM_SECONDS = int(os.getenv('SSE_MAX_STREAM_SECONDS', 120))
+
+# In-memory session cache budget (sessions beyond it are served from disk)
+SESSION_CACHE_MAX_MB = int(os.getenv('SESSION_CACHE_MAX_MB', 256))
+logger.info(f"Session cache budget: {SESSION_CACHE_MAX_MB} MB")
+
+# Streaming page pipeline: render pages lazily and feed extraction workers through a bounded queue
+STREAMING_PIPELINE = os.getenv('STREAMING_PIPELINE', 'True').lower() == 'true'
+PAGE_QUEUE_DEPTH = int(os.getenv('PAGE_QUEUE_DEPTH', MAX_WORKERS))
+logger.info(f"Streaming pipeline: {'enabled' if STREAMING_PIPELINE else 'disabled'} (queue depth {PAGE_QUEUE_DEPTH})")
+
+# Storage janitor: session TTL by last access, a disk quota with least-recently-used deletion,
+# orphaned uploads and finished job status held in worker memory
+JANITOR_INTERVAL_MINUTES = float(os.getenv('JANITOR_INTERVAL_MINUTES', 15))   # 0 = disabled
+SESSION_TTL_HOURS = float(os.getenv('SESSION_TTL_HOURS', 168))                # 0 = keep until the quota needs room
+STORAGE_QUOTA_MB = int(os.getenv('STORAGE_QUOTA_MB', 0))                      # sessions/, exports/, uploads/ and images/; 0 = none
+UPLOAD_TTL_HOURS = float(os.getenv('UPLOAD_TTL_HOURS', 24))
+# Unreferenced page images younger than this may belong to a page whose row isn't written yet
+IMAGE_GRACE_SECONDS = 3600
+STATUS_TTL_MINUTES = float(os.getenv('STATUS_TTL_MINUTES', 60))
+logger.info(f"Janitor: {f'every {JANITOR_INTERVAL_MINUTES:g} min' if JANITOR_INTERVAL_MINUTES > 0 else 'disabled'} "
+            f"(session TTL {SESSION_TTL_HOURS:g}h, quota {STORAGE_QUOTA_MB or 'unlimited'} MB)")
+
+# Sorted row indexes kept for paging, sorting and filtering /get_invoices (least recently used dropped)
+SESSION_INDEX_MAX_SESSIONS = int(os.getenv('SESSION_INDEX_MAX_SESSIONS', 32))
+
+# Extraction cache settings (repeat pages skip the Gemini call entirely)
+EXTRACTION_CACHE_ENABLED = os.getenv('EXTRACTION_CACHE_ENABLED', 'True').lower() == 'true'
+EXTRACTION_CACHE_MAX_ENTRIES = int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', 10000))
+EXTRACTION_CACHE_TTL_HOURS = int(os.getenv('EXTRACTION_CACHE_TTL_HOURS', 720))
+logger.info(f"Extraction cache: {'enabled' if EXTRACTION_CACHE_ENABLED else 'disabled'} "
+            f"(max {EXTRACTION_CACHE_MAX_ENTRIES} entries, TTL {EXTRACTION_CACHE_TTL_HOURS}h)")
+
+# Session exports: written once per session, schema version and format, then served from exports/
+EXPORT_PREGENERATE = [f.strip() for f in os.getenv('EXPORT_PREGENERATE', 'xlsx').lower().split(',') if f.strip()]
+EXPORT_CHUNK_ROWS = int(os.getenv('EXPORT_CHUNK_ROWS', 1000))
+logger.info(f"Export pre-generation: {', '.join(EXPORT_PREGENERATE) or 'disabled'}")
+
 # INVOICE_SCHEMA is now dynamic and stored in the database
 def get_current_fields():
     """Fetch active fields from database"""
@@ -160,421 +302,3753 @@ def get_current_fields():
 
 def get_current_schema_names():
     """Fetch active field names as a list of strings"""
-    return [field.name for field in get_current_fields()]
+    return list(schema_cache.get().names)
+
+# How often each worker publishes its metrics for /metrics (served by whichever worker gets the scrape)
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', 5))
+
+# Metrics
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + list((extra or {}).items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{v}"' for k, v in pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter, optionally split by label values"""
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        self.registry = registry
+        registry.register(self)
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+        self.registry.maybe_flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {'|'.join(key): value for key, value in self.values.items()}
+
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect and three additions under a lock"""
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.lock = threading.Lock()
+        self.registry = registry
+        registry.register(self)
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+        self.registry.maybe_flush()
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+    def snapshot(self):
+        with self.lock:
+            return {'counts': list(self.counts), 'sum': self.sum}
+
+
+class Gauge:
+    """Point-in-time value read from a callback when metrics are published"""
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, callback):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        registry.register(self)
+
+    def snapshot(self):
+        try:
+            return float(self.callback())
+        except Exception:
+            return None
+
+
+def run_off_loop(fn, *args):
+    """Call fn now, or hand it to the default executor when called on a running event loop"""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        fn(*args)
+        return
+    loop.run_in_executor(None, fn, *args)
+
+
+class MetricsRegistry:
+    """Process-local metrics, published as one JSON file per worker and merged on scrape.
+
+    Counters and histograms are summed across every worker that has written a
+    file (so totals survive a worker restart); gauges are reported per live
+    worker with a `pid` label and may lag by up to METRICS_FLUSH_SECONDS.
+    Files are named by pid and start time, so a worker that gets a reused pid
+    never overwrites the totals of the one that had it before.
+    """
+
+    def __init__(self, metrics_dir, flush_interval):
+        self.metrics_dir = Path(metrics_dir)
+        self.flush_interval = flush_interval
+        self.metrics = []
+        self.flush_lock = threading.Lock()
+        self.last_flush = 0.0
+        self.worker_pid = None
+        self.worker_key = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def _own_key(self):
+        """'<pid>-<start ns>' of this worker; recomputed after a fork"""
+        pid = os.getpid()
+        if self.worker_pid != pid:
+            self.worker_pid = pid
+            self.worker_key = f"{pid}-{time.time_ns()}"
+        return self.worker_key
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= self.flush_interval:
+            # Claim the interval before the write so one slow flush isn't scheduled repeatedly
+            self.last_flush = time.monotonic()
+            run_off_loop(self.flush)
+
+    def flush(self):
+        # Whoever loses the race skips; the winner's snapshot already includes their update
+        if not self.flush_lock.acquire(blocking=False):
+            return
+        try:
+            self.last_flush = time.monotonic()
+            self.metrics_dir.mkdir(exist_ok=True)
+            path = self.metrics_dir / f"{self._own_key()}.json"
+            tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            with open(tmp_path, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Could not publish metrics: {str(e)}")
+        finally:
+            self.flush_lock.release()
+
+    def _worker_snapshots(self):
+        """{(pid, worker key): snapshot} for every worker that published metrics, this one included"""
+        own_key = self._own_key()
+        snapshots = {(os.getpid(), own_key): self.snapshot()}
+        for path in self.metrics_dir.glob('*.json'):
+            try:
+                pid = int(path.stem.split('-')[0])
+            except ValueError:
+                continue
+            if path.stem == own_key:
+                continue
+            try:
+                with open(path) as f:
+                    snapshots[(pid, path.stem)] = json.load(f)
+            except (OSError, ValueError):
+                continue
+        return snapshots
+
+    def render(self):
+        """Prometheus text exposition format for all workers"""
+        self.flush()
+        snapshots = self._worker_snapshots()
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            if metric.kind == 'counter':
+                totals = {}
+                for snapshot in snapshots.values():
+                    for key, value in snapshot.get(metric.name, {}).items():
+                        totals[key] = totals.get(key, 0) + value
+                for key, value in sorted(totals.items()):
+                    values = key.split('|') if metric.label_names else ()
+                    lines.append(f"{metric.name}{_format_labels(metric.label_names, values)} {value}")
+            elif metric.kind == 'histogram':
+                counts = [0] * (len(metric.buckets) + 1)
+                total = 0.0
+                for snapshot in snapshots.values():
+                    data = snapshot.get(metric.name)
+                    if data and len(data['counts']) == len(counts):
+                        counts = [a + b for a, b in zip(counts, data['counts'])]
+                        total += data['sum']
+                cumulative = 0
+                for bound, count in zip(list(metric.buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'{metric.name}_bucket{{le="{bound}"}} {cumulative}')
+                lines.append(f"{metric.name}_sum {total}")
+                lines.append(f"{metric.name}_count {cumulative}")
+            else:
+                # Only the newest worker under each pid can still be alive
+                latest = {}
+                for (pid, key), snapshot in snapshots.items():
+                    if pid not in latest or _worker_started(key) > _worker_started(latest[pid][0]):
+                        latest[pid] = (key, snapshot)
+                for pid, (_, snapshot) in sorted(latest.items()):
+                    value = snapshot.get(metric.name)
+                    if value is not None and (pid == os.getpid() or _pid_alive(pid)):
+                        lines.append(f'{metric.name}{{pid="{pid}"}} {value}')
+        return "\n".join(lines) + "\n"
+
+
+def _worker_started(key):
+    """Start time in a '<pid>-<start ns>' worker key; files from before start times were recorded sort first"""
+    _, _, started = key.partition('-')
+    return int(started) if started.isdigit() else 0
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def current_rss_bytes():
+    """Resident set size of this process (peak RSS where /proc isn't available)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+# Global metrics
+metrics = MetricsRegistry(app.config['METRICS_FOLDER'], METRICS_FLUSH_SECONDS)
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (16384, 65536, 262144, 524288, 1048576, 2097152, 4194304, 8388608)
+RENDER_SECONDS = Histogram(metrics, 'invoice_page_render_seconds', 'PDF page rasterization time', SECONDS_BUCKETS)
+ENCODE_SECONDS = Histogram(metrics, 'invoice_image_encode_seconds', 'Page normalization and encoding time', SECONDS_BUCKETS)
+PAYLOAD_BYTES = Histogram(metrics, 'invoice_model_payload_bytes', 'Size of the page part sent to the model', BYTES_BUCKETS)
+GEMINI_SECONDS = Histogram(metrics, 'invoice_gemini_request_seconds', 'Extraction backend call latency', SECONDS_BUCKETS)
+PARSE_SECONDS = Histogram(metrics, 'invoice_response_parse_seconds', 'Response parsing and confidence rules time', SECONDS_BUCKETS)
+RATE_LIMIT_WAIT_SECONDS = Histogram(metrics, 'invoice_rate_limiter_wait_seconds', 'Time each call waits for rate limiter budget', SECONDS_BUCKETS)
+GEMINI_RETRIES = Counter(metrics, 'invoice_gemini_retries_total', 'Extraction calls retried, by cause', labels=('cause',))
+PAGES_PROCESSED = Counter(metrics, 'invoice_pages_processed_total', 'Pages finished, by outcome', labels=('outcome',))
+_gemini_in_flight = [0]
+_gemini_in_flight_lock = threading.Lock()
+Gauge(metrics, 'invoice_gemini_in_flight', 'Extraction backend calls in progress', lambda: _gemini_in_flight[0])
+Gauge(metrics, 'invoice_pages_queued', 'Pages waiting in the page scheduler', lambda: page_scheduler.queued_pages())
+Gauge(metrics, 'invoice_sessions_cached', 'Sessions held in the in-memory session cache', lambda: len(processed_invoices))
+Gauge(metrics, 'invoice_session_cache_bytes', 'Approximate bytes held by the session cache',
+      lambda: processed_invoices.resident_bytes)
+Gauge(metrics, 'process_resident_memory_bytes', 'Resident memory of the worker process', current_rss_bytes)
+
+
+@contextmanager
+def track_backend_call():
+    """Count a backend call as in flight and time it"""
+    with _gemini_in_flight_lock:
+        _gemini_in_flight[0] += 1
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        GEMINI_SECONDS.observe(time.perf_counter() - started)
+        with _gemini_in_flight_lock:
+            _gemini_in_flight[0] -= 1
+
+
+# Rate Limiter Class
+class RateLimiter:
+    """Token-bucket rate limiter for Gemini requests-per-minute and tokens-per-minute.
+
+    Each caller reserves its slot under the lock (the bucket may go into debt)
+    and then sleeps outside it for however long that debt takes to refill, so
+    waiting threads never block each other and are served in arrival order.
+    """
+
+    def __init__(self, max_calls_per_minute=15, max_tokens_per_minute=None, burst=None):
+        self.max_calls = max_calls_per_minute
+        self.max_tokens = max_tokens_per_minute
+        # Bucket capacity; a full-minute burst would allow ~2x the limit inside one window
+        self.burst = burst if burst is not None else max(1, max_calls_per_minute // 10)
+        self.token_burst = max_tokens_per_minute // 10 if max_tokens_per_minute else None
+        self.call_rate = max_calls_per_minute / 60.0
+        self.token_rate = max_tokens_per_minute / 60.0 if max_tokens_per_minute else None
+        self.available_calls = float(self.burst)
+        self.available_tokens = float(self.token_burst) if self.token_burst else None
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+        # Stats
+        self.total_calls = 0
+        self.total_tokens = 0
+        self.delayed_calls = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.waiting = 0
+
+    def _refill(self, now):
+        elapsed = now - self.updated
+        self.updated = now
+        self.available_calls = min(self.burst, self.available_calls + elapsed * self.call_rate)
+        if self.token_rate:
+            self.available_tokens = min(self.token_burst, self.available_tokens + elapsed * self.token_rate)
+
+    def reserve(self, tokens=0):
+        """Claim capacity for one request and return how long the caller must wait"""
+        with self.lock:
+            self._refill(time.monotonic())
+
+            self.available_calls -= 1
+            wait = -self.available_calls / self.call_rate if self.available_calls < 0 else 0.0
+
+            if self.token_rate and tokens:
+                # A single oversized request can't wait for more than one burst of budget
+                self.available_tokens -= min(tokens, self.token_burst)
+                if self.available_tokens < 0:
+                    wait = max(wait, -self.available_tokens / self.token_rate)
+
+            self.total_calls += 1
+            self.total_tokens += tokens
+            if wait > 0:
+                self.delayed_calls += 1
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+        RATE_LIMIT_WAIT_SECONDS.observe(wait)
+        return wait
+
+    def wait_if_needed(self, tokens=0):
+        """Wait if we've hit the rate limit; returns seconds waited"""
+        wait = self.reserve(tokens)
+        if wait > 0:
+            with self.lock:
+                self.waiting += 1
+            try:
+                time.sleep(wait)
+            finally:
+                with self.lock:
+                    self.waiting -= 1
+        return wait
+
+    def record_usage(self, estimated_tokens, actual_tokens):
+        """Correct the token bucket once the real token count of a request is known"""
+        if not self.token_rate or actual_tokens is None:
+            return
+        with self.lock:
+            self.available_tokens = min(self.token_burst, self.available_tokens + estimated_tokens - actual_tokens)
+            self.total_tokens += actual_tokens - estimated_tokens
+
+    def stats(self):
+        with self.lock:
+            self._refill(time.monotonic())
+            call_debt = max(0.0, -self.available_calls)
+            token_debt = max(0.0, -self.available_tokens) if self.token_rate else 0.0
+            return {
+                'max_calls_per_minute': self.max_calls,
+                'max_tokens_per_minute': self.max_tokens,
+                'available_calls': round(self.available_calls, 2),
+                'available_tokens': round(self.available_tokens) if self.token_rate else None,
+                # How long a request arriving now would wait
+                'current_wait_seconds': round(max(
+                    call_debt / self.call_rate,
+                    token_debt / self.token_rate if self.token_rate else 0.0
+                ), 3),
+                'waiting_threads': self.waiting,
+                'total_calls': self.total_calls,
+                'total_tokens': self.total_tokens,
+                'delayed_calls': self.delayed_calls,
+                'total_wait_seconds': round(self.total_wait, 3),
+                'max_wait_seconds': round(self.max_wait, 3)
+            }
+
+def estimate_request_tokens(prompt, image, field_count):
+    """Rough Gemini token count for one extraction, used to budget TPM before the call"""
+    # ~4 characters per text token
+    prompt_tokens = len(prompt) // 4
+    page_text = getattr(image, 'text', None)
+    # Images up to 384px cost 258 tokens; larger ones are tiled into 768px tiles of 258 each
+    if page_text:
+        image_tokens = len(page_text) // 4
+    elif image.width <= 384 and image.height <= 384:
+        image_tokens = 258
+    else:
+        image_tokens = math.ceil(image.width / 768) * math.ceil(image.height / 768) * 258
+    # value + confidence + clarity + evidence per field
+    output_tokens = field_count * 40
+    return prompt_tokens + image_tokens + output_tokens
+
+# Global rate limiter
+# Gemini 2.5 Flash paid tier: 1000 RPM, 10K RPD, 1M TPM
+# Setting to 500 RPM / 800K TPM with buffer for safety
+rate_limiter = RateLimiter(max_calls_per_minute=GEMINI_RPM, max_tokens_per_minute=GEMINI_TPM or None)
+
+# Extraction Cache Class
+class ExtractionCache:
+    """Persistent on-disk cache of extraction results keyed by backend, page hash and schema version.
+
+    A file's mtime is when the extraction was made and its atime when it was
+    last used: entries expire by age however often they're hit, and capacity
+    eviction drops the least recently used.
+    """
+
+    def __init__(self, cache_dir, max_entries=10000, ttl_seconds=30 * 24 * 3600):
+        self.cache_dir = Path(cache_dir)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self._entries = None  # Lazily counted on first write
+
+    def make_key(self, page_hash, schema_version, namespace):
+        """namespace names the backend and model, so results never cross between them"""
+        return hashlib.sha256(f"{namespace}:{page_hash}:{schema_version}".encode('utf-8')).hexdigest()
+
+    def _path(self, key):
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key):
+        """Return cached extraction data or None"""
+        path = self._path(key)
+        try:
+            age = time.time() - path.stat().st_mtime
+            if age > self.ttl_seconds:
+                path.unlink(missing_ok=True)
+                with self.lock:
+                    self.misses += 1
+                    self.evictions += 1
+                return None
+            with open(path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            # Record the use in atime only; mtime keeps the entry's age for the TTL
+            stat = path.stat()
+            os.utime(path, ns=(time.time_ns(), stat.st_mtime_ns))
+            with self.lock:
+                self.hits += 1
+            return data
+        except (FileNotFoundError, json.JSONDecodeError):
+            with self.lock:
+                self.misses += 1
+            return None
+        except Exception as e:
+            logger.error(f"Extraction cache read failed for {key}: {str(e)}")
+            with self.lock:
+                self.misses += 1
+            return None
+
+    def put(self, key, data):
+        """Store extraction data, evicting the oldest entries if over capacity"""
+        try:
+            self.cache_dir.mkdir(exist_ok=True)
+            path = self._path(key)
+            # Write to a temp file then rename so concurrent readers never see partial JSON
+            tmp_path = self.cache_dir / f"{key}.{uuid.uuid4().hex}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp_path, path)
+
+            with self.lock:
+                self.writes += 1
+                if self._entries is None:
+                    self._entries = sum(1 for _ in self.cache_dir.glob('*.json'))
+                else:
+                    self._entries += 1
+                needs_eviction = self._entries > self.max_entries
+            if needs_eviction:
+                self.evict()
+        except Exception as e:
+            logger.error(f"Extraction cache write failed for {key}: {str(e)}")
+
+    def evict(self):
+        """Drop expired entries, then least-recently-used ones until under capacity"""
+        with self.lock:
+            now = time.time()
+            entries = []
+            removed = 0
+            for path in self.cache_dir.glob('*.json'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime > self.ttl_seconds:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+                else:
+                    entries.append((stat.st_atime, path))
+
+            # Trim to 90% of capacity so we don't rescan the directory on every write
+            overflow = len(entries) - int(self.max_entries * 0.9) if len(entries) > self.max_entries else 0
+            if overflow > 0:
+                entries.sort()
+                for _, path in entries[:overflow]:
+                    path.unlink(missing_ok=True)
+                    removed += 1
+
+            self.evictions += removed
+            self._entries = len(entries) - max(0, overflow)
+            if removed:
+                logger.info(f"Extraction cache evicted {removed} entries")
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'enabled': EXTRACTION_CACHE_ENABLED,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0,
+                'writes': self.writes,
+                'evictions': self.evictions,
+                'entries': self._entries,
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl_seconds
+            }
+
+# Global extraction cache
+extraction_cache = ExtractionCache(
+    app.config['CACHE_FOLDER'],
+    max_entries=EXTRACTION_CACHE_MAX_ENTRIES,
+    ttl_seconds=EXTRACTION_CACHE_TTL_HOURS * 3600
+)
+
+def estimate_size(obj):
+    """Approximate in-memory footprint of a session's plain JSON-like data in bytes"""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += estimate_size(key) + estimate_size(value)
+    elif isinstance(obj, (list, tuple)):
+        for item in obj:
+            size += estimate_size(item)
+    return size
+
+# Session Cache Class
+class SessionCache:
+    """LRU cache of session results bounded by approximate memory usage"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # session_id -> (data, size)
+        # Sessions known to have a saved copy on disk; only those can be deleted behind our back
+        self.persisted = set()
+        self.resident_bytes = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, session_id):
+        with self.lock:
+            entry = self.entries.get(session_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(session_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, session_id, data, persisted=False):
+        size = estimate_size(data)
+        with self.lock:
+            old = self.entries.pop(session_id, None)
+            if old is not None:
+                self.resident_bytes -= old[1]
+            if persisted:
+                self.persisted.add(session_id)
+            else:
+                self.persisted.discard(session_id)
+
+            # A session larger than the whole budget is only kept on disk
+            if size > self.max_bytes:
+                logger.warning(f"Session {session_id} ({size} bytes) exceeds cache budget, serving from disk")
+                return
+
+            self.entries[session_id] = (data, size)
+            self.resident_bytes += size
+
+            while self.resident_bytes > self.max_bytes and self.entries:
+                evicted_id, (_, evicted_size) = self.entries.popitem(last=False)
+                self.persisted.discard(evicted_id)
+                self.resident_bytes -= evicted_size
+                self.evictions += 1
+                logger.info(f"Evicted session {evicted_id} from memory ({evicted_size} bytes)")
+
+    def pop(self, session_id):
+        with self.lock:
+            self.persisted.discard(session_id)
+            entry = self.entries.pop(session_id, None)
+            if entry is not None:
+                self.resident_bytes -= entry[1]
+                return entry[0]
+            return None
+
+    def is_persisted(self, session_id):
+        with self.lock:
+            return session_id in self.persisted
+
+    def __contains__(self, session_id):
+        with self.lock:
+            return session_id in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self.entries),
+                'resident_bytes': self.resident_bytes,
+                'max_bytes': self.max_bytes
+            }
+
+# Global storage for processed invoices with disk persistence
+processed_invoices = SessionCache(max_bytes=SESSION_CACHE_MAX_MB * 1024 * 1024)
+# Serializes disk loads so concurrent requests for the same session open it once
+processed_invoices_lock = threading.Lock()
+
+
+class PartialResults:
+    """Rows of jobs that are still running, in the order their pages finish.
+
+    The worker running a job keeps the rows in memory and appends each one to
+    sessions/<sid>.partial.jsonl, so any worker can answer a poll for the rows
+    added since a cursor. The finished session keeps the same order, so row ids
+    and cursors stay valid once the job completes.
+    """
+
+    def __init__(self, session_dir):
+        self.session_dir = Path(session_dir)
+        self.rows = {}
+        self.lock = threading.Lock()
+
+    def _path(self, session_id):
+        return self.session_dir / f"{session_id}.partial.jsonl"
+
+    def start(self, session_id):
+        # The file exists from the start so other workers can tell a running job from a missing one
+        self.session_dir.mkdir(exist_ok=True)
+        self._path(session_id).touch()
+        with self.lock:
+            self.rows[session_id] = []
+
+    def append(self, session_id, row):
+        """Add a finished page; returns its row id (None if the job isn't running here)"""
+        line = json.dumps(row, default=str) + "\n"
+        with self.lock:
+            rows = self.rows.get(session_id)
+            if rows is None:
+                return None
+            rows.append(row)
+            with open(self._path(session_id), 'a', encoding='utf-8') as f:
+                f.write(line)
+            return len(rows) - 1
+
+    def since(self, session_id, cursor):
+        """Rows from index `cursor` on, or None when the job isn't running"""
+        with self.lock:
+            rows = self.rows.get(session_id)
+            if rows is not None:
+                return rows[cursor:]
+        try:
+            with open(self._path(session_id), 'r', encoding='utf-8') as f:
+                # A line still being appended by the owning worker has no newline yet
+                return [json.loads(line) for index, line in enumerate(f)
+                        if index >= cursor and line.endswith("\n")]
+        except FileNotFoundError:
+            return None
+
+    def finish(self, session_id):
+        """Stop collecting and return the rows in completion order"""
+        with self.lock:
+            return self.rows.pop(session_id, None)
+
+    def discard(self, session_id):
+        """Remove the shared copy once the finished session has been saved"""
+        self._path(session_id).unlink(missing_ok=True)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'running_sessions': len(self.rows),
+                'rows': sum(len(rows) for rows in self.rows.values())
+            }
+
+# Rows of running jobs, served by /get_invoices/<session_id>?since=<cursor>
+partial_results = PartialResults(app.config['SESSION_FOLDER'])
+
+
+def row_sort_key(value):
+    """Comparable key for any cell: numbers (including '1,250.00') first, then text, then empty"""
+    if value is None or value == '':
+        return (2, 0.0, '')
+    if isinstance(value, bool):
+        value = str(value)
+    if isinstance(value, (int, float)):
+        return (0, float(value), '')
+    text = str(value).strip()
+    try:
+        number = float(text.replace(',', ''))
+        if math.isfinite(number):
+            return (0, number, '')
+    except ValueError:
+        pass
+    return (1, 0.0, text.lower())
+
+
+def row_value(invoice, field):
+    """A field, Source_File/Page_Number, _overall_confidence or _confidence.<field> of a row"""
+    if field.startswith('_confidence.'):
+        return invoice.get('_confidence_scores', {}).get(field[len('_confidence.'):])
+    return invoice.get(field)
+
+
+class SessionIndex:
+    """Per-field sorted orders of a finished session's rows.
+
+    Each order is built the first time a field is sorted or filtered on. After
+    that a page of a sort is a slice, and a comparison or null filter is a
+    bisect over the sorted keys, so requests cost O(log n + rows returned)
+    rather than a pass over the session.
+    """
+
+    def __init__(self, row_count):
+        self.row_count = row_count
+        self.orders = {}    # field -> (sorted keys, row ids in that order, rank of each row id)
+        self.lock = threading.Lock()
+
+    def order(self, field, invoices):
+        with self.lock:
+            cached = self.orders.get(field)
+        if cached is not None:
+            return cached
+        # Ties fall back to file and page order rather than the order pages finished in
+        keyed = sorted(
+            (row_sort_key(row_value(invoice, field)), row_sort_key(invoice.get('Source_File')),
+             row_sort_key(invoice.get('Page_Number')), row_id)
+            for row_id, invoice in enumerate(invoices)
+        )
+        keys = [entry[0] for entry in keyed]
+        row_ids = [entry[-1] for entry in keyed]
+        ranks = [0] * len(row_ids)
+        for position, row_id in enumerate(row_ids):
+            ranks[row_id] = position
+        with self.lock:
+            self.orders[field] = (keys, row_ids, ranks)
+        return keys, row_ids, ranks
+
+    def matching(self, field, op, value, invoices):
+        """Row ids matching one filter, via bisect on the field's sorted keys"""
+        keys, row_ids, _ = self.order(field, invoices)
+        if op == ':':
+            start = bisect.bisect_left(keys, (2,))
+            return row_ids[start:] if value == 'null' else row_ids[:start]
+
+        key = row_sort_key(value)
+        # Numbers only compare with numbers and text with text
+        low = bisect.bisect_left(keys, (key[0],))
+        high = bisect.bisect_left(keys, (key[0] + 1,))
+        left = bisect.bisect_left(keys, key, low, high)
+        right = bisect.bisect_right(keys, key, low, high)
+        if op == '=':
+            return row_ids[left:right]
+        if op == '!=':
+            return row_ids[:left] + row_ids[right:]
+        if op == '<':
+            return row_ids[low:left]
+        if op == '<=':
+            return row_ids[low:right]
+        if op == '>':
+            return row_ids[right:high]
+        return row_ids[left:high]    # '>='
+
+
+class SessionIndexCache:
+    """LRU of SessionIndex objects for finished sessions"""
+
+    def __init__(self, max_sessions):
+        self.max_sessions = max_sessions
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, session_id, row_count):
+        with self.lock:
+            index = self.entries.get(session_id)
+            if index is not None and index.row_count == row_count:
+                self.entries.move_to_end(session_id)
+                self.hits += 1
+                return index
+            self.misses += 1
+            index = SessionIndex(row_count)
+            self.entries[session_id] = index
+            while len(self.entries) > self.max_sessions:
+                self.entries.popitem(last=False)
+            return index
+
+    def discard(self, session_id):
+        with self.lock:
+            self.entries.pop(session_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'sessions': len(self.entries),
+                'sorted_fields': sum(len(index.orders) for index in self.entries.values()),
+                'max_sessions': self.max_sessions
+            }
+
+# Global row indexes for /get_invoices paging, sorting and filtering
+session_indexes = SessionIndexCache(SESSION_INDEX_MAX_SESSIONS)
+
+INVOICE_FILTER_PATTERN = re.compile(r'^\s*(?P<field>[\w.]+)\s*(?P<op><=|>=|!=|=|<|>|:)\s*(?P<value>.*?)\s*$')
+
+def query_invoices(invoices, index, schema_names, sort=None, filters=(), search=None, offset=0, limit=None):
+    """(matching row count, [(row_id, invoice)] for one page); raises ValueError for a bad query"""
+    fields = set(['Source_File', 'Page_Number', '_overall_confidence'] + schema_names)
+    fields.update(f"_confidence.{name}" for name in schema_names)
+
+    selected = None
+    for spec in filters:
+        match = INVOICE_FILTER_PATTERN.match(spec)
+        if not match or match.group('field') not in fields:
+            raise ValueError(f"Invalid filter: {spec}")
+        op, value = match.group('op'), match.group('value')
+        if op == ':' and value not in ('null', 'notnull'):
+            raise ValueError(f"Invalid filter: {spec} (use field:null or field:notnull)")
+        row_ids = index.matching(match.group('field'), op, value, invoices)
+        selected = set(row_ids) if selected is None else selected.intersection(row_ids)
+
+    if search:
+        # Free-text search has no index: one pass over the selected rows
+        needle = search.lower()
+        columns = ['Source_File', 'Page_Number'] + schema_names
+        if selected is None:
+            candidates = enumerate(invoices)
+        else:
+            row_ids = sorted(selected)
+            candidates = zip(row_ids, fetch_rows(invoices, row_ids))
+        selected = {row_id for row_id, invoice in candidates
+                    if any(needle in str(invoice.get(c) or '').lower() for c in columns)}
+
+    descending = bool(sort) and sort.startswith('-')
+    sort_field = sort.lstrip('-') if sort else None
+    if sort_field and sort_field not in fields:
+        raise ValueError(f"Invalid sort field: {sort_field}")
+
+    if selected is None:
+        total = len(invoices)
+        row_ids = index.order(sort_field, invoices)[1] if sort_field else range(len(invoices))
+        if descending:
+            # Slice from the end instead of reversing the whole order
+            end = max(0, total - offset)
+            page = row_ids[max(0, end - limit) if limit is not None else 0:end][::-1]
+        else:
+            page = row_ids[offset:offset + limit if limit is not None else None]
+    else:
+        total = len(selected)
+        if sort_field:
+            ranks = index.order(sort_field, invoices)[2]
+            row_ids = sorted(selected, key=ranks.__getitem__, reverse=descending)
+        else:
+            row_ids = sorted(selected)
+        page = row_ids[offset:offset + limit if limit is not None else None]
+
+    return total, list(zip(page, fetch_rows(invoices, page)))
+
+# Job Registry Classes
+class MemoryJobStore:
+    """No shared store; progress is only visible to the worker that owns the job"""
+
+    def save(self, session_id, status):
+        pass
+
+    def load(self, session_id):
+        return None
+
+    def delete(self, session_id):
+        pass
+
+    def save_trace(self, session_id, events):
+        pass
+
+    def load_trace(self, session_id):
+        return None
+
+
+class FileJobStore:
+    """One small JSON file per job, replaced atomically so readers never see a partial write"""
+
+    def __init__(self, job_dir):
+        self.job_dir = Path(job_dir)
+
+    def _path(self, session_id):
+        return self.job_dir / f"{session_id}.json"
+
+    def save(self, session_id, status):
+        self.job_dir.mkdir(exist_ok=True)
+        tmp_path = self.job_dir / f"{session_id}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(status, f)
+        os.replace(tmp_path, self._path(session_id))
+
+    def load(self, session_id):
+        try:
+            with open(self._path(session_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def delete(self, session_id):
+        self._path(session_id).unlink(missing_ok=True)
+        self._trace_path(session_id).unlink(missing_ok=True)
+
+    def _trace_path(self, session_id):
+        return self.job_dir / f"{session_id}.trace.json"
+
+    def save_trace(self, session_id, events):
+        self.job_dir.mkdir(exist_ok=True)
+        tmp_path = self.job_dir / f"{session_id}.trace.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(events, f, separators=(',', ':'))
+        os.replace(tmp_path, self._trace_path(session_id))
+
+    def load_trace(self, session_id):
+        try:
+            with open(self._trace_path(session_id), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+
+class DatabaseJobStore:
+    """Job rows in the application database, shared by every worker and host using it"""
+
+    def __init__(self):
+        self._table_ready = False
+
+    def _ensure_table(self):
+        # init_db only runs under `python app.py`, so create the tables on first use under gunicorn too
+        if not self._table_ready:
+            ProcessingJob.__table__.create(db.engine, checkfirst=True)
+            ProcessingTrace.__table__.create(db.engine, checkfirst=True)
+            self._table_ready = True
+
+    def save(self, session_id, status):
+        with app.app_context():
+            self._ensure_table()
+            db.session.merge(ProcessingJob(session_id=session_id, status=json.dumps(status)))
+            db.session.commit()
+            db.session.remove()
+
+    def load(self, session_id):
+        with app.app_context():
+            self._ensure_table()
+            job = db.session.get(ProcessingJob, session_id)
+            data = json.loads(job.status) if job else None
+            db.session.remove()
+            return data
+
+    def delete(self, session_id):
+        with app.app_context():
+            self._ensure_table()
+            ProcessingJob.query.filter_by(session_id=session_id).delete()
+            ProcessingTrace.query.filter_by(session_id=session_id).delete()
+            db.session.commit()
+            db.session.remove()
+
+    def save_trace(self, session_id, events):
+        with app.app_context():
+            self._ensure_table()
+            db.session.merge(ProcessingTrace(session_id=session_id, events=json.dumps(events, separators=(',', ':'))))
+            db.session.commit()
+            db.session.remove()
+
+    def load_trace(self, session_id):
+        with app.app_context():
+            self._ensure_table()
+            trace = db.session.get(ProcessingTrace, session_id)
+            events = json.loads(trace.events) if trace else None
+            db.session.remove()
+            return events
+
+
+class JobRegistry:
+    """Processing status shared across gunicorn workers.
+
+    The worker running a job keeps the authoritative copy in memory and writes
+    it through to the shared store on every change; any other worker answering
+    a progress poll reads it back from the store.
+
+    Store writes happen outside the registry lock, one at a time per job. A
+    change made while a write is in flight doesn't wait for it: the writer
+    saves the latest snapshot again once it's done, so changes that piled up
+    behind a slow store go out together.
+    """
+
+    def __init__(self, store, poll_interval=0.5):
+        self.store = store
+        self.poll_interval = poll_interval
+        self.jobs = {}
+        self.versions = {}
+        self.page_events = {}
+        self.traces = {}
+        self.trace_persisted = {}
+        self.updated = {}
+        self.write_locks = {}
+        self.persisted_versions = {}
+        self.persisted_trace_lengths = {}
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+
+    def create(self, session_id, status):
+        with self.lock:
+            self.jobs[session_id] = status
+            self.page_events[session_id] = []
+            self.traces[session_id] = []
+            self.trace_persisted[session_id] = time.monotonic()
+            self.write_locks[session_id] = {'status': threading.Lock(), 'trace': threading.Lock()}
+            self._bump(session_id)
+        self._write_status(session_id)
+
+    @contextmanager
+    def edit(self, session_id):
+        """Yield the live status dict (or None if unknown here) and persist any changes"""
+        with self.lock:
+            status = self.jobs.get(session_id)
+            yield status
+            if status is None:
+                return
+            self._bump(session_id)
+        self._write_status(session_id)
+
+    def get(self, session_id):
+        """Return a snapshot of the job status from this worker or the shared store"""
+        with self.lock:
+            status = self.jobs.get(session_id)
+            if status is not None:
+                return dict(status)
+        return self.store.load(session_id)
+
+    def add_page_event(self, session_id, event):
+        """Record a per-page completion for live streams (kept only on the owning worker)"""
+        with self.lock:
+            events = self.page_events.get(session_id)
+            if events is not None:
+                events.append(event)
+                self._bump(session_id)
+
+    def page_events_since(self, session_id, cursor):
+        with self.lock:
+            events = self.page_events.get(session_id, [])
+            return events[cursor:], len(events)
+
+    def add_trace_event(self, session_id, event):
+        """Record a finished span; written through to the store every TRACE_PERSIST_SECONDS"""
+        with self.lock:
+            events = self.traces.get(session_id)
+            if events is None or len(events) >= TRACE_MAX_EVENTS:
+                return
+            events.append(event)
+            now = time.monotonic()
+            if now - self.trace_persisted[session_id] < TRACE_PERSIST_SECONDS:
+                return
+            self.trace_persisted[session_id] = now
+        # Spans of the asyncio engine are recorded on its event loop, which must not wait on the store
+        run_off_loop(self._write_trace, session_id)
+
+    def flush_trace(self, session_id):
+        """Write the complete trace to the shared store (called when the job finishes)"""
+        with self.lock:
+            if session_id not in self.traces:
+                return
+            self.trace_persisted[session_id] = time.monotonic()
+        self._write_trace(session_id)
+
+    def trace_events(self, session_id):
+        """Spans recorded for a job by this worker, or the last copy persisted by its owner"""
+        with self.lock:
+            events = self.traces.get(session_id)
+            if events is not None:
+                return list(events)
+        return self.store.load_trace(session_id)
+
+    def version(self, session_id):
+        with self.lock:
+            return self.versions.get(session_id, 0)
+
+    def wait_for_change(self, session_id, version, timeout):
+        """Block until the job moves past `version` or timeout expires.
+
+        Jobs owned by this worker wake up immediately on change; jobs running in
+        another worker can only be observed by re-reading the shared store.
+        """
+        with self.changed:
+            if session_id in self.jobs:
+                self.changed.wait_for(lambda: self.versions.get(session_id, 0) != version, timeout)
+                return
+        time.sleep(min(timeout, self.poll_interval))
+
+    def running(self):
+        """Ids of the jobs this worker is still processing"""
+        with self.lock:
+            return {session_id for session_id, status in self.jobs.items() if not status.get('completed')}
+
+    def prune(self, max_age_seconds):
+        """Drop finished jobs unchanged for max_age_seconds from memory; the store still has them"""
+        cutoff = time.monotonic() - max_age_seconds
+        with self.lock:
+            stale = [session_id for session_id, status in self.jobs.items()
+                     if status.get('completed') and self.updated.get(session_id, 0) < cutoff]
+            for session_id in stale:
+                self._forget(session_id)
+        return len(stale)
+
+    def delete(self, session_id):
+        """Remove a job everywhere, including the shared store"""
+        with self.lock:
+            self._forget(session_id)
+        try:
+            self.store.delete(session_id)
+        except Exception as e:
+            logger.error(f"Failed to delete job status for {session_id}: {str(e)}")
+
+    def _forget(self, session_id):
+        # Caller holds self.lock
+        for entries in (self.jobs, self.versions, self.page_events, self.traces, self.trace_persisted, self.updated,
+                        self.write_locks, self.persisted_versions, self.persisted_trace_lengths):
+            entries.pop(session_id, None)
+
+    def _bump(self, session_id):
+        # Caller holds self.lock
+        self.versions[session_id] = self.versions.get(session_id, 0) + 1
+        self.updated[session_id] = time.monotonic()
+        self.changed.notify_all()
+
+    def _write_status(self, session_id):
+        self._write_through(session_id, 'status', self._status_snapshot, self._persist)
+
+    def _write_trace(self, session_id):
+        self._write_through(session_id, 'trace', self._trace_snapshot, self._persist_trace)
+
+    def _write_through(self, session_id, kind, take_snapshot, persist):
+        """Save the latest snapshot, or leave it to the write of that kind already in flight for this job"""
+        with self.lock:
+            write_lock = self.write_locks.get(session_id, {}).get(kind)
+        if write_lock is None:
+            return
+        while write_lock.acquire(blocking=False):
+            try:
+                with self.lock:
+                    snapshot = take_snapshot(session_id)
+                if snapshot is None:
+                    return
+                persist(session_id, snapshot)
+            finally:
+                write_lock.release()
+            # Changes made during the write were left to us; loop until none are
+
+    def _status_snapshot(self, session_id):
+        # Caller holds self.lock; None when the store is already up to date
+        status = self.jobs.get(session_id)
+        version = self.versions.get(session_id, 0)
+        if status is None or self.persisted_versions.get(session_id) == version:
+            return None
+        self.persisted_versions[session_id] = version
+        return dict(status)
+
+    def _trace_snapshot(self, session_id):
+        # Caller holds self.lock; None when the store is already up to date
+        events = self.traces.get(session_id)
+        if events is None or self.persisted_trace_lengths.get(session_id) == len(events):
+            return None
+        self.persisted_trace_lengths[session_id] = len(events)
+        return list(events)
+
+    def _persist(self, session_id, status):
+        try:
+            self.store.save(session_id, status)
+        except Exception as e:
+            logger.error(f"Failed to persist job status for {session_id}: {str(e)}")
+
+    def _persist_trace(self, session_id, events):
+        try:
+            self.store.save_trace(session_id, events)
+        except Exception as e:
+            logger.error(f"Failed to persist job trace for {session_id}: {str(e)}")
+
+
+def create_job_store(backend):
+    if backend == 'db':
+        return DatabaseJobStore()
+    if backend == 'memory':
+        return MemoryJobStore()
+    return FileJobStore(app.config['JOB_FOLDER'])
+
+# Global storage for background processing status
+processing_status = JobRegistry(create_job_store(JOB_REGISTRY_BACKEND))
+
+# Job Tracing
+# (session_id, trace row) of the page the current thread or coroutine is working on
+_trace_context = contextvars.ContextVar('trace_context', default=None)
+
+
+@contextmanager
+def page_trace(session_id, source_file, page):
+    """Attribute spans recorded inside the block to one page (or batch) of a session"""
+    if not session_id or not TRACE_ENABLED:
+        yield
+        return
+    token = _trace_context.set((session_id, f"{source_file} p{page}"))
+    try:
+        yield
+    finally:
+        _trace_context.reset(token)
+
+
+def record_span(name, started, duration, **args):
+    """Add a finished span (wall-clock start, seconds) to the current page's trace"""
+    context = _trace_context.get()
+    if context is None:
+        return
+    session_id, row = context
+    processing_status.add_trace_event(session_id, {
+        'name': name,
+        'row': row,
+        'ts': round(started * 1e6),
+        'dur': round(duration * 1e6),
+        'thread': threading.current_thread().name,
+        'args': args
+    })
+
+
+@contextmanager
+def trace_span(name, **args):
+    """Time the block as a span of the current page; failures are recorded with their error"""
+    if _trace_context.get() is None:
+        yield
+        return
+    started = time.time()
+    began = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        args['error'] = str(e)[:200]
+        raise
+    finally:
+        record_span(name, started, time.perf_counter() - began, **args)
+
+
+def build_chrome_trace(session_id, events, status=None):
+    """Chrome trace-event JSON with one track per page, timestamps relative to the first span"""
+    events = sorted(events, key=lambda e: e['ts'])
+    origin = events[0]['ts'] if events else 0
+    rows = {}
+    trace_events = [{'ph': 'M', 'pid': 1, 'tid': 0, 'name': 'process_name', 'args': {'name': f"session {session_id}"}}]
+    for event in events:
+        tid = rows.get(event['row'])
+        if tid is None:
+            tid = rows[event['row']] = len(rows) + 1
+            trace_events.append({'ph': 'M', 'pid': 1, 'tid': tid, 'name': 'thread_name', 'args': {'name': event['row']}})
+            trace_events.append({'ph': 'M', 'pid': 1, 'tid': tid, 'name': 'thread_sort_index', 'args': {'sort_index': tid}})
+        trace_events.append({
+            'name': event['name'],
+            'cat': 'pipeline',
+            'ph': 'X',
+            'pid': 1,
+            'tid': tid,
+            'ts': event['ts'] - origin,
+            'dur': event['dur'],
+            'args': dict(event['args'], thread=event['thread'])
+        })
+    return {
+        'traceEvents': trace_events,
+        'displayTimeUnit': 'ms',
+        'otherData': {
+            'session_id': session_id,
+            'started_at': datetime.utcfromtimestamp(origin / 1e6).isoformat() + 'Z' if events else None,
+            'spans': len(events),
+            'truncated': len(events) >= TRACE_MAX_EVENTS,
+            'completed': bool(status and status.get('completed'))
+        }
+    }
+
+# Single-letter codes for visual_clarity in the compact response format
+CLARITY_CODES = {
+    "C": "Crisp",
+    "R": "Readable",
+    "S": "Slightly Blurry",
+    "V": "Very Blurry/Pixelated",
+    "M": "Missing"
+}
+
+def get_gemini_prompt(fields):
+    """Generate a clean Gemini prompt with confidence scoring"""
+    if RESPONSE_FORMAT == 'compact':
+        return get_gemini_compact_prompt(fields)
+
+    field_list = "\n".join([f"- {f.name}: {f.description or 'Extract this value'}" for f in fields])
+
+    example_field = fields[0].name if fields else "Field_Name"
+    example_json = {example_field: {"value": "extracted_value", "confidence": 95, "visual_clarity": "Crisp", "visual_evidence": "Clear text visible"}}
+
+    return f"""You are an invoice data extractor.
+
+Extract values EXACTLY as they appear in the image.
+Do not standardize, normalize, convert, or correct any data.
+
+Fields to extract:
+{field_list}
+
+For EVERY field, return:
+- value (as seen)
+- confidence (0-100)
+- visual_clarity
+- visual_evidence
+
+CONFIDENCE = how clearly the value is visible:
+- 90-100: Very clear
+- 70-89: Readable
+- 40-69: Partially unclear
+- 1-39: Very unclear
+- 0: Not visible
+
+VISUAL_CLARITY (use only):
+"Crisp", "Readable", "Slightly Blurry", "Very Blurry/Pixelated", "Missing"
+
+RULES:
+1. Extract only what is visually present. Do NOT guess.
+2. Handwritten values override printed values only if clearly numeric and labeled.
+3. Keep text, spelling, symbols, and formatting exactly as seen.
+4. If a field is not visible: value = null, confidence = 0, visual_clarity = "Missing", visual_evidence = "Not visible"
+5. HANDWRITTEN ADJUSTMENTS: If you see handwritten deductions like "less 20%", "return", "short", or "-500":
+   - Convert percentages to actual amounts (e.g., "less 20%" on 10000 = 2000)
+   - SUM all adjustments of same type into one field (e.g., multiple discounts → total Discount)
+   - Use the FINAL calculated total if handwritten, not the printed subtotals
+
+Example:
+{json.dumps(example_json, indent=2)}
+
+Return ONLY valid JSON, no explanations."""
+
+def get_gemini_compact_prompt(fields):
+    """Same rules as get_gemini_prompt, but one short positional array per field"""
+    field_list = "\n".join([f"- {f.name}: {f.description or 'Extract this value'}" for f in fields])
+    clarity_list = ", ".join(f'"{code}" = {label}' for code, label in CLARITY_CODES.items())
+
+    example_fields = [f.name for f in fields[:2]] or ["Field_Name"]
+    example_json = {example_fields[0]: ["extracted_value", 95, "C"]}
+    if len(example_fields) > 1:
+        example_json[example_fields[1]] = ["partly hidden value", 55, "S", "stamp covers last two digits"]
+
+    if STRUCTURED_OUTPUT:
+        entry_format = '{"v": value, "c": confidence, "q": clarity code, "e": evidence}'
+        example_json = {
+            name: dict(zip(("v", "c", "q", "e"), entry)) for name, entry in example_json.items()
+        }
+    else:
+        entry_format = '[value, confidence, clarity code] or [value, confidence, clarity code, evidence]'
+
+    return f"""You are an invoice data extractor.
+
+Extract values EXACTLY as they appear in the image.
+Do not standardize, normalize, convert, or correct any data.
+
+Fields to extract:
+{field_list}
+
+For EVERY field, return {entry_format}:
+- value (as seen)
+- confidence (0-100)
+- clarity code: {clarity_list}
+- evidence: a short note on where/how the value is visible, ONLY when confidence is below {COMPACT_EVIDENCE_THRESHOLD}; omit it otherwise
+
+CONFIDENCE = how clearly the value is visible:
+- 90-100: Very clear
+- 70-89: Readable
+- 40-69: Partially unclear
+- 1-39: Very unclear
+- 0: Not visible
+
+RULES:
+1. Extract only what is visually present. Do NOT guess.
+2. Handwritten values override printed values only if clearly numeric and labeled.
+3. Keep text, spelling, symbols, and formatting exactly as seen.
+4. If a field is not visible, return null for it instead of an entry.
+5. HANDWRITTEN ADJUSTMENTS: If you see handwritten deductions like "less 20%", "return", "short", or "-500":
+   - Convert percentages to actual amounts (e.g., "less 20%" on 10000 = 2000)
+   - SUM all adjustments of same type into one field (e.g., multiple discounts → total Discount)
+   - Use the FINAL calculated total if handwritten, not the printed subtotals
+
+Example:
+{json.dumps(example_json, ensure_ascii=False, separators=(',', ':'))}
+
+Return ONLY compact JSON with no whitespace, no explanations."""
+
+def get_gemini_batch_prompt(fields, page_count):
+    """Prompt for several pages in one request; same rules, answer is one object per page"""
+    return get_gemini_prompt(fields) + f"""
+
+BATCH MODE:
+You are given {page_count} separate invoice page images, labelled "Page 1" to "Page {page_count}".
+Treat every page as its own invoice and never copy values between pages.
+Return a JSON array with exactly {page_count} items, in page order, shaped like:
+[{{"page_index": 1, "fields": {{...JSON object for page 1 in the format above...}}}}, ...]"""
+
+def get_schema_version(fields):
+    """Hash of the active field set plus the rendered prompt, used to key cached extractions"""
+    if isinstance(fields, CompiledSchema):
+        return fields.version
+    field_spec = json.dumps([[f.name, f.description or ""] for f in fields])
+    payload = field_spec + "\n" + get_gemini_prompt(fields)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+class CompiledSchema(list):
+    """Snapshot of the active fields with their prompt and version rendered once.
+
+    It is a plain list of field objects, so it can be passed anywhere a schema
+    is expected; the extraction hot path reads the precomputed prompt from it.
+    """
+
+    def __init__(self, fields):
+        super().__init__(SimpleNamespace(name=f.name, description=f.description) for f in fields)
+        self.names = tuple(f.name for f in self)
+        self.prompt = get_gemini_prompt(self)
+        field_spec = json.dumps([[f.name, f.description or ""] for f in self])
+        self.version = hashlib.sha256((field_spec + "\n" + self.prompt).encode('utf-8')).hexdigest()
+        self._batch_prompts = {}
+        self.generation_config = genai.types.GenerationConfig(
+            temperature=0,
+            **structured_output_options(build_response_schema(self))
+        )
+        self.batch_generation_config = genai.types.GenerationConfig(
+            temperature=0,
+            **structured_output_options(build_batch_response_schema(self))
+        )
+
+    def batch_prompt(self, page_count):
+        prompt = self._batch_prompts.get(page_count)
+        if prompt is None:
+            prompt = self._batch_prompts[page_count] = get_gemini_batch_prompt(self, page_count)
+        return prompt
+
+
+VISUAL_CLARITY_VALUES = ["Crisp", "Readable", "Slightly Blurry", "Very Blurry/Pixelated", "Missing"]
+
+def build_response_schema(fields):
+    """Gemini response schema mirroring the prompt: one {value, confidence, ...} object per field"""
+    if RESPONSE_FORMAT == 'compact':
+        # Response schemas can't express positional tuples, so compact mode uses one-letter keys
+        field_schema = {
+            "type": "object",
+            "nullable": True,
+            "properties": {
+                "v": {"type": "string", "nullable": True},
+                "c": {"type": "integer"},
+                "q": {"type": "string", "enum": list(CLARITY_CODES)},
+                "e": {"type": "string"}
+            },
+            "required": ["v", "c", "q"]
+        }
+        return {
+            "type": "object",
+            "properties": {f.name: field_schema for f in fields},
+            "required": [f.name for f in fields]
+        }
+
+    field_schema = {
+        "type": "object",
+        "properties": {
+            "value": {"type": "string", "nullable": True},
+            "confidence": {"type": "integer"},
+            "visual_clarity": {"type": "string", "enum": VISUAL_CLARITY_VALUES},
+            "visual_evidence": {"type": "string"}
+        },
+        "required": ["value", "confidence", "visual_clarity", "visual_evidence"]
+    }
+    return {
+        "type": "object",
+        "properties": {f.name: field_schema for f in fields},
+        "required": [f.name for f in fields]
+    }
+
+def build_batch_response_schema(fields):
+    """Response schema for batch mode: an array of {page_index, fields} items"""
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {
+                "page_index": {"type": "integer"},
+                "fields": build_response_schema(fields)
+            },
+            "required": ["page_index", "fields"]
+        }
+    }
+
+def structured_output_options(response_schema):
+    """Extra GenerationConfig arguments for STRUCTURED_OUTPUT mode (empty when disabled)"""
+    if not STRUCTURED_OUTPUT:
+        return {}
+    return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+
+def compile_schema(schema):
+    """Return schema as a CompiledSchema, rendering its prompt only if it isn't one already"""
+    if isinstance(schema, CompiledSchema):
+        return schema
+    return CompiledSchema(schema)
+
+
+class SchemaCache:
+    """Active schema compiled once and reused until /api/fields changes it.
+
+    Mutations touch a stamp file next to the extraction cache, so every worker
+    process notices the change on its next lookup without querying the DB.
+    """
+
+    def __init__(self, stamp_path):
+        self.stamp_path = Path(stamp_path)
+        self.lock = threading.Lock()
+        self._compiled = None
+        self._stamp = None
+        self.loads = 0
+
+    def _read_stamp(self):
+        try:
+            return self.stamp_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def get(self):
+        """Compiled active schema; must be called inside an app context on a miss"""
+        stamp = self._read_stamp()
+        with self.lock:
+            if self._compiled is None or stamp != self._stamp:
+                self._compiled = CompiledSchema(get_current_fields())
+                self._stamp = stamp
+                self.loads += 1
+                logger.info(f"Schema compiled: {len(self._compiled)} fields, version {self._compiled.version[:12]}")
+            return self._compiled
+
+    def invalidate(self):
+        """Drop the compiled schema here and signal other workers to do the same"""
+        with self.lock:
+            self._compiled = None
+        try:
+            self.stamp_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.stamp_path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+            tmp_path.write_text(uuid.uuid4().hex)
+            os.replace(tmp_path, self.stamp_path)
+        except Exception as e:
+            logger.error(f"Could not update schema stamp: {str(e)}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'loads': self.loads,
+                'version': self._compiled.version if self._compiled is not None else None,
+                'model': GEMINI_MODEL,
+                'backend': EXTRACTION_BACKEND
+            }
+
+# Global schema cache
+schema_cache = SchemaCache(Path(app.config['CACHE_FOLDER']) / 'schema.stamp')
+
+class GeminiBackend:
+    """Extraction backend that calls the Gemini API"""
+
+    name = 'gemini'
+
+    def __init__(self, model_name):
+        self.model = genai.GenerativeModel(model_name)
+        # Cached extractions are only reused for the model that produced them
+        self.cache_namespace = f"gemini:{model_name}"
+
+    def generate(self, contents, schema, generation_config, page_count=1):
+        return self.model.generate_content(contents, generation_config=generation_config)
+
+    async def generate_async(self, contents, schema, generation_config, page_count=1):
+        return await self.model.generate_content_async(contents, generation_config=generation_config)
+
+
+class FakeBackend:
+    """Offline extraction backend that answers like Gemini without any network calls.
+
+    Latency is log-normal around FAKE_LATENCY_MS. A share of calls raise a 429
+    or return malformed JSON (chatter, truncation or plain prose), and field
+    confidences come from FAKE_FIELD_CONFIDENCE with FAKE_CONFIDENCE as the
+    default. Responses follow RESPONSE_FORMAT and batch mode, so the real
+    parser, retry and confidence code paths all run.
+    """
+
+    name = 'fake'
+    cache_namespace = 'fake'
+
+    def __init__(self, latency_ms=None, latency_sigma=None, rate_limit_rate=None, malformed_rate=None,
+                 confidence=None, field_confidence=None, seed=None):
+        self.latency_ms = FAKE_LATENCY_MS if latency_ms is None else latency_ms
+        self.latency_sigma = FAKE_LATENCY_SIGMA if latency_sigma is None else latency_sigma
+        self.rate_limit_rate = FAKE_RATE_LIMIT_RATE if rate_limit_rate is None else rate_limit_rate
+        self.malformed_rate = FAKE_MALFORMED_RATE if malformed_rate is None else malformed_rate
+        self.confidence = FAKE_CONFIDENCE if confidence is None else confidence
+        self.field_confidence = FAKE_FIELD_CONFIDENCE if field_confidence is None else field_confidence
+        self.random = random.Random(seed if seed is not None else FAKE_SEED)
+        self.lock = threading.Lock()
+        self.calls = 0
+
+    def _plan(self, schema, page_count):
+        """Decide one call's latency, outcome and body under the lock so a seed replays exactly"""
+        with self.lock:
+            self.calls += 1
+            latency = self.latency_ms / 1000 * math.exp(self.random.gauss(0, self.latency_sigma))
+            if self.random.random() < self.rate_limit_rate:
+                return latency, 'rate_limited', None
+            pages = [self._fields(schema) for _ in range(page_count)]
+            malformed = self.random.choice(['chatter', 'truncated', 'prose']) \
+                if self.random.random() < self.malformed_rate else None
+        if page_count > 1:
+            body = [{'page_index': i, 'fields': fields} for i, fields in enumerate(pages, start=1)]
+        else:
+            body = pages[0]
+        return latency, malformed, body
+
+    def _fields(self, schema):
+        fields = {}
+        for field in schema:
+            base = self.field_confidence.get(field.name, self.confidence)
+            confidence = max(0, min(100, int(self.random.gauss(base, 5))))
+            if confidence < 20:
+                value, clarity, evidence = None, 'Missing', 'Not visible'
+            else:
+                value = f"{field.name[:3].upper()}-{self.random.randint(1000, 99999)}"
+                clarity = 'Crisp' if confidence >= 80 else 'Slightly Blurry' if confidence < 60 else 'Readable'
+                evidence = f"printed next to the {field.name.replace('_', ' ')} label"
+            if RESPONSE_FORMAT == 'compact':
+                entry = [value, confidence, clarity[0]]
+                if confidence < COMPACT_EVIDENCE_THRESHOLD:
+                    entry.append(evidence)
+                fields[field.name] = entry if value is not None else None
+            else:
+                fields[field.name] = {'value': value, 'confidence': confidence,
+                                      'visual_clarity': clarity, 'visual_evidence': evidence}
+        return fields
+
+    def _respond(self, contents, outcome, body):
+        if outcome == 'rate_limited':
+            raise Exception("429 Resource has been exhausted (fake backend)")
+        text = json.dumps(body)
+        if outcome == 'chatter':
+            text = f"Here is the extracted data:\n```json\n{text}\n```"
+        elif outcome == 'truncated':
+            text = text[:max(1, len(text) * 3 // 4)]
+        elif outcome == 'prose':
+            text = "I could not find an invoice on this page."
+        prompt_chars = sum(len(part) for part in contents if isinstance(part, str))
+        image_count = sum(1 for part in contents if isinstance(part, dict))
+        prompt_tokens = prompt_chars // 4 + image_count * 1032
+        usage = SimpleNamespace(prompt_token_count=prompt_tokens, candidates_token_count=len(text) // 4,
+                                total_token_count=prompt_tokens + len(text) // 4)
+        return SimpleNamespace(text=text, usage_metadata=usage)
+
+    def generate(self, contents, schema, generation_config, page_count=1):
+        latency, outcome, body = self._plan(schema, page_count)
+        time.sleep(latency)
+        return self._respond(contents, outcome, body)
+
+    async def generate_async(self, contents, schema, generation_config, page_count=1):
+        latency, outcome, body = self._plan(schema, page_count)
+        await asyncio.sleep(latency)
+        return self._respond(contents, outcome, body)
+
+
+def create_extraction_backend(name):
+    if name == 'fake':
+        return FakeBackend()
+    return GeminiBackend(GEMINI_MODEL)
+
+_extraction_backend = None
+_extraction_backend_lock = threading.Lock()
+
+def get_extraction_backend():
+    """Process-wide extraction backend, created once and shared by every request"""
+    global _extraction_backend
+    if _extraction_backend is None:
+        with _extraction_backend_lock:
+            if _extraction_backend is None:
+                _extraction_backend = create_extraction_backend(EXTRACTION_BACKEND)
+    return _extraction_backend
+
+SESSION_FORMAT_VERSION = 1
+
+def _session_path(session_id, extension='sqlite'):
+    return Path(app.config['SESSION_FOLDER']) / f"{session_id}.{extension}"
+
+def encode_session_record(invoice):
+    return zlib.compress(json.dumps(invoice, separators=(',', ':'), default=str).encode('utf-8'))
+
+def decode_session_record(record):
+    return json.loads(zlib.decompress(record))
+
+
+class StoredSession(Sequence):
+    """A saved session read lazily from its SQLite file.
+
+    Every invoice is its own compressed JSON record keyed by row id, so
+    looking up one row or one page of rows reads only those records. Each
+    access opens a short-lived read-only connection with the file memory
+    mapped, so the object can be shared between request threads.
+    """
+
+    def __init__(self, path, row_count):
+        self.path = Path(path)
+        self.row_count = row_count
+
+    @contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        try:
+            connection.execute(f"PRAGMA mmap_size={256 * 1024 * 1024}")
+            yield connection
+        finally:
+            connection.close()
+
+    def __len__(self):
+        return self.row_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.row_count)
+            if step != 1:
+                return list(self)[index]
+            if start >= stop:
+                return []
+            with self._connect() as connection:
+                records = connection.execute(
+                    "SELECT record FROM invoices WHERE row_id >= ? AND row_id < ? ORDER BY row_id", (start, stop)
+                ).fetchall()
+            return [decode_session_record(record) for (record,) in records]
+
+        if index < 0:
+            index += self.row_count
+        if not 0 <= index < self.row_count:
+            raise IndexError('session row out of range')
+        with self._connect() as connection:
+            row = connection.execute("SELECT record FROM invoices WHERE row_id = ?", (index,)).fetchone()
+        return decode_session_record(row[0])
+
+    def __iter__(self):
+        with self._connect() as connection:
+            for (record,) in connection.execute("SELECT record FROM invoices ORDER BY row_id"):
+                yield decode_session_record(record)
+
+    def rows(self, row_ids):
+        """Several rows, in the order given, with one query per 500 ids"""
+        row_ids = list(row_ids)
+        records = {}
+        with self._connect() as connection:
+            for start in range(0, len(row_ids), 500):
+                chunk = row_ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                records.update(connection.execute(
+                    f"SELECT row_id, record FROM invoices WHERE row_id IN ({placeholders})", chunk
+                ).fetchall())
+        return [decode_session_record(records[row_id]) for row_id in row_ids]
+
+
+def fetch_rows(invoices, row_ids):
+    """Rows by id from an in-memory list or a StoredSession (batched reads)"""
+    if isinstance(invoices, StoredSession):
+        return invoices.rows(row_ids)
+    return [invoices[row_id] for row_id in row_ids]
+
+
+def save_session_to_disk(session_id, data):
+    """Save session data to disk as one compressed record per invoice; returns whether it was saved"""
+    session_file = _session_path(session_id)
+    # Build under a temporary name so readers only ever open a complete file
+    tmp_path = session_file.with_name(f"{session_id}.{uuid.uuid4().hex}.tmp")
+    try:
+        session_file.parent.mkdir(exist_ok=True)
+        connection = sqlite3.connect(tmp_path)
+        try:
+            connection.execute("PRAGMA journal_mode=OFF")
+            connection.execute("CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            connection.execute("CREATE TABLE invoices (row_id INTEGER PRIMARY KEY, record BLOB NOT NULL)")
+            # Lets the janitor tell which page images are in use without decoding every row
+            connection.execute("CREATE TABLE images (image_id TEXT PRIMARY KEY)")
+            connection.executemany("INSERT INTO meta VALUES (?, ?)", [
+                ('format_version', str(SESSION_FORMAT_VERSION)),
+                ('rows', str(len(data))),
+                ('saved_at', datetime.utcnow().isoformat())
+            ])
+            connection.executemany(
+                "INSERT INTO invoices VALUES (?, ?)",
+                ((row_id, encode_session_record(invoice)) for row_id, invoice in enumerate(data))
+            )
+            connection.executemany(
+                "INSERT OR IGNORE INTO images VALUES (?)",
+                ((invoice['_image_id'],) for invoice in data if invoice.get('_image_id'))
+            )
+            connection.commit()
+        finally:
+            connection.close()
+        os.replace(tmp_path, session_file)
+        logger.info(f"Session {session_id} saved to disk")
+        return True
+    except Exception as e:
+        logger.error(f"Failed to save session {session_id}: {str(e)}")
+        tmp_path.unlink(missing_ok=True)
+        return False
+
+def stored_session_image_ids(session_file):
+    """Page image ids a session file refers to, without decoding its rows"""
+    connection = sqlite3.connect(session_file)
+    try:
+        try:
+            return {image_id for image_id, in connection.execute("SELECT image_id FROM images")}
+        except sqlite3.OperationalError:
+            pass
+        # Saved before sessions listed their images: read the rows once and add the list
+        image_ids = {decode_session_record(record).get('_image_id')
+                     for record, in connection.execute("SELECT record FROM invoices")}
+        image_ids.discard(None)
+        accessed = session_file.stat().st_mtime
+        connection.execute("CREATE TABLE IF NOT EXISTS images (image_id TEXT PRIMARY KEY)")
+        connection.executemany("INSERT OR IGNORE INTO images VALUES (?)", ((i,) for i in image_ids))
+        connection.commit()
+    finally:
+        connection.close()
+    # The file's mtime is its last access; this write isn't one
+    os.utime(session_file, (accessed, accessed))
+    return image_ids
+
+def open_stored_session(session_file):
+    """StoredSession for a session file, or None if it isn't one this version can read"""
+    connection = sqlite3.connect(f"file:{session_file}?mode=ro", uri=True)
+    try:
+        meta = dict(connection.execute("SELECT key, value FROM meta").fetchall())
+    finally:
+        connection.close()
+    if int(meta.get('format_version', 0)) > SESSION_FORMAT_VERSION:
+        logger.error(f"Session file {session_file.name} has unsupported format version {meta['format_version']}")
+        return None
+    return StoredSession(session_file, int(meta['rows']))
+
+
+class PlainDataUnpickler(pickle.Unpickler):
+    """Reads legacy .pkl sessions without constructing arbitrary objects.
+
+    Sessions only ever held lists, dicts, strings and numbers, which pickle
+    encodes without looking up any class; anything else is refused.
+    """
+
+    def find_class(self, module, name):
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a session file")
+
+
+def migrate_legacy_session(session_id):
+    """Convert a pre-SQLite .pkl session to the record format; returns True if one was converted"""
+    legacy_file = _session_path(session_id, 'pkl')
+    if not legacy_file.exists():
+        return False
+    with open(legacy_file, 'rb') as f:
+        data = PlainDataUnpickler(f).load()
+    if not isinstance(data, list):
+        raise ValueError(f"Legacy session {session_id} is not a list of invoices")
+    if not save_session_to_disk(session_id, data):
+        return False
+    legacy_file.unlink(missing_ok=True)
+    logger.info(f"Session {session_id} migrated from pickle")
+    return True
+
+def load_session_from_disk(session_id):
+    """Open a saved session; rows are read from disk as they are accessed"""
+    try:
+        session_file = _session_path(session_id)
+        if not session_file.exists() and not migrate_legacy_session(session_id):
+            return None
+        data = open_stored_session(session_file)
+        if data is not None:
+            logger.info(f"Session {session_id} opened from disk ({len(data)} rows)")
+        return data
+    except Exception as e:
+        logger.error(f"Failed to load session {session_id}: {str(e)}")
+        return None
+
+IMAGE_STORE_EXTENSIONS = {'image/png': 'png', 'image/jpeg': 'jpg', 'image/webp': 'webp'}
+
+def _image_path(image_id, extension='png'):
+    """Images are sharded by the first two hex chars to keep directories small"""
+    return Path(app.config['IMAGE_FOLDER']) / image_id[:2] / f"{image_id}.{extension}"
+
+def find_stored_image(image_id):
+    """Return (path, mime_type) of a stored page image, or (None, None)"""
+    for mime_type, extension in IMAGE_STORE_EXTENSIONS.items():
+        path = _image_path(image_id, extension)
+        if path.exists():
+            return path, mime_type
+    return None, None
+
+def store_page_image(image):
+    """Write a page to the content-addressed store and return its id (sha256 of the stored bytes)"""
+    mime_type, data = as_page_payload(image).stored_image()
+    image_id = hashlib.sha256(data).hexdigest()
+
+    path = _image_path(image_id, IMAGE_STORE_EXTENSIONS[mime_type])
+    try:
+        # Reused pages count as new for the janitor's grace period
+        os.utime(path)
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Identical pages map to the same file, so a concurrent writer is harmless
+        tmp_path = path.with_suffix(f".{uuid.uuid4().hex}.tmp")
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    return image_id
+
+def get_session_data(session_id):
+    """Get session data from memory or disk"""
+    janitor.touch(session_id)
+    # Try memory first
+    data = processed_invoices.get(session_id)
+    if data is not None:
+        if processed_invoices.is_persisted(session_id) and not any(
+                _session_path(session_id, extension).exists() for extension in ('sqlite', 'pkl')):
+            # Saved once and since deleted by the janitor, possibly in another worker
+            processed_invoices.pop(session_id)
+            return None
+        return data
+
+    with processed_invoices_lock:
+        # Another request may have loaded it while we waited
+        if session_id in processed_invoices:
+            return processed_invoices.get(session_id)
+
+        # Try disk
+        data = load_session_from_disk(session_id)
+        if data:
+            # Cache in memory (may evict least recently used sessions)
+            processed_invoices.put(session_id, data, persisted=True)
+            return data
+        
+        logger.warning(f"Session {session_id} not found in memory or disk")
+        return None
+
+
+# Session Exports
+EXPORT_FORMATS = {
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet'
+}
+
+def export_columns(schema_names):
+    return ['Source_File', 'Page_Number'] + list(schema_names)
+
+def iter_export_rows(invoices, columns):
+    # Sessions are stored in the order pages finished; exports read in file and page order.
+    # Only the sort keys stay in memory, rows are read back a chunk at a time in that order
+    order = sorted((str(invoice.get('Source_File', '')), invoice.get('Page_Number') or 0, row_id)
+                   for row_id, invoice in enumerate(invoices))
+    for start in range(0, len(order), EXPORT_CHUNK_ROWS):
+        for invoice in fetch_rows(invoices, [row_id for _, _, row_id in order[start:start + EXPORT_CHUNK_ROWS]]):
+            row = []
+            for field in columns:
+                value = invoice.get(field, '')
+                # Cells only take scalars; anything else the model returned is written as text
+                row.append(value if value is None or isinstance(value, (str, int, float, bool)) else str(value))
+            yield row
+
+def iter_export_chunks(invoices, columns):
+    """Rows in lists of at most EXPORT_CHUNK_ROWS"""
+    chunk = []
+    for row in iter_export_rows(invoices, columns):
+        chunk.append(row)
+        if len(chunk) >= EXPORT_CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def iter_csv_export(invoices, columns):
+    """CSV text in chunks of EXPORT_CHUNK_ROWS rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for chunk in iter_export_chunks(invoices, columns):
+        writer.writerows(chunk)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+def write_xlsx_export(path, invoices, columns):
+    # Write-only mode streams rows to the file instead of building the sheet in memory
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Invoice Data')
+    sheet.append(columns)
+    for row in iter_export_rows(invoices, columns):
+        sheet.append(row)
+    workbook.save(path)
+
+def write_csv_export(path, invoices, columns):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for text in iter_csv_export(invoices, columns):
+            f.write(text)
+
+def write_parquet_export(path, invoices, columns):
+    # Only needed for Parquet, so the app still runs where pyarrow isn't installed
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(c, pa.int64() if c == 'Page_Number' else pa.string()) for c in columns])
+    with pq.ParquetWriter(path, schema) as writer:
+        for chunk in iter_export_chunks(invoices, columns):
+            data = {}
+            for index, column in enumerate(columns):
+                values = [row[index] for row in chunk]
+                if column == 'Page_Number':
+                    data[column] = [v if isinstance(v, int) else None for v in values]
+                else:
+                    data[column] = [None if v is None or v == '' else str(v) for v in values]
+            writer.write_table(pa.Table.from_pydict(data, schema=schema))
+
+EXPORT_WRITERS = {'xlsx': write_xlsx_export, 'csv': write_csv_export, 'parquet': write_parquet_export}
+
+
+class ExportCache:
+    """Finished exports on disk, one file per session, schema version and format.
+
+    Files are written under a temporary name and renamed into place, so other
+    requests and workers only ever see complete exports. Generating one format
+    for a session removes that format's exports for older schema versions.
+    """
+
+    def __init__(self, export_dir):
+        self.export_dir = Path(export_dir)
+        self.lock = threading.Lock()
+        self.generating = {}
+        self.hits = 0
+        self.misses = 0
+        self.generated = 0
+        self.generate_seconds = 0.0
+
+    def path(self, session_id, version, export_format):
+        return self.export_dir / f"{session_id}.{version[:16]}.{export_format}"
+
+    def get(self, session_id, version, export_format):
+        """Path of a finished export, or None"""
+        path = self.path(session_id, version, export_format)
+        exists = path.exists()
+        with self.lock:
+            if exists:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path if exists else None
+
+    def generate(self, session_id, invoices, columns, version, export_format):
+        """Write an export unless it already exists; concurrent callers wait for the first"""
+        path = self.path(session_id, version, export_format)
+        with self.lock:
+            path_lock = self.generating.setdefault(path.name, threading.Lock())
+        with path_lock:
+            if not path.exists():
+                started = time.perf_counter()
+                self.export_dir.mkdir(exist_ok=True)
+                # Unique per call: other workers may be writing the same export, and forked
+                # processes reuse thread idents, so only this lock's process is serialized
+                tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+                try:
+                    EXPORT_WRITERS[export_format](tmp_path, invoices, columns)
+                    os.replace(tmp_path, path)
+                finally:
+                    tmp_path.unlink(missing_ok=True)
+                self._remove_stale(session_id, export_format, path)
+                elapsed = time.perf_counter() - started
+                with self.lock:
+                    self.generated += 1
+                    self.generate_seconds += elapsed
+                logger.info(f"Export {path.name} generated in {elapsed:.2f}s")
+        with self.lock:
+            self.generating.pop(path.name, None)
+        return path
+
+    def stream_csv(self, session_id, invoices, columns, version):
+        """Stream a CSV export to the client while writing it to the cache"""
+        path = self.path(session_id, version, 'csv')
+        self.export_dir.mkdir(exist_ok=True)
+        tmp_path = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+
+        def generate():
+            try:
+                with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+                    for text in iter_csv_export(invoices, columns):
+                        f.write(text)
+                        yield text
+                os.replace(tmp_path, path)
+                self._remove_stale(session_id, 'csv', path)
+                with self.lock:
+                    self.generated += 1
+            finally:
+                # An aborted download leaves no partial export behind
+                tmp_path.unlink(missing_ok=True)
+
+        return generate()
+
+    def _remove_stale(self, session_id, export_format, keep):
+        for stale in self.export_dir.glob(f"{session_id}.*.{export_format}"):
+            if stale != keep:
+                stale.unlink(missing_ok=True)
+
+    def delete(self, session_id):
+        for path in self.export_dir.glob(f"{session_id}.*"):
+            path.unlink(missing_ok=True)
+
+    def stats(self):
+        files = list(self.export_dir.glob('*.*')) if self.export_dir.exists() else []
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'generated': self.generated,
+                'generate_seconds': round(self.generate_seconds, 3),
+                'files': len(files),
+                'bytes': sum(f.stat().st_size for f in files if f.exists())
+            }
+
+# Global export cache; exports are pre-generated on one background thread as jobs finish
+export_cache = ExportCache(app.config['EXPORT_FOLDER'])
+export_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='export')
+
+def pregenerate_exports(session_id, invoices, schema):
+    """Write the EXPORT_PREGENERATE formats for a finished session so downloads are a file send"""
+    columns = export_columns(schema.names)
+    for export_format in EXPORT_PREGENERATE:
+        if export_format not in EXPORT_WRITERS:
+            logger.warning(f"Unknown export format in EXPORT_PREGENERATE: {export_format}")
+            continue
+        try:
+            export_cache.generate(session_id, invoices, columns, schema.version, export_format)
+        except Exception as e:
+            logger.error(f"Failed to pre-generate {export_format} export for {session_id}: {str(e)}")
+
+
+# Storage Janitor
+class Janitor:
+    """Background cleanup of sessions, exports, uploads, page images and job status.
+
+    Every JANITOR_INTERVAL_MINUTES each worker drops finished jobs older than
+    STATUS_TTL_MINUTES from memory. One worker per interval (claimed through a
+    stamp file) then cleans the shared folders:
+
+    - sessions not accessed for SESSION_TTL_HOURS, with their exports and job records
+    - least recently accessed sessions while sessions/, exports/, uploads/
+      and images/ exceed STORAGE_QUOTA_MB; a session's page images go with it
+      once no other session refers to them
+    - uploads, partial results and temp files older than UPLOAD_TTL_HOURS, left
+      behind by a worker that died mid-job
+    - page images no session refers to
+
+    Sessions of running jobs are never deleted. Access times are session file
+    mtimes, updated at most once a minute per session.
+    """
+
+    def __init__(self, interval_seconds, stamp_path):
+        self.interval = interval_seconds
+        self.stamp_path = Path(stamp_path)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.touched = {}
+        self.runs = 0
+        self.last_run = None
+        self.last_duration = 0.0
+        self.last_reclaimed = {}
+        self.reclaimed = {}
+        self.deleted = {}
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._loop, name='janitor', daemon=True)
+                self.thread.start()
+
+    def touch(self, session_id):
+        """Mark a session as used now, for TTL and least-recently-used deletion"""
+        now = time.monotonic()
+        with self.lock:
+            if now - self.touched.get(session_id, -60) < 60:
+                return
+            self.touched[session_id] = now
+        for extension in ('sqlite', 'pkl'):
+            try:
+                os.utime(_session_path(session_id, extension))
+                return
+            except FileNotFoundError:
+                continue
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                processing_status.prune(STATUS_TTL_MINUTES * 60)
+                if self._claim():
+                    self.run()
+            except Exception as e:
+                logger.error(f"Janitor pass failed: {str(e)}")
+
+    def _claim(self):
+        """True for the first worker to reach this interval's pass"""
+        try:
+            if time.time() - self.stamp_path.stat().st_mtime < self.interval * 0.9:
+                return False
+        except FileNotFoundError:
+            pass
+        self.stamp_path.parent.mkdir(exist_ok=True)
+        self.stamp_path.touch()
+        return True
+
+    def run(self):
+        """One cleanup pass over the shared folders; returns reclaimed bytes by kind"""
+        started = time.perf_counter()
+        now = time.time()
+        reclaimed = {}
+        deleted = {}
+
+        def removed(kind, size):
+            reclaimed[kind] = reclaimed.get(kind, 0) + size
+            deleted[kind] = deleted.get(kind, 0) + 1
+
+        session_dir = Path(app.config['SESSION_FOLDER'])
+        export_dir = Path(app.config['EXPORT_FOLDER'])
+        upload_dir = Path(app.config['UPLOAD_FOLDER'])
+        image_dir = Path(app.config['IMAGE_FOLDER'])
+        upload_ttl = UPLOAD_TTL_HOURS * 3600
+
+        # Leftovers of jobs whose worker died: partial results, uploads and half-written files
+        running = processing_status.running()
+        for path, size, mtime in _scan_files(session_dir):
+            if path.name.endswith('.partial.jsonl'):
+                session_id = path.name.split('.')[0]
+                if now - mtime > upload_ttl and session_id not in running:
+                    path.unlink(missing_ok=True)
+                    processing_status.delete(session_id)
+                    removed('partial', size)
+                else:
+                    running.add(session_id)
+        for folder in (session_dir, export_dir, Path(app.config['JOB_FOLDER']), image_dir):
+            for path, size, mtime in _scan_files(folder, recursive=folder == image_dir):
+                if path.suffix == '.tmp' and now - mtime > upload_ttl:
+                    path.unlink(missing_ok=True)
+                    removed('temp', size)
+        uploads = []
+        for path, size, mtime in _scan_files(upload_dir):
+            if now - mtime > upload_ttl:
+                path.unlink(missing_ok=True)
+                removed('uploads', size)
+            else:
+                uploads.append(size)
+
+        # Page images and the sessions (saved or still running) that refer to them
+        images = {}
+        for path, size, mtime in _scan_files(image_dir, recursive=True):
+            if path.suffix != '.tmp':
+                images[path.name.split('.')[0]] = (path, size, mtime)
+        references = self._image_references(session_dir)
+        ref_counts = {}
+        for image_ids in (references or {}).values():
+            for image_id in image_ids:
+                ref_counts[image_id] = ref_counts.get(image_id, 0) + 1
+
+        def release_image(image_id):
+            """Bytes an image stops taking once no session refers to it"""
+            path, size, mtime = images.get(image_id, (None, 0, now))
+            if path is None or ref_counts.get(image_id):
+                return 0
+            del images[image_id]
+            # Recent images may belong to a page whose row isn't written yet; a later pass deletes them
+            if now - mtime > IMAGE_GRACE_SECONDS:
+                path.unlink(missing_ok=True)
+                removed('images', size)
+            return size
+
+        image_bytes = sum(size for _, size, _ in images.values())
+        if references is not None:
+            for image_id in list(images):
+                image_bytes -= release_image(image_id)
+
+        # Sessions and their exports, by last access
+        sessions = {}
+        for path, size, mtime in _scan_files(session_dir):
+            if path.suffix in ('.sqlite', '.pkl'):
+                entry = sessions.setdefault(path.name.split('.')[0], {'bytes': 0, 'accessed': 0})
+                entry['bytes'] += size
+                entry['accessed'] = max(entry['accessed'], mtime)
+        for path, size, mtime in _scan_files(export_dir):
+            session_id = path.name.split('.')[0]
+            if path.suffix == '.tmp':
+                continue
+            if session_id in sessions:
+                sessions[session_id]['bytes'] += size
+            elif session_id not in running:
+                path.unlink(missing_ok=True)
+                removed('exports', size)
+
+        candidates = sorted((entry['accessed'], session_id) for session_id, entry in sessions.items()
+                            if session_id not in running)
+        kept_bytes = sum(entry['bytes'] for entry in sessions.values()) + sum(uploads) + image_bytes
+        quota = STORAGE_QUOTA_MB * 1024 * 1024
+        for accessed, session_id in candidates:
+            expired = SESSION_TTL_HOURS > 0 and now - accessed > SESSION_TTL_HOURS * 3600
+            over_quota = quota > 0 and kept_bytes > quota
+            if not expired and not over_quota:
+                # Candidates are oldest first, so nothing after this one qualifies either
+                break
+            size = sessions[session_id]['bytes']
+            delete_session(session_id)
+            kept_bytes -= size
+            removed('sessions_ttl' if expired else 'sessions_quota', size)
+            if references is not None:
+                for image_id in references.pop(session_id, ()):
+                    ref_counts[image_id] -= 1
+                    kept_bytes -= release_image(image_id)
+        if quota and kept_bytes > quota:
+            logger.warning(f"Storage still over quota after cleanup: {kept_bytes} bytes (running jobs are kept)")
+
+        # Job records without a session, e.g. failed uploads
+        job_store_dir = getattr(processing_status.store, 'job_dir', None)
+        if job_store_dir is not None and SESSION_TTL_HOURS > 0:
+            for path, size, mtime in _scan_files(job_store_dir):
+                session_id = path.name.split('.')[0]
+                if (path.suffix == '.json' and now - mtime > SESSION_TTL_HOURS * 3600
+                        and session_id not in sessions and session_id not in running):
+                    path.unlink(missing_ok=True)
+                    removed('jobs', size)
+
+        for kind, size in reclaimed.items():
+            JANITOR_RECLAIMED_BYTES.inc(kind, amount=size)
+        with self.lock:
+            self.runs += 1
+            self.last_run = datetime.utcnow().isoformat() + 'Z'
+            self.last_duration = time.perf_counter() - started
+            self.last_reclaimed = reclaimed
+            for kind, size in reclaimed.items():
+                self.reclaimed[kind] = self.reclaimed.get(kind, 0) + size
+            for kind, count in deleted.items():
+                self.deleted[kind] = self.deleted.get(kind, 0) + count
+            cutoff = time.monotonic() - 60
+            self.touched = {k: v for k, v in self.touched.items() if v > cutoff}
+        logger.info(f"Janitor reclaimed {sum(reclaimed.values())} bytes in {self.last_duration:.2f}s "
+                    f"({', '.join(f'{kind}: {size}' for kind, size in sorted(reclaimed.items())) or 'nothing to do'})")
+        return reclaimed
+
+    def _image_references(self, session_dir):
+        """{session_id: page image ids} for saved and running sessions, or None if one can't be read"""
+        references = {}
+        try:
+            for path, _, _ in _scan_files(session_dir):
+                if path.suffix == '.sqlite':
+                    image_ids = stored_session_image_ids(path)
+                elif path.suffix == '.pkl':
+                    with open(path, 'rb') as f:
+                        image_ids = {row.get('_image_id') for row in PlainDataUnpickler(f).load()}
+                elif path.name.endswith('.partial.jsonl'):
+                    with open(path, 'r', encoding='utf-8') as f:
+                        image_ids = {json.loads(line).get('_image_id') for line in f if line.endswith("\n")}
+                else:
+                    continue
+                references.setdefault(path.name.split('.')[0], set()).update(image_ids)
+        except Exception as e:
+            # A session that finished (or vanished) mid-scan can't be read reliably; try next pass
+            logger.warning(f"Skipping image cleanup: {str(e)}")
+            return None
+        for image_ids in references.values():
+            image_ids.discard(None)
+        return references
+
+    def stats(self):
+        with self.lock:
+            return {
+                'interval_seconds': self.interval,
+                'runs': self.runs,
+                'last_run': self.last_run,
+                'last_duration_seconds': round(self.last_duration, 3),
+                'last_reclaimed_bytes': dict(self.last_reclaimed),
+                'reclaimed_bytes': dict(self.reclaimed),
+                'deleted': dict(self.deleted),
+                'session_ttl_hours': SESSION_TTL_HOURS,
+                'storage_quota_mb': STORAGE_QUOTA_MB
+            }
+
+
+def _scan_files(folder, recursive=False):
+    """(path, size, mtime) of the files in a folder; missing folders are empty"""
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                if recursive:
+                    yield from _scan_files(entry.path, recursive=True)
+                continue
+            stat = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        yield Path(entry.path), stat.st_size, stat.st_mtime
+
+
+def delete_session(session_id):
+    """Remove a finished session's data, exports, job records and in-memory state"""
+    for extension in ('sqlite', 'pkl'):
+        _session_path(session_id, extension).unlink(missing_ok=True)
+    export_cache.delete(session_id)
+    processing_status.delete(session_id)
+    processed_invoices.pop(session_id)
+    session_indexes.discard(session_id)
+    logger.info(f"Deleted session {session_id}")
+
+# Global janitor (its thread starts with the first request)
+janitor = Janitor(JANITOR_INTERVAL_MINUTES * 60, Path(app.config['CACHE_FOLDER']) / 'janitor.stamp')
+JANITOR_RECLAIMED_BYTES = Counter(metrics, 'invoice_janitor_reclaimed_bytes_total', 'Disk space freed by the janitor, by kind',
+                                  labels=('kind',))
+
+@app.before_request
+def start_janitor():
+    janitor.start()
+
+
+def render_page_pixmap(page):
+    """Rasterize a PDF page at PDF_RENDER_DPI (native resolution by default)"""
+    if PDF_RENDER_DPI:
+        return page.get_pixmap(dpi=PDF_RENDER_DPI)
+    return page.get_pixmap()  # Native resolution - faster, Gemini handles it fine
+
+
+def pdf_to_images(pdf_bytes, session_id=None, source_file='pdf'):
+    """Convert PDF bytes to a list of page payloads using PyMuPDF with progress updates"""
+    try:
+        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
+        images = []
+        total_pages = len(pdf_document)
+
+        for page_num in range(total_pages):
+            with page_trace(session_id, source_file, page_num + 1), trace_span('render'):
+                images.append(load_pdf_page(pdf_document, pdf_document[page_num]))
+
+            # Update progress during PDF conversion (20-30% range)
+            if session_id:
+                with processing_status.edit(session_id) as status:
+                    if status is not None:
+                        # PDF conversion takes 20-30% of progress
+                        conversion_progress = 20 + int(((page_num + 1) / total_pages) * 10)
+                        status['percentage'] = conversion_progress
+                        status['message'] = f"Converting PDF page {page_num + 1} of {total_pages}..."
+
+        pdf_document.close()
+        logger.info(f"Successfully converted PDF to {len(images)} images")
+        return images
+    except Exception as e:
+        logger.error(f"Failed to convert PDF to images: {str(e)}")
+        return []
+
+
+# Page Scheduler Class
+class PageScheduler:
+    """Process-wide pool of page workers shared fairly between sessions.
+
+    Every page task in the worker goes through one fixed set of threads. Higher
+    priority sessions are served first; sessions with the same priority take
+    turns (`weight` pages per turn), so a 500-page upload can't starve a
+    1-page upload submitted after it.
+    """
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.has_work = threading.Condition(self.lock)
+        self.queues = {}        # session_id -> deque of (future, fn, args)
+        self.rotation = {}      # priority -> deque of session_ids with queued pages
+        self.sessions = {}      # session_id -> priority, weight and counters
+        self.workers = []
+
+    def submit(self, session_id, fn, *args, priority=0, weight=1):
+        """Queue fn(*args) for a session and return a concurrent.futures.Future"""
+        future = Future()
+        with self.lock:
+            self._ensure_workers()
+            info = self.sessions.get(session_id)
+            if info is None:
+                info = {'priority': priority, 'weight': max(1, weight), 'turn': 0, 'running': 0, 'completed': 0}
+                self.sessions[session_id] = info
+
+            session_queue = self.queues.get(session_id)
+            if session_queue is None:
+                session_queue = self.queues[session_id] = deque()
+                self.rotation.setdefault(info['priority'], deque()).append(session_id)
+            session_queue.append((future, fn, args))
+            self.has_work.notify()
+        return future
+
+    def _ensure_workers(self):
+        # Caller holds self.lock
+        while len(self.workers) < self.max_workers:
+            worker = threading.Thread(target=self._run, name=f"page-worker-{len(self.workers)}", daemon=True)
+            self.workers.append(worker)
+            worker.start()
+
+    def _next_task(self):
+        # Caller holds self.lock
+        for priority in sorted(self.rotation, reverse=True):
+            rotation = self.rotation[priority]
+            if not rotation:
+                continue
+
+            session_id = rotation[0]
+            session_queue = self.queues[session_id]
+            task = session_queue.popleft()
+            info = self.sessions[session_id]
+            info['running'] += 1
+            info['turn'] += 1
+
+            if not session_queue:
+                del self.queues[session_id]
+                rotation.popleft()
+                info['turn'] = 0
+            elif info['turn'] >= info['weight']:
+                rotation.rotate(-1)
+                info['turn'] = 0
+            return session_id, task
+        return None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                item = self._next_task()
+                while item is None:
+                    self.has_work.wait()
+                    item = self._next_task()
+
+            session_id, (future, fn, args) = item
+            if future.set_running_or_notify_cancel():
+                try:
+                    future.set_result(fn(*args))
+                except BaseException as e:
+                    future.set_exception(e)
+            # Don't keep the page image alive while waiting for the next task
+            item = future = fn = args = None
+
+            with self.lock:
+                info = self.sessions[session_id]
+                info['running'] -= 1
+                info['completed'] += 1
+                if not info['running'] and session_id not in self.queues:
+                    del self.sessions[session_id]
+
+    def queue_depth(self, session_id):
+        with self.lock:
+            return len(self.queues.get(session_id, ()))
+
+    def queued_pages(self):
+        with self.lock:
+            return sum(len(q) for q in self.queues.values())
+
+    def stats(self):
+        with self.lock:
+            sessions = {
+                str(session_id): {
+                    'queued': len(self.queues.get(session_id, ())),
+                    'running': info['running'],
+                    'completed': info['completed'],
+                    'priority': info['priority'],
+                    'weight': info['weight']
+                }
+                for session_id, info in self.sessions.items()
+            }
+            return {
+                'max_workers': self.max_workers,
+                'queued': sum(len(q) for q in self.queues.values()),
+                'running': sum(info['running'] for info in self.sessions.values()),
+                'sessions': sessions
+            }
+
+# Global page scheduler (threads engine); MAX_WORKERS is now a per-process cap, not per upload
+page_scheduler = PageScheduler(max_workers=MAX_WORKERS)
+
+
+def get_embedded_page_image(pdf_document, page):
+    """(mime_type, bytes) when a page is nothing but one full-page JPEG/PNG scan, else None"""
+    try:
+        if page.rotation or page.first_annot:
+            return None
+        images = page.get_images(full=True)
+        if len(images) != 1:
+            return None
+        xref, smask = images[0][0], images[0][1]
+        if smask:
+            return None
+
+        rects = page.get_image_rects(xref)
+        if len(rects) != 1 or rects[0].get_area() < 0.9 * page.rect.get_area():
+            return None
+        # Anything drawn over the scan (stamps, visible text) only shows up when rendering;
+        # invisible OCR text (render mode 3) is fine
+        if page.get_drawings() or any(span.get('type') != 3 for span in page.get_texttrace()):
+            return None
+
+        extracted = pdf_document.extract_image(xref)
+        mime_type = sniff_image_mime(extracted.get('image', b''))
+        # CMYK JPEGs aren't reliably understood by the model or browsers
+        if mime_type not in ('image/jpeg', 'image/png') or extracted.get('colorspace') == 4:
+            return None
+        return mime_type, extracted['image']
+    except Exception as e:
+        logger.warning(f"Could not inspect embedded page image: {str(e)}")
+        return None
+
+
+def get_page_text_layer(page):
+    """Layout-ordered text of a born-digital page, or None when it should go to the model as an image"""
+    try:
+        # Annotations may carry handwriting or stamps that only exist visually
+        if page.first_annot:
+            return None
+        page_area = page.rect.get_area()
+        image_area = sum(
+            rect.get_area()
+            for img in page.get_images(full=True)
+            for rect in page.get_image_rects(img[0])
+        )
+        # Mostly-picture pages are scans (possibly with an OCR layer) or have content we can't read as text
+        if page_area and image_area > 0.5 * page_area:
+            return None
+
+        lines = []
+        for x0, y0, _, _, block_text, _, block_type in page.get_text("blocks", sort=True):
+            block_text = " | ".join(part.strip() for part in block_text.splitlines() if part.strip())
+            if block_type == 0 and block_text:
+                lines.append(f"[{int(x0)},{int(y0)}] {block_text}")
+        text = "\n".join(lines)
+
+        if len(text) < TEXT_MIN_CHARS:
+            return None
+        # Fonts without a usable ToUnicode map extract as replacement characters or control codes
+        unreadable = sum(1 for ch in text if ch == '\ufffd' or (ord(ch) < 32 and ch not in '\n\t'))
+        if unreadable > 0.05 * len(text):
+            return None
+        return text
+    except Exception as e:
+        logger.warning(f"Could not read page text layer: {str(e)}")
+        return None
+
+
+def load_pdf_page(pdf_document, page):
+    """Build the payload for one PDF page: passthrough scan, text layer plus render, or plain render"""
+    embedded = get_embedded_page_image(pdf_document, page)
+    if embedded:
+        # Scanned page: hand the original JPEG/PNG through without rasterizing
+        return PagePayload(data=embedded[1], mime_type=embedded[0])
+
+    text = get_page_text_layer(page) if TEXT_FAST_PATH else None
+    # Still rendered: the UI shows the page next to the extracted values
+    with RENDER_SECONDS.time():
+        pix = render_page_pixmap(page)
+        image = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
+    return PagePayload(image=image, text=text)
+
+
+def iter_pdf_pages(pdf_source, session_id=None, source_file='pdf'):
+    """Lazily render PDF pages one at a time, yielding (page_number, PagePayload)"""
+    if isinstance(pdf_source, (bytes, bytearray)):
+        pdf_document = fitz.open(stream=pdf_source, filetype="pdf")
+    else:
+        pdf_document = fitz.open(pdf_source)
+
+    try:
+        total_pages = len(pdf_document)
+        for page_num in range(total_pages):
+            with page_trace(session_id, source_file, page_num + 1), trace_span('render'):
+                payload = load_pdf_page(pdf_document, pdf_document[page_num])
+
+            if session_id:
+                with processing_status.edit(session_id) as status:
+                    if status is not None:
+                        # Rendering overlaps with extraction here, so never move the bar backwards
+                        conversion_progress = 20 + int(((page_num + 1) / total_pages) * 10)
+                        status['percentage'] = max(status['percentage'], conversion_progress)
+                        status['rendered'] = status.get('rendered', 0) + 1
+                        if not status['processed']:
+                            status['message'] = f"Converting PDF page {page_num + 1} of {total_pages}..."
+
+            yield page_num + 1, payload
+    finally:
+        pdf_document.close()
+
+
+def process_pages_streaming(pages, filename, schema, session_id=None, max_workers=None, queue_depth=None, priority=0):
+    """Submit lazily rendered pages to the shared page scheduler and collect the results.
+
+    The renderer blocks once queue_depth + max_workers pages of this file are
+    outstanding, so peak memory is bounded by that rather than the page count.
+    """
+    if max_workers is None:
+        max_workers = MAX_WORKERS
+    if queue_depth is None:
+        queue_depth = PAGE_QUEUE_DEPTH
+
+    # With batching each outstanding task holds up to GEMINI_BATCH_SIZE pages
+    outstanding = threading.BoundedSemaphore(max(1, queue_depth + max_workers))
+    futures = []
+
+    def submit(task, *args):
+        outstanding.acquire()
+        future = page_scheduler.submit(session_id, task, *args, priority=priority)
+        future.add_done_callback(lambda _: outstanding.release())
+        futures.append(future)
+
+    batch = []
+    try:
+        for page_num, image in pages:
+            if GEMINI_BATCH_SIZE > 1:
+                batch.append((page_num, image))
+                if len(batch) >= GEMINI_BATCH_SIZE:
+                    submit(process_invoice_batch, batch, filename, schema, session_id)
+                    batch = []
+            else:
+                submit(process_single_invoice, image, filename, page_num, schema, session_id)
+    except Exception as e:
+        # Keep whatever pages already made it through rather than discarding the file
+        logger.error(f"Error rendering {filename}: {str(e)}")
+    finally:
+        if batch:
+            submit(process_invoice_batch, batch, filename, schema, session_id)
+
+    results = []
+    for future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Page extraction failed for {filename}: {str(e)}")
+            continue
+        if isinstance(result, list):
+            results.extend(result)
+        elif result:
+            results.append(result)
+
+    results.sort(key=lambda r: r.get('Page_Number', 0))
+    return results
+
+
+IMAGE_MIME_TYPES = {'png': 'image/png', 'jpeg': 'image/jpeg', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+
+
+def is_monochrome(image, tolerance=24):
+    """True when a page has no meaningful colour (checked on a small thumbnail)"""
+    if image.mode in ('1', 'L', 'LA'):
+        return True
+    thumb = image.convert('RGB').resize((64, 64))
+    r, g, b = thumb.split()
+    spread = max(
+        ImageChops.difference(r, g).getextrema()[1],
+        ImageChops.difference(g, b).getextrema()[1]
+    )
+    return spread <= tolerance
+
+
+def trim_whitespace(image, threshold=245, padding=10):
+    """Crop near-white margins, leaving a small border around the content"""
+    mask = image.convert('L').point(lambda p: 255 if p < threshold else 0)
+    bbox = mask.getbbox()
+    if not bbox:
+        return image
+    left, top, right, bottom = bbox
+    return image.crop((
+        max(0, left - padding),
+        max(0, top - padding),
+        min(image.width, right + padding),
+        min(image.height, bottom + padding)
+    ))
+
+
+def normalize_page_image(image, max_edge=None, grayscale=None, trim=None):
+    """Shrink a page for the model: trim margins, cap the longest edge, drop colour if there is none"""
+    max_edge = IMAGE_MAX_EDGE if max_edge is None else max_edge
+    grayscale = IMAGE_GRAYSCALE if grayscale is None else grayscale
+    trim = IMAGE_TRIM_WHITESPACE if trim is None else trim
+
+    if trim:
+        image = trim_whitespace(image)
+    if max_edge and max(image.width, image.height) > max_edge:
+        image = image.copy()
+        image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if grayscale and image.mode != 'L' and is_monochrome(image):
+        image = image.convert('L')
+    return image
+
+
+def encode_image(image, image_format=None, quality=None):
+    """Encode a page as png/jpeg/webp and return (mime_type, raw bytes)"""
+    image_format = (image_format or IMAGE_FORMAT).lower()
+    quality = IMAGE_QUALITY if quality is None else quality
+
+    img_byte_arr = io.BytesIO()
+    if image_format in ('jpeg', 'jpg'):
+        if image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(img_byte_arr, format='JPEG', quality=quality, optimize=True)
+    elif image_format == 'webp':
+        image.save(img_byte_arr, format='WEBP', quality=quality)
+    else:
+        image_format = 'png'
+        image.save(img_byte_arr, format='PNG')
+    return IMAGE_MIME_TYPES[image_format], img_byte_arr.getvalue()
+
+
+def sniff_image_mime(data):
+    """Mime type of encoded image bytes we can pass through untouched, else None"""
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'image/png'
+    if data[:3] == b'\xff\xd8\xff':
+        return 'image/jpeg'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+class PagePayload:
+    """One page on its way through the pipeline, encoded at most once.
+
+    Holds either a rendered PIL image or the original encoded bytes of an
+    uploaded photo / embedded scan. The content hash, the model image part and
+    the stored copy are computed lazily and reused across the cache lookup,
+    every API retry and the image store.
+    """
+
+    def __init__(self, image=None, data=None, mime_type=None, text=None):
+        self._image = image
+        self.data = data
+        self.mime_type = mime_type
+        # PDF text layer; when set the model gets this instead of the image
+        self.text = text
+        self._size = None
+        self._hash = None
+        self._model_encoding = None
+        self._model_part = None
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        mime_type = sniff_image_mime(data)
+        if mime_type:
+            return cls(data=data, mime_type=mime_type)
+        return cls(image=Image.open(io.BytesIO(data)))
+
+    @property
+    def image(self):
+        """Decoded page, only materialized when something actually needs pixels"""
+        if self._image is None:
+            image = Image.open(io.BytesIO(self.data))
+            image.load()
+            self._image = image
+        return self._image
+
+    @property
+    def size(self):
+        if self._size is None:
+            if self._image is not None:
+                self._size = self._image.size
+            else:
+                # Reads the header only, no decode
+                self._size = Image.open(io.BytesIO(self.data)).size
+        return self._size
+
+    @property
+    def width(self):
+        return self.size[0]
+
+    @property
+    def height(self):
+        return self.size[1]
+
+    def content_hash(self):
+        if self._hash is None:
+            if self.data is not None:
+                self._hash = hashlib.sha256(self.data).hexdigest()
+            else:
+                self._hash = hash_page_image(self._image)
+        return self._hash
+
+    @property
+    def extraction_path(self):
+        return 'text' if self.text else 'image'
+
+    def needs_normalization(self):
+        if IMAGE_GRAYSCALE or IMAGE_TRIM_WHITESPACE:
+            return True
+        return bool(IMAGE_MAX_EDGE) and max(self.size) > IMAGE_MAX_EDGE
+
+    def model_encoding(self):
+        """(mime_type, bytes) sent to the model"""
+        if self._model_encoding is None:
+            if self.data is not None and not self.needs_normalization():
+                self._model_encoding = (self.mime_type, self.data)
+            else:
+                with ENCODE_SECONDS.time(), trace_span('encode'):
+                    self._model_encoding = encode_image(normalize_page_image(self.image))
+        return self._model_encoding
+
+    def model_part(self):
+        if self._model_part is None and self.text:
+            self._model_part = (
+                "This page is given as its PDF text layer instead of an image: one text block per line, "
+                "prefixed with its [x,y] position in points from the top-left corner. Treat it as the page "
+                "itself; confidence is how unambiguous each value is in this text.\n\n" + self.text
+            )
+            PAYLOAD_BYTES.observe(len(self._model_part))
+        elif self._model_part is None:
+            mime_type, data = self.model_encoding()
+            self._model_part = {
+                "mime_type": mime_type,
+                "data": base64.b64encode(data).decode('utf-8')
+            }
+            PAYLOAD_BYTES.observe(len(data))
+        return self._model_part
+
+    def stored_image(self):
+        """(mime_type, bytes) written to the image store for the UI"""
+        if self.data is not None:
+            return self.mime_type, self.data
+        if not self.needs_normalization():
+            # The model copy is the whole page, so one encoding serves both
+            return self.model_encoding()
+        return encode_image(self.image, 'png')
+
+
+def as_page_payload(page):
+    """Accept either a PagePayload or a bare PIL image"""
+    if isinstance(page, PagePayload):
+        return page
+    return PagePayload(image=page)
+
+
+def prepare_image_part(image):
+    """Gemini content part for a page: its text layer, or the normalized image (encoded once per PagePayload)"""
+    return as_page_payload(image).model_part()
+
+
+def get_normalization_signature():
+    """Settings that change what the model sees, folded into extraction cache keys"""
+    return f"{IMAGE_FORMAT}:{IMAGE_QUALITY}:{IMAGE_MAX_EDGE}:{IMAGE_GRAYSCALE}:{IMAGE_TRIM_WHITESPACE}"
+
+
+def image_to_base64(image):
+    """Convert PIL Image to base64 string"""
+    img_byte_arr = io.BytesIO()
+    image.save(img_byte_arr, format='PNG')
+    img_byte_arr.seek(0)
+    return base64.b64encode(img_byte_arr.read()).decode('utf-8')
+
+
+def hash_page_image(image):
+    """Content hash of a rendered page (raw pixels, no encoding needed)"""
+    digest = hashlib.sha256(f"{image.mode}:{image.width}x{image.height}:".encode('utf-8'))
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class ParseStats:
+    """Counters for how model responses were turned into JSON"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clean = 0
+        self.repaired = 0
+        self.failures = 0
+        self.repairs_by_kind = {}
+
+    def record(self, repairs=None, failed=False):
+        with self.lock:
+            if failed:
+                self.failures += 1
+            elif repairs:
+                self.repaired += 1
+                for kind in repairs:
+                    self.repairs_by_kind[kind] = self.repairs_by_kind.get(kind, 0) + 1
+            else:
+                self.clean += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.clean + self.repaired + self.failures
+            return {
+                'structured_output': STRUCTURED_OUTPUT,
+                'responses': total,
+                'clean': self.clean,
+                'repaired': self.repaired,
+                'failures': self.failures,
+                'failure_rate': round(self.failures / total, 4) if total else 0,
+                'repairs_by_kind': dict(self.repairs_by_kind)
+            }
+
+# Global parse counters
+parse_stats = ParseStats()
+
+_TRAILING_COMMA = re.compile(r',(\s*[}\]])')
+_CLOSERS = {'{': '}', '[': ']'}
+# Where an object of fields or an array of objects begins, so "Note [1]:" in chatter isn't mistaken for one
+_JSON_STARTS = {'{': re.compile(r'\{\s*["}]'), '[': re.compile(r'\[\s*[{\]]')}
+
+def find_json_start(text, openers):
+    """Index of the first object (or array of objects, for the openers given) in text, or -1"""
+    starts = [match.start() for match in (_JSON_STARTS[opener].search(text) for opener in openers) if match]
+    return min(starts, default=-1)
+
+def repair_json_text(text, openers):
+    """Single pass over text from where its JSON starts: returns (json_text, repairs) or (None, repairs).
+
+    Skips fences and chatter around the value, stops at the matching close
+    bracket, and if the output was cut off, truncates to the last complete
+    member and closes the open brackets.
+    """
+    repairs = []
+    start = find_json_start(text, openers)
+    if start < 0:
+        return None, repairs
+    if text[:start].strip():
+        repairs.append('leading_text')
+
+    stack = []
+    in_string = False
+    escaped = False
+    # (index, open brackets) where cutting the text leaves only complete members
+    safe_point = None
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_string:
+            if escaped:
+                escaped = False
+            elif ch == '\\':
+                escaped = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in _CLOSERS:
+            stack.append(ch)
+        elif ch in '}]':
+            if not stack or _CLOSERS[stack[-1]] != ch:
+                return None, repairs
+            stack.pop()
+            if not stack:
+                if text[i + 1:].strip():
+                    repairs.append('trailing_text')
+                return text[start:i + 1], repairs
+            safe_point = (i + 1, list(stack))
+        elif ch == ',':
+            safe_point = (i, list(stack))
+
+    # Ran out of text with brackets still open: the response was truncated
+    repairs.append('truncated')
+    if safe_point is None:
+        return None, repairs
+    cut, open_brackets = safe_point
+    closing = ''.join(_CLOSERS[b] for b in reversed(open_brackets))
+    return text[start:cut] + closing, repairs
+
+
+def parse_json_response(response_text, openers='{', repairs=None, allow_truncated=False):
+    """Parse a model response, repairing fences, chatter, trailing commas and truncation in one pass.
+
+    Repairs made are appended to `repairs`. A truncated response is an
+    INVALID_JSON failure unless allow_truncated is set.
+    """
+    try:
+        data = json.loads(response_text)
+        parse_stats.record()
+        return data
+    except json.JSONDecodeError:
+        pass
+
+    candidate, found = repair_json_text(response_text, openers)
+    if 'truncated' in found and not allow_truncated:
+        parse_stats.record(failed=True)
+        raise Exception("INVALID_JSON: response was truncated")
+    if candidate is not None:
+        try:
+            data = json.loads(candidate)
+        except json.JSONDecodeError:
+            data = None
+            fixed = _TRAILING_COMMA.sub(r'\1', candidate)
+            if fixed != candidate:
+                found.append('trailing_comma')
+                try:
+                    data = json.loads(fixed)
+                except json.JSONDecodeError:
+                    pass
+        if data is not None:
+            parse_stats.record(found)
+            logger.info(f"Repaired model JSON ({', '.join(found)})")
+            if repairs is not None:
+                repairs.extend(found)
+            return data
+
+    parse_stats.record(failed=True)
+    raise Exception("INVALID_JSON")
+
+
+def parse_extraction_response(response_text, schema, repairs=None, allow_truncated=False):
+    """Parse a Gemini response into field values plus enforced confidence scores"""
+    with PARSE_SECONDS.time(), trace_span('parse'):
+        extracted_data = parse_json_response(response_text, '{', repairs, allow_truncated)
+        if not isinstance(extracted_data, dict):
+            raise Exception("INVALID_JSON")
+        return apply_confidence_rules(extracted_data, schema)
+
+
+def parse_batch_response(response_text, schema, page_count, repairs=None):
+    """Split a batched response into {page_index: filtered_data} for the pages it covers completely"""
+    with PARSE_SECONDS.time(), trace_span('parse', pages=page_count):
+        return _parse_batch_response(response_text, schema, page_count, repairs)
+
+
+def _parse_batch_response(response_text, schema, page_count, repairs):
+    # Pages a truncation cut short are dropped below and fall back to single-page calls
+    found = []
+    batch_data = parse_json_response(response_text, '[{', found, allow_truncated=True)
+    if repairs is not None:
+        repairs.extend(found)
+
+    # Tolerate {"pages": [...]} and {"1": {...}, "2": {...}} as well as the requested array
+    if isinstance(batch_data, dict):
+        batch_data = batch_data.get('pages', [
+            {'page_index': key, 'fields': value} for key, value in batch_data.items()
+        ])
+    if not isinstance(batch_data, list):
+        raise Exception("INVALID_JSON")
+    if 'truncated' in found:
+        # The repair closed the page that was being written, even mid-field
+        batch_data = batch_data[:-1]
+
+    field_names = [f.name for f in schema]
+    pages = {}
+    for position, item in enumerate(batch_data, start=1):
+        if not isinstance(item, dict):
+            continue
+        fields = item.get('fields', item)
+        try:
+            page_index = int(item.get('page_index', position))
+        except (TypeError, ValueError):
+            continue
+        # Pages that left fields out fall back too rather than losing values
+        if (1 <= page_index <= page_count and isinstance(fields, dict)
+                and all(name in fields for name in field_names)):
+            pages[page_index] = apply_confidence_rules(fields, schema)
+    return pages
+
+
+def expand_compact_entry(field_data):
+    """Turn a compact [value, confidence, code, evidence?] or {"v","c","q","e"} entry into the full dict"""
+    if isinstance(field_data, dict) and 'value' not in field_data and ('v' in field_data or 'c' in field_data):
+        field_data = [field_data.get('v'), field_data.get('c', 0), field_data.get('q'), field_data.get('e')]
+    if not isinstance(field_data, list) or not field_data or len(field_data) > 4:
+        return field_data
+
+    value, confidence, code, evidence = (list(field_data) + [None, None, None])[:4]
+    try:
+        confidence = int(confidence or 0)
+    except (TypeError, ValueError):
+        confidence = 0
+    clarity = CLARITY_CODES.get(str(code).strip().upper()[:1], str(code)) if code else "Readable"
+    return {
+        'value': value,
+        'confidence': confidence,
+        'visual_clarity': clarity,
+        # None marks evidence the compact format leaves out on purpose for confident values
+        'visual_evidence': evidence
+    }
+
+
+def apply_confidence_rules(extracted_data, schema):
+    """Map parsed model output onto the schema and enforce the confidence heuristics"""
+    # Process the new confidence format: {"field": {"value": x, "confidence": y}}
+    filtered_data = {}
+    confidence_scores = {}
+    
+    for field in schema:
+        field_data = extracted_data.get(field.name)
+        if RESPONSE_FORMAT == 'compact':
+            field_data = expand_compact_entry(field_data)
+        
+        if field_data is None:
+            # Field not present
+            filtered_data[field.name] = None
+            confidence_scores[field.name] = 0
+        elif isinstance(field_data, dict) and 'value' in field_data:
+            # New format with confidence, visual clarity, and evidence
+            val = field_data.get('value')
+            conf = field_data.get('confidence', 0)
+            clarity = str(field_data.get('visual_clarity', 'Crisp')).lower()
+            # Compact responses only explain values below the threshold, so no evidence is fine above it
+            omitted_evidence = (RESPONSE_FORMAT == 'compact' and field_data.get('visual_evidence') is None
+                                and conf >= COMPACT_EVIDENCE_THRESHOLD)
+            evidence = str(field_data.get('visual_evidence') or '').lower()
+            
+            # PHASE 5 STRICT ENFORCEMENT
+            # 1. Check clarity cap
+            if "blurry" in clarity or "pixelated" in clarity:
+                if "very" in clarity:
+                    conf = min(conf, 30) # Strict cap for very blurry
+                else:
+                    conf = min(conf, 50) # Strict cap for slightly blurry
+            
+            # 2. Check evidence quality
+            generic_evidence = ["looks", "okay", "good", "readable", "crisp", "clear", "visible", "readable text"]
+            evidence_words = evidence.lower().split()
+            is_generic = all(word in generic_evidence for word in evidence_words) or len(evidence) < 15
+            
+            if conf > 50 and is_generic and not omitted_evidence:
+                logger.warning(f"Downgrading confidence for {field.name} due to generic evidence: '{evidence}'")
+                conf = min(conf, 45) # Penalize lack of specific detail
+            
+            # 3. ID Field Length Check (Heuristic)
+            # GST and STRN are usually 13-15 digits. If shorter, it's likely incomplete.
+            id_keywords = ['gst', 'strn', 'registration', 'ntn']
+            if any(keyword in field.name.lower() for keyword in id_keywords) and val:
+                digits_only = re.sub(r'\D', '', str(val))
+                if digits_only and len(digits_only) < 7: # NTN can be 7-8 digits, GST 13+
+                     logger.warning(f"Downgrading confidence for ID field {field.name} due to short length: {val}")
+                     conf = min(conf, 50)
+
+            if val is None or val == "":
+                conf = 0
+            
+            filtered_data[field.name] = val
+            confidence_scores[field.name] = conf
+        else:
+            # Fallback
+            filtered_data[field.name] = field_data
+            confidence_scores[field.name] = 75 
+    
+    # Calculate overall confidence score (average of all fields with values)
+    valid_scores = [score for fname, score in confidence_scores.items() 
+                  if filtered_data.get(fname) is not None]
+    overall_confidence = round(sum(valid_scores) / len(valid_scores)) if valid_scores else 0
+    
+    # Store confidence data in the result
+    filtered_data['_confidence_scores'] = confidence_scores
+    filtered_data['_overall_confidence'] = overall_confidence
+    
+    logger.debug(f"Extraction complete with overall confidence: {overall_confidence}%")
+    return filtered_data
+
+
+def get_retry_cause(error_str):
+    """Bucket a failed attempt's error for the retry counter"""
+    if any(keyword in error_str for keyword in ['quota', 'rate limit', 'resource exhausted', '429']):
+        return '429'
+    if 'empty_response' in error_str:
+        return 'empty'
+    if 'invalid_json' in error_str:
+        return 'invalid_json'
+    return 'other'
+
+
+def get_retry_delay(error_str, attempt, max_retries):
+    """Seconds to back off before the next attempt, or None to give up"""
+    if attempt >= max_retries - 1:
+        return None
+    GEMINI_RETRIES.inc(get_retry_cause(error_str))
+
+    # Check for quota/rate limit errors
+    if any(keyword in error_str for keyword in ['quota', 'rate limit', 'resource exhausted', '429']):
+        # Exponential backoff: 2s, 4s, 8s, 16s, 32s...
+        base_delay = 2 * (2 ** attempt)
+        # Add jitter: +/- 500ms
+        jitter = random.uniform(0, 1)
+        sleep_time = base_delay + jitter
+        
+        logger.warning(f"Rate limit hit. Sleeping for {sleep_time:.2f}s before retry.")
+        return sleep_time
+
+    # The parser already repaired what it could; a fresh attempt needs no backoff
+    if 'invalid_json' in error_str:
+        return 0
+
+    # Retry with milder backoff for other errors
+    return 2 * (attempt + 1)
+
+
+def get_extraction_cache_key(image, schema):
+    if not EXTRACTION_CACHE_ENABLED:
+        return None
+    payload = as_page_payload(image)
+    if payload.text:
+        page_hash = f"{payload.content_hash()}:text"
+    else:
+        page_hash = f"{payload.content_hash()}:{get_normalization_signature()}"
+    return extraction_cache.make_key(page_hash, get_schema_version(schema),
+                                     get_extraction_backend().cache_namespace)
+
+
+def lookup_cached_extraction(image, schema):
+    """Return (cache_key, cached_data) for a page; both None when the cache is disabled"""
+    cache_key = get_extraction_cache_key(image, schema)
+    if cache_key is None:
+        return None, None
+    cached = extraction_cache.get(cache_key)
+    if cached is not None:
+        logger.debug("Extraction cache hit, skipping Gemini call")
+        cached['_cache_hit'] = True
+    return cache_key, cached
+
+
+def wait_for_rate_limit(estimated_tokens, attempt):
+    """Block for rate limiter budget, tracing the wait when there was one"""
+    started = time.time()
+    waited = rate_limiter.wait_if_needed(estimated_tokens)
+    if waited > 0:
+        record_span('rate_limit_wait', started, waited, attempt=attempt + 1)
+
+
+def extract_invoice_data_with_gemini(image, schema, max_retries=5, check_cache=True):
+    """Use Gemini Vision to extract invoice data with confidence scores and retry logic"""
+
+    schema = compile_schema(schema)
+    if check_cache:
+        cache_key, cached = lookup_cached_extraction(image, schema)
+        if cached is not None:
+            return cached
+    else:
+        cache_key = get_extraction_cache_key(image, schema)
+
+    last_error = None
+    prompt = schema.prompt
+    estimated_tokens = estimate_request_tokens(prompt, image, len(schema))
+
+    # Normalize and encode the page once; every retry reuses the same part
+    image_part = prepare_image_part(image)
+
+    for attempt in range(max_retries):
+        try:
+            # Apply rate limiting
+            wait_for_rate_limit(estimated_tokens, attempt)
+
+            backend = get_extraction_backend()
+
+            # Send request to Gemini (or the configured backend)
+            with track_backend_call(), trace_span('api_attempt', attempt=attempt + 1):
+                response = backend.generate([prompt, image_part], schema, schema.generation_config)
+
+            usage = getattr(response, 'usage_metadata', None)
+            if usage is not None:
+                rate_limiter.record_usage(estimated_tokens, getattr(usage, 'total_token_count', None))
 
-# Rate Limiter Class
-class RateLimiter:
-    """Simple rate limiter to prevent hitting API quota"""
+            if not response or not response.text:
+                raise Exception("EMPTY_RESPONSE")
 
-    def __init__(self, max_calls_per_minute=15):
-        self.max_calls = max_calls_per_minute
-        self.calls = deque()
-        self.lock = threading.Lock()
+            # Retry a truncated response; only the last attempt keeps what survived of it
+            repairs = []
+            filtered_data = parse_extraction_response(response.text, schema, repairs,
+                                                      allow_truncated=attempt == max_retries - 1)
+            # Lets text-layer and image pages be compared on real prompt size
+            filtered_data['_input_tokens'] = getattr(usage, 'prompt_token_count', None)
 
-    def wait_if_needed(self):
-        """Wait if we've hit the rate limit"""
-        with self.lock:
-            now = time.time()
+            # Repaired output may have lost values, so it is never reused for later uploads
+            if cache_key and not repairs:
+                extraction_cache.put(cache_key, filtered_data)
 
-            # Remove calls older than 1 minute
-            while self.calls and now - self.calls[0] > 60:
-                self.calls.popleft()
+            return filtered_data
 
-            # If we've hit the limit, wait
-            if len(self.calls) >= self.max_calls:
-                sleep_time = 60 - (now - self.calls[0]) + 1
-                if sleep_time > 0:
-                    time.sleep(sleep_time)
-                    # Clear old calls after waiting
-                    while self.calls and time.time() - self.calls[0] > 60:
-                        self.calls.popleft()
+        except Exception as e:
+            last_error = str(e)
+            logger.error(f"API call failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
 
-            # Record this call
-            self.calls.append(time.time())
+            delay = get_retry_delay(str(e).lower(), attempt, max_retries)
+            if delay is None:
+                return None
+            with trace_span('retry_backoff', attempt=attempt + 1, cause=get_retry_cause(str(e).lower())):
+                time.sleep(delay)
 
-# Global rate limiter
-# Gemini 2.5 Flash paid tier: 1000 RPM, 10K RPD, 1M TPM
-# Setting to 500 RPM with buffer for safety
-rate_limiter = RateLimiter(max_calls_per_minute=500)
+    return None
 
-# Global storage for processed invoices with disk persistence
-processed_invoices = {}
-processed_invoices_lock = threading.Lock()
 
-# Global storage for background processing status
-processing_status = {}
-processing_status_lock = threading.Lock()
+def extract_invoice_batch_with_gemini(images, schema, max_retries=5):
+    """Extract several pages with one Gemini request; returns one result (or None) per image.
 
-def get_gemini_prompt(fields):
-    """Generate a clean Gemini prompt with confidence scoring"""
-    field_list = "\n".join([f"- {f.name}: {f.description or 'Extract this value'}" for f in fields])
+    Pages already in the extraction cache are skipped. Any page the batched
+    response doesn't cover (or a response that won't parse) falls back to a
+    single-page call, so batching never loses a page.
+    """
+    schema = compile_schema(schema)
+    results = [None] * len(images)
+    cache_keys = [None] * len(images)
+    pending = []
+    for i, image in enumerate(images):
+        cache_keys[i], cached = lookup_cached_extraction(image, schema)
+        if cached is not None:
+            results[i] = cached
+        else:
+            pending.append(i)
 
-    example_field = fields[0].name if fields else "Field_Name"
-    example_json = {example_field: {"value": "extracted_value", "confidence": 95, "visual_clarity": "Crisp", "visual_evidence": "Clear text visible"}}
+    if len(pending) == 1:
+        i = pending[0]
+        results[i] = extract_invoice_data_with_gemini(images[i], schema, max_retries, check_cache=False)
+        return results
+    if not pending:
+        return results
 
-    return f"""You are an invoice data extractor.
+    prompt = schema.batch_prompt(len(pending))
+    # The prompt is paid for once per batch instead of once per page
+    estimated_tokens = len(prompt) // 4 + sum(
+        estimate_request_tokens('', images[i], len(schema)) for i in pending
+    )
 
-Extract values EXACTLY as they appear in the image.
-Do not standardize, normalize, convert, or correct any data.
+    parts = [prompt]
+    for page_index, i in enumerate(pending, start=1):
+        parts.append(f"Page {page_index}:")
+        parts.append(prepare_image_part(images[i]))
 
-Fields to extract:
-{field_list}
+    response_text = None
+    for attempt in range(max_retries):
+        try:
+            wait_for_rate_limit(estimated_tokens, attempt)
 
-For EVERY field, return:
-- value (as seen)
-- confidence (0-100)
-- visual_clarity
-- visual_evidence
+            backend = get_extraction_backend()
+            with track_backend_call(), trace_span('api_attempt', attempt=attempt + 1, pages=len(pending)):
+                response = backend.generate(parts, schema, schema.batch_generation_config, page_count=len(pending))
 
-CONFIDENCE = how clearly the value is visible:
-- 90-100: Very clear
-- 70-89: Readable
-- 40-69: Partially unclear
-- 1-39: Very unclear
-- 0: Not visible
+            usage = getattr(response, 'usage_metadata', None)
+            if usage is not None:
+                rate_limiter.record_usage(estimated_tokens, getattr(usage, 'total_token_count', None))
 
-VISUAL_CLARITY (use only):
-"Crisp", "Readable", "Slightly Blurry", "Very Blurry/Pixelated", "Missing"
+            if not response or not response.text:
+                raise Exception("EMPTY_RESPONSE")
 
-RULES:
-1. Extract only what is visually present. Do NOT guess.
-2. Handwritten values override printed values only if clearly numeric and labeled.
-3. Keep text, spelling, symbols, and formatting exactly as seen.
-4. If a field is not visible: value = null, confidence = 0, visual_clarity = "Missing", visual_evidence = "Not visible"
-5. HANDWRITTEN ADJUSTMENTS: If you see handwritten deductions like "less 20%", "return", "short", or "-500":
-   - Convert percentages to actual amounts (e.g., "less 20%" on 10000 = 2000)
-   - SUM all adjustments of same type into one field (e.g., multiple discounts → total Discount)
-   - Use the FINAL calculated total if handwritten, not the printed subtotals
+            response_text = response.text
+            break
 
-Example:
-{json.dumps(example_json, indent=2)}
+        except Exception as e:
+            logger.error(f"Batch API call failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
+            delay = get_retry_delay(str(e).lower(), attempt, max_retries)
+            if delay is None:
+                break
+            with trace_span('retry_backoff', attempt=attempt + 1, cause=get_retry_cause(str(e).lower())):
+                time.sleep(delay)
 
-Return ONLY valid JSON, no explanations."""
+    page_data = {}
+    repairs = []
+    if response_text:
+        try:
+            page_data = parse_batch_response(response_text, schema, len(pending), repairs)
+        except Exception as e:
+            logger.warning(f"Batch response could not be parsed ({str(e)}), falling back to single-page calls")
 
-def save_session_to_disk(session_id, data):
-    """Save session data to disk for persistence"""
-    try:
-        session_dir = Path(app.config['SESSION_FOLDER'])
-        session_dir.mkdir(exist_ok=True)
-        session_file = session_dir / f"{session_id}.pkl"
-        with open(session_file, 'wb') as f:
-            pickle.dump(data, f)
-        logger.info(f"Session {session_id} saved to disk")
-    except Exception as e:
-        logger.error(f"Failed to save session {session_id}: {str(e)}")
+    for page_index, i in enumerate(pending, start=1):
+        data = page_data.get(page_index)
+        if data is not None:
+            results[i] = data
+            if cache_keys[i] and not repairs:
+                extraction_cache.put(cache_keys[i], data)
+        else:
+            results[i] = extract_invoice_data_with_gemini(images[i], schema, max_retries, check_cache=False)
 
-def load_session_from_disk(session_id):
-    """Load session data from disk"""
-    try:
-        session_file = Path(app.config['SESSION_FOLDER']) / f"{session_id}.pkl"
-        if session_file.exists():
-            with open(session_file, 'rb') as f:
-                data = pickle.load(f)
-            logger.info(f"Session {session_id} loaded from disk")
-            return data
-        return None
-    except Exception as e:
-        logger.error(f"Failed to load session {session_id}: {str(e)}")
-        return None
+    logger.info(f"Batch extraction: {len(page_data)}/{len(pending)} pages from one request")
+    return results
 
-def get_session_data(session_id):
-    """Get session data from memory or disk"""
-    with processed_invoices_lock:
-        # Try memory first
-        if session_id in processed_invoices:
-            logger.info(f"Session {session_id} found in memory")
-            return processed_invoices[session_id]
-        
-        # Try disk
-        data = load_session_from_disk(session_id)
-        if data:
-            # Cache in memory
-            processed_invoices[session_id] = data
-            return data
+
+def finish_invoice(extracted_data, image, source_file, page_num, session_id=None):
+    """Attach source details and the stored page image to an extraction and report progress"""
+    if extracted_data:
+        extracted_data['Source_File'] = source_file
+        extracted_data['Page_Number'] = page_num
+        with trace_span('store_image'):
+            extracted_data['_image_id'] = store_page_image(image)
+        extracted_data['_extraction_path'] = as_page_payload(image).extraction_path
+        PAGES_PROCESSED.inc('cached' if extracted_data.get('_cache_hit') else 'success')
+        # Per-page detail is debug-only; volumes are in /metrics
+        logger.debug(f"Successfully processed {source_file} - Page {page_num} "
+                     f"({extracted_data['_extraction_path']}, {extracted_data.get('_input_tokens')} input tokens)")
         
-        logger.warning(f"Session {session_id} not found in memory or disk")
+        # Update progress status if session_id is provided
+        if session_id:
+            partial_results.append(session_id, extracted_data)
+            with processing_status.edit(session_id) as status:
+                if status is not None:
+                    status['processed'] += 1
+                    # Update percentage (30-100 range for API processing)
+                    # 0-20%: upload, 20-30%: PDF conversion, 30-100%: API extraction
+                    total = status['total']
+                    processed = status['processed']
+                    if total > 0:
+                        percentage = 30 + int((processed / total) * 70)
+                        status['percentage'] = min(100, percentage)
+                        status['message'] = f"Extracting invoice {processed} of {total}..."
+            processing_status.add_page_event(session_id, {
+                'file': source_file,
+                'page': page_num,
+                'success': True,
+                'confidence': extracted_data.get('_overall_confidence', 0)
+            })
+
+        return extracted_data
+    else:
+        logger.warning(f"Failed to extract data from {source_file} - Page {page_num}")
+        mark_page_failed(source_file, page_num, session_id)
         return None
 
 
-def pdf_to_images(pdf_bytes, session_id=None):
-    """Convert PDF bytes to list of images using PyMuPDF with progress updates"""
-    try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        images = []
-        total_pages = len(pdf_document)
+def mark_page_failed(source_file, page_num, session_id=None):
+    """Still count a failed page so progress reaches 100%"""
+    PAGES_PROCESSED.inc('failed')
+    if session_id:
+        with processing_status.edit(session_id) as status:
+            if status is not None:
+                status['processed'] += 1
+        processing_status.add_page_event(session_id, {'file': source_file, 'page': page_num, 'success': False})
 
-        for page_num in range(total_pages):
-            page = pdf_document[page_num]
-            pix = page.get_pixmap()  # Native resolution - faster, Gemini handles it fine
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            images.append(img)
 
-            # Update progress during PDF conversion (20-30% range)
-            if session_id:
-                with processing_status_lock:
-                    if session_id in processing_status:
-                        # PDF conversion takes 20-30% of progress
-                        conversion_progress = 20 + int(((page_num + 1) / total_pages) * 10)
-                        processing_status[session_id]['percentage'] = conversion_progress
-                        processing_status[session_id]['message'] = f"Converting PDF page {page_num + 1} of {total_pages}..."
+def process_single_invoice(image, source_file, page_num, schema, session_id=None):
+    """Process a single invoice"""
+    try:
+        with page_trace(session_id, source_file, page_num), trace_span('extract'):
+            extracted_data = extract_invoice_data_with_gemini(image, schema)
+            return finish_invoice(extracted_data, image, source_file, page_num, session_id)
+    except Exception as e:
+        logger.error(f"Error processing {source_file} - Page {page_num}: {str(e)}")
+        mark_page_failed(source_file, page_num, session_id)
+        return None
 
-        pdf_document.close()
-        logger.info(f"Successfully converted PDF to {len(images)} images")
-        return images
+
+def process_invoice_batch(pages, source_file, schema, session_id=None):
+    """Process several (page_num, image) pages of one file with a single batched request"""
+    try:
+        batch_pages = f"{pages[0][0]}-{pages[-1][0]}" if len(pages) > 1 else pages[0][0]
+        with page_trace(session_id, source_file, batch_pages), trace_span('extract_batch', pages=len(pages)):
+            extracted = extract_invoice_batch_with_gemini([image for _, image in pages], schema)
     except Exception as e:
-        logger.error(f"Failed to convert PDF to images: {str(e)}")
-        return []
+        logger.error(f"Error processing batch from {source_file}: {str(e)}")
+        extracted = [None] * len(pages)
 
+    results = []
+    for (page_num, image), extracted_data in zip(pages, extracted):
+        try:
+            with page_trace(session_id, source_file, page_num):
+                result = finish_invoice(extracted_data, image, source_file, page_num, session_id)
+        except Exception as e:
+            logger.error(f"Error processing {source_file} - Page {page_num}: {str(e)}")
+            mark_page_failed(source_file, page_num, session_id)
+            result = None
+        if result:
+            results.append(result)
+    return results
 
-def image_to_base64(image):
-    """Convert PIL Image to base64 string"""
-    img_byte_arr = io.BytesIO()
-    image.save(img_byte_arr, format='PNG')
-    img_byte_arr.seek(0)
-    return base64.b64encode(img_byte_arr.read()).decode('utf-8')
 
+# Asyncio Extraction Engine
+class AsyncExtractionEngine:
+    """Runs extraction coroutines on a single background event loop.
 
-def extract_invoice_data_with_gemini(image, schema, max_retries=5):
-    """Use Gemini Vision to extract invoice data with confidence scores and retry logic"""
+    Each in-flight Gemini call is a coroutine waiting on the network rather than
+    an OS thread, so hundreds of pages can be in flight from one thread.
+    """
 
-    last_error = None
+    def __init__(self, max_concurrency=100):
+        self.max_concurrency = max_concurrency
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.loop = None
+        self.thread = None
+        self.lock = threading.Lock()
 
-    for attempt in range(max_retries):
-        try:
-            # Apply rate limiting
-            rate_limiter.wait_if_needed()
+    def _ensure_started(self):
+        with self.lock:
+            if self.loop is None:
+                self.loop = asyncio.new_event_loop()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='async-extraction', daemon=True)
+                self.thread.start()
 
-            # Convert image to base64
-            img_base64 = image_to_base64(image)
+    def submit(self, coro):
+        """Schedule a coroutine on the engine loop from any thread; returns a concurrent Future"""
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
 
-            # Initialize Gemini model
-            model = genai.GenerativeModel('gemini-2.5-flash') # Using flash for better speed
-            
-            prompt = get_gemini_prompt(schema)
 
-            # Send request to Gemini
-            image_part = {
-                "mime_type": "image/png",
-                "data": img_base64
-            }
+async def extract_invoice_data_async(image, schema, max_retries=5):
+    """Async twin of extract_invoice_data_with_gemini using the async Gemini client"""
 
-            response = model.generate_content(
-                [prompt, image_part],
-                generation_config=genai.types.GenerationConfig(
-                    temperature=0,
-                )
-            )
+    schema = compile_schema(schema)
+    # Hashing pixels and encoding the PNG are CPU work; keep them off the event loop
+    cache_key, cached = await asyncio.to_thread(lookup_cached_extraction, image, schema)
+    if cached is not None:
+        return cached
 
-            if not response or not response.text:
-                raise Exception("EMPTY_RESPONSE")
+    prompt = schema.prompt
+    estimated_tokens = estimate_request_tokens(prompt, image, len(schema))
+    image_part = await asyncio.to_thread(prepare_image_part, image)
 
-            response_text = response.text.strip()
+    async with async_engine.semaphore:
+        for attempt in range(max_retries):
+            try:
+                # Token bucket reservations never block, so waiting is just an async sleep
+                wait = rate_limiter.reserve(estimated_tokens)
+                if wait > 0:
+                    with trace_span('rate_limit_wait', attempt=attempt + 1):
+                        await asyncio.sleep(wait)
 
-            # Clean markdown code blocks
-            if response_text.startswith('```json'):
-                response_text = response_text[7:]
-            elif response_text.startswith('```'):
-                response_text = response_text[3:]
+                backend = get_extraction_backend()
+                with track_backend_call(), trace_span('api_attempt', attempt=attempt + 1):
+                    response = await backend.generate_async([prompt, image_part], schema, schema.generation_config)
 
-            if response_text.endswith('```'):
-                response_text = response_text[:-3]
+                usage = getattr(response, 'usage_metadata', None)
+                if usage is not None:
+                    rate_limiter.record_usage(estimated_tokens, getattr(usage, 'total_token_count', None))
 
-            response_text = response_text.strip()
+                if not response or not response.text:
+                    raise Exception("EMPTY_RESPONSE")
 
-            # Parse JSON
-            try:
-                extracted_data = json.loads(response_text)
-            except json.JSONDecodeError:
-                # Try to find JSON in response
-                json_match = re.search(r'\{.*\}', response_text, re.DOTALL)
-                if json_match:
-                    extracted_data = json.loads(json_match.group())
-                else:
-                    raise Exception("INVALID_JSON")
+                repairs = []
+                filtered_data = parse_extraction_response(response.text, schema, repairs,
+                                                          allow_truncated=attempt == max_retries - 1)
+                filtered_data['_input_tokens'] = getattr(usage, 'prompt_token_count', None)
 
-            # Process the new confidence format: {"field": {"value": x, "confidence": y}}
-            filtered_data = {}
-            confidence_scores = {}
-            
-            for field in schema:
-                field_data = extracted_data.get(field.name)
-                
-                if field_data is None:
-                    # Field not present
-                    filtered_data[field.name] = None
-                    confidence_scores[field.name] = 0
-                elif isinstance(field_data, dict) and 'value' in field_data:
-                    # New format with confidence, visual clarity, and evidence
-                    val = field_data.get('value')
-                    conf = field_data.get('confidence', 0)
-                    clarity = str(field_data.get('visual_clarity', 'Crisp')).lower()
-                    evidence = str(field_data.get('visual_evidence', '')).lower()
-                    
-                    # PHASE 5 STRICT ENFORCEMENT
-                    # 1. Check clarity cap
-                    if "blurry" in clarity or "pixelated" in clarity:
-                        if "very" in clarity:
-                            conf = min(conf, 30) # Strict cap for very blurry
-                        else:
-                            conf = min(conf, 50) # Strict cap for slightly blurry
-                    
-                    # 2. Check evidence quality
-                    generic_evidence = ["looks", "okay", "good", "readable", "crisp", "clear", "visible", "readable text"]
-                    evidence_words = evidence.lower().split()
-                    is_generic = all(word in generic_evidence for word in evidence_words) or len(evidence) < 15
-                    
-                    if conf > 50 and is_generic:
-                        logger.warning(f"Downgrading confidence for {field.name} due to generic evidence: '{evidence}'")
-                        conf = min(conf, 45) # Penalize lack of specific detail
-                    
-                    # 3. ID Field Length Check (Heuristic)
-                    # GST and STRN are usually 13-15 digits. If shorter, it's likely incomplete.
-                    id_keywords = ['gst', 'strn', 'registration', 'ntn']
-                    if any(keyword in field.name.lower() for keyword in id_keywords) and val:
-                        digits_only = re.sub(r'\D', '', str(val))
-                        if digits_only and len(digits_only) < 7: # NTN can be 7-8 digits, GST 13+
-                             logger.warning(f"Downgrading confidence for ID field {field.name} due to short length: {val}")
-                             conf = min(conf, 50)
-
-                    if val is None or val == "":
-                        conf = 0
-                    
-                    filtered_data[field.name] = val
-                    confidence_scores[field.name] = conf
-                else:
-                    # Fallback
-                    filtered_data[field.name] = field_data
-                    confidence_scores[field.name] = 75 
-            
-            # Calculate overall confidence score (average of all fields with values)
-            valid_scores = [score for fname, score in confidence_scores.items() 
-                          if filtered_data.get(fname) is not None]
-            overall_confidence = round(sum(valid_scores) / len(valid_scores)) if valid_scores else 0
-            
-            # Store confidence data in the result
-            filtered_data['_confidence_scores'] = confidence_scores
-            filtered_data['_overall_confidence'] = overall_confidence
-            
-            logger.info(f"Extraction complete with overall confidence: {overall_confidence}%")
-            return filtered_data
+                if cache_key and not repairs:
+                    await asyncio.to_thread(extraction_cache.put, cache_key, filtered_data)
 
-        except Exception as e:
-            error_str = str(e).lower()
-            last_error = str(e)
-            logger.error(f"API call failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
+                return filtered_data
 
-            # Check for quota/rate limit errors
-            if any(keyword in error_str for keyword in ['quota', 'rate limit', 'resource exhausted', '429']):
-                if attempt < max_retries - 1:
-                    # Exponential backoff: 2s, 4s, 8s, 16s, 32s...
-                    base_delay = 2 * (2 ** attempt)
-                    # Add jitter: +/- 500ms
-                    jitter = random.uniform(0, 1)
-                    sleep_time = base_delay + jitter
-                    
-                    logger.warning(f"Rate limit hit. Sleeping for {sleep_time:.2f}s before retry.")
-                    time.sleep(sleep_time)
-                    continue
-                else:
-                    return None
+            except Exception as e:
+                logger.error(f"API call failed (attempt {attempt + 1}/{max_retries}): {str(e)}")
 
-            # Retry with milder backoff for other errors
-            if attempt < max_retries - 1:
-                time.sleep(2 * (attempt + 1))
-                continue
-            else:
-                return None
+                delay = get_retry_delay(str(e).lower(), attempt, max_retries)
+                if delay is None:
+                    return None
+                with trace_span('retry_backoff', attempt=attempt + 1, cause=get_retry_cause(str(e).lower())):
+                    await asyncio.sleep(delay)
 
     return None
 
 
-def process_single_invoice(image, source_file, page_num, schema, session_id=None):
-    """Process a single invoice"""
+async def process_single_invoice_async(image, source_file, page_num, schema, session_id=None):
+    """Process a single invoice on the asyncio engine"""
     try:
-        extracted_data = extract_invoice_data_with_gemini(image, schema)
-
-        if extracted_data:
-            img_base64 = image_to_base64(image)
-            extracted_data['Source_File'] = source_file
-            extracted_data['Page_Number'] = page_num
-            extracted_data['_image_base64'] = img_base64
-            logger.info(f"Successfully processed {source_file} - Page {page_num}")
-            
-            # Update progress status if session_id is provided
-            if session_id:
-                with processing_status_lock:
-                    if session_id in processing_status:
-                        processing_status[session_id]['processed'] += 1
-                        # Update percentage (30-100 range for API processing)
-                        # 0-20%: upload, 20-30%: PDF conversion, 30-100%: API extraction
-                        total = processing_status[session_id]['total']
-                        processed = processing_status[session_id]['processed']
-                        if total > 0:
-                            percentage = 30 + int((processed / total) * 70)
-                            processing_status[session_id]['percentage'] = min(100, percentage)
-                            processing_status[session_id]['message'] = f"Extracting invoice {processed} of {total}..."
-
-            return extracted_data
-        else:
-            logger.warning(f"Failed to extract data from {source_file} - Page {page_num}")
-            if session_id:
-                with processing_status_lock:
-                    if session_id in processing_status:
-                        processing_status[session_id]['processed'] += 1 # Still count it even if it failed
-            return None
+        with page_trace(session_id, source_file, page_num), trace_span('extract'):
+            extracted_data = await extract_invoice_data_async(image, schema)
+            return await asyncio.to_thread(finish_invoice, extracted_data, image, source_file, page_num, session_id)
     except Exception as e:
         logger.error(f"Error processing {source_file} - Page {page_num}: {str(e)}")
-        if session_id:
-            with processing_status_lock:
-                if session_id in processing_status:
-                    processing_status[session_id]['processed'] += 1
+        await asyncio.to_thread(mark_page_failed, source_file, page_num, session_id)
         return None
 
 
-def process_file_parallel(file_path, filename, schema, session_id=None, max_workers=None):
-    """Process file with multi-threading"""
-    if max_workers is None:
-        max_workers = MAX_WORKERS
+def process_pages_async(pages, filename, schema, session_id=None):
+    """Submit pages to the asyncio engine as they are rendered and collect the results.
+
+    Rendering stays in the calling thread and pauses once the engine's
+    concurrency plus PAGE_QUEUE_DEPTH pages are outstanding, bounding memory.
+    """
+    outstanding = threading.BoundedSemaphore(async_engine.max_concurrency + PAGE_QUEUE_DEPTH)
+    futures = []
+
+    try:
+        for page_num, image in pages:
+            outstanding.acquire()
+            future = async_engine.submit(
+                process_single_invoice_async(image, filename, page_num, schema, session_id)
+            )
+            future.add_done_callback(lambda _: outstanding.release())
+            futures.append(future)
+    except Exception as e:
+        # Keep whatever pages already made it through rather than discarding the file
+        logger.error(f"Error rendering {filename}: {str(e)}")
+
     results = []
+    for future in futures:
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.error(f"Async extraction failed for {filename}: {str(e)}")
+            continue
+        if result:
+            results.append(result)
+
+    results.sort(key=lambda r: r.get('Page_Number', 0))
+    return results
 
+# Global asyncio engine (its loop thread only starts when EXTRACTION_ENGINE=asyncio is used)
+async_engine = AsyncExtractionEngine(max_concurrency=ASYNC_MAX_CONCURRENCY)
+
+
+def process_file_parallel(file_path, filename, schema, session_id=None, max_workers=None, priority=0):
+    """Render a file's pages and extract them on the shared page scheduler (or the asyncio engine)"""
     try:
         # Determine file type
         file_extension = filename.lower().split('.')[-1]
 
-        if file_extension == 'pdf':
+        if file_extension == 'pdf' and (STREAMING_PIPELINE or EXTRACTION_ENGINE == 'asyncio'):
+            pages = iter_pdf_pages(file_path, session_id, filename)
+        elif file_extension == 'pdf':
             with open(file_path, 'rb') as f:
                 pdf_bytes = f.read()
-            images = pdf_to_images(pdf_bytes, session_id)
-
-            with ThreadPoolExecutor(max_workers=max_workers) as executor:
-                futures = {
-                    executor.submit(
-                        process_single_invoice,
-                        image,
-                        filename,
-                        page_num,
-                        schema,
-                        session_id
-                    ): page_num
-                    for page_num, image in enumerate(images, start=1)
-                }
-
-                for future in as_completed(futures):
-                    result = future.result()
-                    if result:
-                        results.append(result)
+            pages = enumerate(pdf_to_images(pdf_bytes, session_id, filename), start=1)
         else:
             # Process single image file
             if session_id:
-                with processing_status_lock:
-                    if session_id in processing_status:
-                        processing_status[session_id]['percentage'] = 30
-                        processing_status[session_id]['message'] = f"Extracting {filename}..."
+                with processing_status.edit(session_id) as status:
+                    if status is not None:
+                        status['percentage'] = 30
+                        status['message'] = f"Extracting {filename}..."
+            # Uploaded JPEG/PNG/WebP bytes are sent and stored as-is
+            pages = [(1, PagePayload.from_file(file_path))]
 
-            image = Image.open(file_path)
-            result = process_single_invoice(image, filename, 1, schema, session_id)
-            if result:
-                results.append(result)
+        if EXTRACTION_ENGINE == 'asyncio':
+            results = process_pages_async(pages, filename, schema, session_id)
+        else:
+            results = process_pages_streaming(
+                pages,
+                filename,
+                schema,
+                session_id,
+                max_workers=max_workers,
+                priority=priority
+            )
 
         return results
 
@@ -591,20 +4065,109 @@ def get_usage():
         return jsonify({'error': 'Usage statistics not found'}), 404
     return jsonify(stats.to_dict())
 
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    """Get extraction, session, schema, export and session index cache counters"""
+    return jsonify({
+        'extraction': extraction_cache.stats(),
+        'sessions': processed_invoices.stats(),
+        'schema': schema_cache.stats(),
+        'exports': export_cache.stats(),
+        'session_indexes': session_indexes.stats()
+    })
+
+@app.route('/api/rate-limiter/stats', methods=['GET'])
+def get_rate_limiter_stats():
+    """Get current rate limiter budget and wait statistics"""
+    return jsonify(rate_limiter.stats())
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics for every worker process"""
+    from flask import Response
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/janitor/stats', methods=['GET'])
+def get_janitor_stats():
+    """Get janitor passes and reclaimed bytes by kind"""
+    return jsonify(janitor.stats())
+
+@app.route('/api/parser/stats', methods=['GET'])
+def get_parser_stats():
+    """Get model response parse and repair counters"""
+    return jsonify(parse_stats.stats())
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def get_scheduler_stats():
+    """Get page scheduler queue depth per session"""
+    return jsonify(page_scheduler.stats())
+
 @app.route('/api/progress/<session_id>', methods=['GET'])
 def get_processing_progress(session_id):
     """Get processing progress for a session"""
-    with processing_status_lock:
-        status = processing_status.get(session_id)
-        if not status:
-            return jsonify({'error': 'Session not found'}), 404
-        return jsonify(status)
+    status = processing_status.get(session_id)
+    if not status:
+        return jsonify({'error': 'Session not found'}), 404
+    return jsonify(status)
+
+@app.route('/api/trace/<session_id>', methods=['GET'])
+def get_processing_trace(session_id):
+    """Per-page stage spans of a job in Chrome trace-event format (chrome://tracing, Perfetto)"""
+    events = processing_status.trace_events(session_id)
+    if events is None:
+        return jsonify({'error': 'Trace not found'}), 404
+    return jsonify(build_chrome_trace(session_id, events, processing_status.get(session_id)))
+
+@app.route('/api/progress/<session_id>/stream', methods=['GET'])
+def stream_processing_progress(session_id):
+    """Server-Sent Events stream that pushes progress and per-page events only when they change"""
+    if processing_status.get(session_id) is None:
+        return jsonify({'error': 'Session not found'}), 404
+
+    def generate():
+        # Ask EventSource to reconnect quickly if we close the stream before completion
+        yield "retry: 1000\n\n"
+        started = time.time()
+        last_status = None
+        last_sent = time.time()
+        cursor = 0
+
+        while time.time() - started < SSE_MAX_STREAM_SECONDS:
+            version = processing_status.version(session_id)
+            status = processing_status.get(session_id)
+            if status is None:
+                return
+
+            events, cursor = processing_status.page_events_since(session_id, cursor)
+            for event in events:
+                yield f"event: page\ndata: {json.dumps(event)}\n\n"
+                last_sent = time.time()
+
+            if status != last_status:
+                yield f"event: progress\ndata: {json.dumps(status)}\n\n"
+                last_status = status
+                last_sent = time.time()
+
+            if status.get('completed'):
+                return
+
+            # Comment line keeps proxies from closing an idle connection
+            if time.time() - last_sent >= 15:
+                yield ": keep-alive\n\n"
+                last_sent = time.time()
+
+            processing_status.wait_for_change(session_id, version, timeout=5)
+
+    from flask import Response
+    response = Response(generate(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Disable nginx buffering
+    return response
 
 @app.route('/')
 def index():
     """Render main page"""
-    fields = get_current_fields()
-    schema_names = [f.name for f in fields]
+    schema_names = get_current_schema_names()
     return render_template('index.html', schema=schema_names, max_invoices=MAX_INVOICES_PER_SESSION)
 
 
@@ -618,9 +4181,7 @@ def get_fields():
 def preview_prompt():
     """API endpoint to preview the actual Gemini prompt with current fields"""
     try:
-        fields = get_current_fields()
-        prompt = get_gemini_prompt(fields)
-        return jsonify({'prompt': prompt})
+        return jsonify({'prompt': schema_cache.get().prompt})
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -641,6 +4202,7 @@ def add_field():
     new_field = SchemaField(name=name, description=description)
     db.session.add(new_field)
     db.session.commit()
+    schema_cache.invalidate()
     return jsonify(new_field.to_dict()), 201
 
 
@@ -664,6 +4226,7 @@ def update_field(field_id):
         field.is_active = bool(data['is_active'])
         
     db.session.commit()
+    schema_cache.invalidate()
     return jsonify(field.to_dict())
 
 
@@ -673,15 +4236,14 @@ def delete_field(field_id):
     field = SchemaField.query.get_or_404(field_id)
     db.session.delete(field)
     db.session.commit()
+    schema_cache.invalidate()
     return jsonify({'success': True})
 
 
 @app.route('/api/prompt-preview', methods=['GET'])
 def prompt_preview():
     """API endpoint to preview the AI prompt"""
-    fields = get_current_fields()
-    prompt = get_gemini_prompt(fields)
-    return jsonify({'prompt': prompt.strip()})
+    return jsonify({'prompt': schema_cache.get().prompt.strip()})
 
 
 @app.route('/update_schema', methods=['POST'])
@@ -757,34 +4319,36 @@ def upload_files():
             return jsonify({'error': f'Limit exceeded. Max {MAX_INVOICES_PER_SESSION} allowed.'}), 400
 
         session_id = str(uuid.uuid4())
+
+        # Optional scheduling priority (0-10); higher priority uploads get page workers first
+        try:
+            priority = max(0, min(10, int(request.form.get('priority', 0))))
+        except ValueError:
+            priority = 0
         
         # Initialize processing status
-        with processing_status_lock:
-            processing_status[session_id] = {
-                'percentage': 20,  # Upload complete
-                'processed': 0,
-                'total': total_invoice_count,
-                'message': 'Preparing files...',
-                'completed': False
-            }
+        processing_status.create(session_id, {
+            'percentage': 20,  # Upload complete
+            'processed': 0,
+            'total': total_invoice_count,
+            'message': 'Preparing files...',
+            'completed': False
+        })
+        partial_results.start(session_id)
 
         # Start background processing
-        def run_background_processing(sid, files_to_process):
+        def run_background_processing(sid, files_to_process, priority):
             with app.app_context():
                 try:
                     all_results = []
-                    current_schema_objects = get_current_fields()
-                    
-                    # Convert to simple objects to avoid "Working outside of application context" 
-                    # errors in threads when accessing SQLAlchemy objects
-                    safe_schema_objects = [
-                        SimpleNamespace(name=f.name, description=f.description) 
-                        for f in current_schema_objects
-                    ]
+                    # Compiled snapshot of plain objects: no "Working outside of application
+                    # context" errors in threads, and the prompt is rendered once per schema version
+                    safe_schema_objects = schema_cache.get()
                     
-                    # Use ThreadPoolExecutor for parallel file processing
-                    # We use MAX_WORKERS from environment variables
-                    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    # Files are only rendered here; page extraction runs on the shared
+                    # page scheduler, so a few file threads per upload are enough
+                    file_workers = max(1, min(UPLOAD_FILE_WORKERS, len(files_to_process)))
+                    with ThreadPoolExecutor(max_workers=file_workers) as executor:
                         # Submit all file processing tasks
                         future_to_file = {
                             executor.submit(
@@ -792,7 +4356,8 @@ def upload_files():
                                 filepath, 
                                 original_filename, 
                                 safe_schema_objects, 
-                                sid
+                                sid,
+                                priority=priority
                             ): (filepath, original_filename)
                             for filepath, original_filename in files_to_process
                         }
@@ -807,9 +4372,11 @@ def upload_files():
                                     
                                     # Increment total calls in database
                                     # This runs in the main background thread, so it's safe to use db.session
+                                    # Cached pages never reached Gemini, so they don't count against the trial
+                                    billable = sum(1 for r in results if not r.get('_cache_hit'))
                                     stats = UsageStats.query.first()
-                                    if stats:
-                                        stats.total_calls += len(results)
+                                    if stats and billable:
+                                        stats.total_calls += billable
                                         db.session.commit()
                             except Exception as e:
                                 logger.error(f"Error processing file {original_filename}: {str(e)}")
@@ -818,27 +4385,40 @@ def upload_files():
                                 try: os.remove(filepath)
                                 except: pass
 
-                    with processed_invoices_lock:
-                        processed_invoices[sid] = all_results
-                    
-                    save_session_to_disk(sid, all_results)
+                    # Keep the order rows were served in while the job ran, so row ids don't change
+                    all_results = partial_results.finish(sid) or all_results
+
+                    # Persist first so an evicted session can always be reloaded
+                    saved = save_session_to_disk(sid, all_results)
+                    # An unsaved session is still served from memory; it just won't survive eviction
+                    processed_invoices.put(sid, all_results, persisted=saved)
+                    partial_results.discard(sid)
+                    if EXPORT_PREGENERATE:
+                        export_executor.submit(pregenerate_exports, sid, all_results, schema_cache.get())
                     
-                    with processing_status_lock:
-                        if sid in processing_status:
-                            processing_status[sid]['completed'] = True
-                            processing_status[sid]['percentage'] = 100
-                            processing_status[sid]['message'] = 'Processing complete!'
+                    with processing_status.edit(sid) as status:
+                        if status is not None:
+                            status['completed'] = True
+                            status['percentage'] = 100
+                            status['message'] = 'Processing complete!'
+
+                    # Publish this job's final counts now rather than on the next metric update
+                    metrics.flush()
+                    processing_status.flush_trace(sid)
                             
                 except Exception as e:
                     logger.error(f"Background processing error: {str(e)}")
-                    with processing_status_lock:
-                        if sid in processing_status:
-                            processing_status[sid]['error'] = str(e)
-                            processing_status[sid]['completed'] = True
+                    with processing_status.edit(sid) as status:
+                        if status is not None:
+                            status['error'] = str(e)
+                            status['completed'] = True
+                    partial_results.finish(sid)
+                    partial_results.discard(sid)
+                    processing_status.flush_trace(sid)
 
         # Run in thread
         import threading
-        thread = threading.Thread(target=run_background_processing, args=(session_id, saved_files))
+        thread = threading.Thread(target=run_background_processing, args=(session_id, saved_files, priority))
         thread.daemon = True # Ensure thread doesn't block shutdown
         thread.start()
 
@@ -853,41 +4433,121 @@ def upload_files():
         return jsonify({'error': str(e)}), 500
 
 
+def invoice_table_row(row_id, invoice, schema_names):
+    """One row of the results table"""
+    row = {'row_id': row_id}
+    for field in ['Source_File', 'Page_Number'] + schema_names:
+        row[field] = invoice.get(field, '')
+    # Add overall confidence score
+    row['_overall_confidence'] = invoice.get('_overall_confidence', 0)
+    return row
+
+
 @app.route('/get_invoices/<session_id>')
 def get_invoices(session_id):
-    """Get processed invoices for a session with confidence scores"""
-    invoices = get_session_data(session_id)
-    if invoices is None:
-        return jsonify({'error': 'Session not found'}), 404
+    """Get processed invoices for a session with confidence scores.
+
+    ?since=<cursor> returns only rows added after a previous response's cursor,
+    so a running job's table can be filled in as pages finish.
+    """
+    if any(arg in request.args for arg in ('limit', 'offset', 'sort', 'filter', 'q')):
+        return get_invoices_page(session_id)
+
+    cursor = max(0, request.args.get('since', 0, type=int))
+    invoices = partial_results.since(session_id, cursor)
+    completed = invoices is None
+    if completed:
+        invoices = get_session_data(session_id)
+        if invoices is None:
+            return jsonify({'error': 'Session not found'}), 404
+        invoices = invoices[cursor:]
+
+    current_schema_names = get_current_schema_names()
+    table_data = [invoice_table_row(cursor + idx, invoice, current_schema_names)
+                  for idx, invoice in enumerate(invoices)]
+
+    return jsonify({
+        'success': True,
+        'invoices': table_data,
+        'cursor': cursor + len(table_data),
+        'completed': completed
+    })
+
+
+def get_invoices_page(session_id):
+    """One page of a session's rows.
+
+    ?limit=&offset= page through the rows, ?sort=<field> (or -<field> for
+    descending) orders them, and each ?filter= narrows them: `Field<60`,
+    `_overall_confidence>=85`, `_confidence.Field<60`, `Field=value`,
+    `Field!=value`, `Field:null` or `Field:notnull`. ?q= is a free-text search.
+    """
+    invoices = partial_results.since(session_id, 0)
+    completed = invoices is None
+    if completed:
+        invoices = get_session_data(session_id)
+        if invoices is None:
+            return jsonify({'error': 'Session not found'}), 404
+        index = session_indexes.get(session_id, len(invoices))
+    else:
+        # Rows are still arriving, so this index is only good for one request
+        index = SessionIndex(len(invoices))
+
+    offset = max(0, request.args.get('offset', 0, type=int))
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        limit = max(1, limit)
 
     current_schema_names = get_current_schema_names()
-    table_data = []
-    for idx, invoice in enumerate(invoices):
-        row = {'row_id': idx}
-        for field in ['Source_File', 'Page_Number'] + current_schema_names:
-            row[field] = invoice.get(field, '')
-        # Add overall confidence score
-        row['_overall_confidence'] = invoice.get('_overall_confidence', 0)
-        table_data.append(row)
+    try:
+        total, page = query_invoices(
+            invoices, index, current_schema_names,
+            sort=request.args.get('sort'),
+            filters=request.args.getlist('filter'),
+            search=request.args.get('q', '').strip(),
+            offset=offset,
+            limit=limit
+        )
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-    return jsonify({'success': True, 'invoices': table_data})
+    next_offset = offset + len(page)
+    return jsonify({
+        'success': True,
+        'invoices': [invoice_table_row(row_id, invoice, current_schema_names) for row_id, invoice in page],
+        'total': len(invoices),
+        'filtered': total,
+        'offset': offset,
+        'next_offset': next_offset if next_offset < total else None,
+        'completed': completed
+    })
 
 
 @app.route('/get_invoice_image/<session_id>/<int:invoice_id>')
 def get_invoice_image(session_id, invoice_id):
     """Get invoice image and data for modal with confidence scores"""
-    invoices = get_session_data(session_id)
-    if invoices is None or invoice_id < 0 or invoice_id >= len(invoices):
+    if invoice_id < 0:
+        return jsonify({'error': 'Not found'}), 404
+    # Rows of a running job are viewable as soon as they appear in the table
+    rows = partial_results.since(session_id, invoice_id)
+    if rows is None:
+        invoices = get_session_data(session_id)
+        rows = invoices[invoice_id:invoice_id + 1] if invoices is not None else []
+    if not rows:
         return jsonify({'error': 'Not found'}), 404
 
-    invoice = invoices[invoice_id]
+    invoice = rows[0]
     
     # Separate internal fields from display data
-    internal_fields = ['_image_base64', '_confidence_scores', '_overall_confidence']
+    internal_fields = ['_image_base64', '_image_id', '_confidence_scores', '_overall_confidence', '_cache_hit',
+                       '_extraction_path', '_input_tokens']
     display_data = {k: v for k, v in invoice.items() if k not in internal_fields}
-    
+
+    image_id = invoice.get('_image_id')
     return jsonify({
         'success': True,
+        'image_url': f"/api/images/{image_id}" if image_id else None,
+        # Sessions saved before the image store still carry inline base64
         'image': invoice.get('_image_base64', ''),
         'data': display_data,
         'confidence_scores': invoice.get('_confidence_scores', {}),
@@ -895,34 +4555,65 @@ def get_invoice_image(session_id, invoice_id):
     })
 
 
+@app.route('/api/images/<image_id>')
+def get_page_image(image_id):
+    """Serve a stored page image; ids are content hashes so responses never change"""
+    if not re.fullmatch(r'[0-9a-f]{64}', image_id):
+        return jsonify({'error': 'Not found'}), 404
+
+    path, mime_type = find_stored_image(image_id)
+    if path is None:
+        return jsonify({'error': 'Not found'}), 404
+
+    from flask import send_file
+    response = send_file(
+        path.resolve(),
+        mimetype=mime_type,
+        etag=image_id,
+        max_age=365 * 24 * 3600,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @app.route('/export/<session_id>')
 def export_excel(session_id):
-    """Export invoices to Excel"""
-    invoices = get_session_data(session_id)
-    if invoices is None:
-        return jsonify({'error': 'Session not found'}), 404
+    """Export invoices to Excel, or ?format=csv / ?format=parquet"""
+    export_format = request.args.get('format', 'xlsx').lower()
+    if export_format not in EXPORT_FORMATS:
+        return jsonify({'error': f"Unsupported export format: {export_format}"}), 400
 
-    current_schema_names = get_current_schema_names()
-    df_data = []
-    for invoice in invoices:
-        row = {}
-        for field in ['Source_File', 'Page_Number'] + current_schema_names:
-            row[field] = invoice.get(field, '')
-        df_data.append(row)
-
-    df = pd.DataFrame(df_data)
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        df.to_excel(writer, index=False, sheet_name='Invoice Data')
-    output.seek(0)
+    schema = schema_cache.get()
+    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    download_name = f'invoices_{timestamp}.{export_format}'
+
+    path = export_cache.get(session_id, schema.version, export_format)
+    if path is None:
+        invoices = get_session_data(session_id)
+        if invoices is None:
+            return jsonify({'error': 'Session not found'}), 404
+        columns = export_columns(schema.names)
+
+        if export_format == 'csv':
+            from flask import Response
+            return Response(
+                export_cache.stream_csv(session_id, invoices, columns, schema.version),
+                mimetype=EXPORT_FORMATS['csv'],
+                headers={'Content-Disposition': f'attachment; filename={download_name}'}
+            )
+        try:
+            path = export_cache.generate(session_id, invoices, columns, schema.version, export_format)
+        except ImportError:
+            return jsonify({'error': 'Parquet export needs pyarrow installed on the server'}), 501
 
     from flask import send_file
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        path.resolve(),
+        mimetype=EXPORT_FORMATS[export_format],
         as_attachment=True,
-        download_name=f'invoices_{timestamp}.xlsx'
+        download_name=download_name
     )
 
 
@@ -933,6 +4624,7 @@ if __name__ == '__main__':
     # Create folders
     os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
     os.makedirs(app.config['SESSION_FOLDER'], exist_ok=True)
+    os.makedirs(app.config['IMAGE_FOLDER'], exist_ok=True)
 
     # Run app
     port = int(os.environ.get('PORT', 8080))
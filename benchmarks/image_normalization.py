@@ -0,0 +1,129 @@
+"""
+Image normalization benchmark: bytes per page and preparation time for each
+model-image setting, against the original lossless PNG path.
+
+Pages come from the PDFs and images in `sample invoices/`. With --live the
+first N pages are also sent to Gemini under every setting (needs
+GEMINI_API_KEY) to report real end-to-end latency and how many field values
+agree with the PNG baseline.
+
+Usage:
+    python benchmarks/image_normalization.py
+    python benchmarks/image_normalization.py --live 3 --output normalization.json
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from PIL import Image  # noqa: E402
+
+import app  # noqa: E402
+
+# name -> (image_format, quality, max_edge, grayscale, trim)
+SETTINGS = {
+    'png_baseline': ('png', 85, 0, False, False),
+    'png_gray_trim': ('png', 85, 0, True, True),
+    'jpeg_q85': ('jpeg', 85, 0, False, False),
+    'jpeg_q70_gray': ('jpeg', 70, 0, True, False),
+    'webp_q80': ('webp', 80, 0, False, False),
+    'webp_q80_gray_trim': ('webp', 80, 0, True, True),
+    'jpeg_q85_1600px': ('jpeg', 85, 1600, True, True),
+    'jpeg_q80_1024px': ('jpeg', 80, 1024, True, True),
+}
+
+
+def load_pages(sample_dir, dpi):
+    app.PDF_RENDER_DPI = dpi
+    pages = []
+    for name in sorted(os.listdir(sample_dir)):
+        path = os.path.join(sample_dir, name)
+        extension = name.lower().rsplit('.', 1)[-1]
+        if extension == 'pdf':
+            for page_num, page in app.iter_pdf_pages(path):
+                # Decoded pixels, so every setting is measured from the same starting point
+                pages.append((f"{name}#{page_num}", page.image.convert('RGB')))
+        elif extension in ('png', 'jpg', 'jpeg', 'webp'):
+            pages.append((name, Image.open(path).convert('RGB')))
+    return pages
+
+
+def apply_setting(setting):
+    app.IMAGE_FORMAT, app.IMAGE_QUALITY, app.IMAGE_MAX_EDGE, app.IMAGE_GRAYSCALE, app.IMAGE_TRIM_WHITESPACE = setting
+
+
+def measure_offline(pages, setting):
+    apply_setting(setting)
+    sizes, timings = [], []
+    for _, image in pages:
+        started = time.perf_counter()
+        part = app.prepare_image_part(image)
+        timings.append(time.perf_counter() - started)
+        sizes.append(len(part['data']) * 3 // 4)  # decoded size
+    return {
+        'bytes_per_page_mean': round(statistics.mean(sizes)),
+        'bytes_per_page_max': max(sizes),
+        'prepare_ms_mean': round(statistics.mean(timings) * 1000, 2),
+    }
+
+
+def measure_live(pages, setting, schema, baseline):
+    apply_setting(setting)
+    latencies, agreements, values = [], [], []
+    for _, image in pages:
+        started = time.perf_counter()
+        data = app.extract_invoice_data_with_gemini(image, schema, check_cache=False)
+        latencies.append(time.perf_counter() - started)
+        values.append(data)
+    if baseline is not None:
+        for data, reference in zip(values, baseline):
+            if data and reference:
+                same = sum(1 for f in schema if data.get(f.name) == reference.get(f.name))
+                agreements.append(same / len(schema))
+    return values, {
+        'latency_s_mean': round(statistics.mean(latencies), 3),
+        'latency_s_max': round(max(latencies), 3),
+        'field_agreement_with_png': round(statistics.mean(agreements), 3) if agreements else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', default=os.path.join(ROOT, 'sample invoices'))
+    parser.add_argument('--dpi', type=int, default=0, help='PDF render DPI (0 = native)')
+    parser.add_argument('--live', type=int, default=0, help='Send the first N pages to Gemini per setting')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    pages = load_pages(args.samples, args.dpi)
+    results = {'config': vars(args), 'pages': len(pages), 'settings': {}}
+
+    for name, setting in SETTINGS.items():
+        results['settings'][name] = measure_offline(pages, setting)
+
+    if args.live:
+        with app.app.app_context():
+            schema = [SimpleNamespace(name=f.name, description=f.description) for f in app.get_current_fields()]
+        live_pages = pages[:args.live]
+        baseline = None
+        for name, setting in SETTINGS.items():
+            values, stats = measure_live(live_pages, setting, schema, baseline)
+            if name == 'png_baseline':
+                baseline = values
+            results['settings'][name].update(stats)
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
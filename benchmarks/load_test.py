@@ -0,0 +1,309 @@
+"""
+End-to-end load generator for the Flask API.
+
+Starts the app under gunicorn with the Dockerfile's worker settings (gthread
+workers, 16 threads each) and the offline fake extraction backend, in a
+scratch directory with its own SQLite database. Then N simulated users loop
+until the deadline:
+
+  POST /upload            a synthetic PDF whose page count is drawn from --mix
+  GET  /api/progress/<id> polled every --poll-interval seconds like main.js's fallback
+  GET  /get_invoices/<id> once the job completes
+  GET  /export/<id>
+
+It reports p50/p95/p99 latency and error rate per endpoint, job durations,
+throughput in pages/min and the RSS of every gunicorn worker sampled once a
+second. Pass --url to load an already running server instead; RSS sampling
+then needs --server-pid.
+
+Usage:
+    python benchmarks/load_test.py --users 50 --duration 120
+    python benchmarks/load_test.py --users 50 --mix 1:50,5:30,20:15,100:5 --fake-latency-ms 1500 --output load.json
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from synthetic_pdf import build_synthetic_pdf  # noqa: E402
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def parse_mix(spec):
+    """'1:50,5:30' -> [(1, 50), (5, 30)] as (pages, weight)"""
+    mix = []
+    for item in spec.split(','):
+        pages, weight = item.split(':')
+        mix.append((int(pages), float(weight)))
+    return mix
+
+
+class Recorder:
+    """Thread-safe latency and outcome log per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.jobs = []
+
+    def request(self, session, endpoint, method, url, **kwargs):
+        started = time.perf_counter()
+        try:
+            response = session.request(method, url, timeout=300, **kwargs)
+            ok = response.status_code < 400
+        except requests.RequestException:
+            response, ok = None, False
+        elapsed = time.perf_counter() - started
+        with self.lock:
+            self.latencies[endpoint].append(elapsed)
+            if not ok:
+                self.errors[endpoint] += 1
+        return response if ok else None
+
+    def job(self, pages, seconds, completed):
+        with self.lock:
+            self.jobs.append((pages, seconds, completed))
+
+    def summary(self):
+        with self.lock:
+            endpoints = {}
+            for endpoint, values in sorted(self.latencies.items()):
+                endpoints[endpoint] = {
+                    'requests': len(values),
+                    'errors': self.errors[endpoint],
+                    'error_rate': round(self.errors[endpoint] / len(values), 4) if values else 0,
+                    'p50_ms': round(percentile(values, 50) * 1000, 1),
+                    'p95_ms': round(percentile(values, 95) * 1000, 1),
+                    'p99_ms': round(percentile(values, 99) * 1000, 1),
+                    'max_ms': round(max(values) * 1000, 1),
+                }
+            return endpoints, list(self.jobs)
+
+
+def run_user(user_id, base_url, documents, mix, deadline, poll_interval, job_timeout, recorder, seed):
+    rng = random.Random(seed + user_id)
+    session = requests.Session()
+    sizes = [pages for pages, _ in mix]
+    weights = [weight for _, weight in mix]
+
+    while time.monotonic() < deadline:
+        pages = rng.choices(sizes, weights)[0]
+        with open(documents[pages], 'rb') as f:
+            files = {'files[]': (f"load_{pages}p_{user_id}.pdf", f, 'application/pdf')}
+            response = recorder.request(session, '/upload', 'POST', f"{base_url}/upload", files=files)
+        if response is None:
+            time.sleep(1)
+            continue
+
+        session_id = response.json().get('session_id')
+        started = time.monotonic()
+        completed = False
+        while time.monotonic() - started < job_timeout:
+            time.sleep(poll_interval)
+            status = recorder.request(session, '/api/progress', 'GET', f"{base_url}/api/progress/{session_id}")
+            if status is not None and status.json().get('completed'):
+                completed = not status.json().get('error')
+                break
+        recorder.job(pages, time.monotonic() - started, completed)
+
+        if completed:
+            recorder.request(session, '/get_invoices', 'GET', f"{base_url}/get_invoices/{session_id}")
+            recorder.request(session, '/export', 'GET', f"{base_url}/export/{session_id}")
+
+
+def worker_pids(master_pid):
+    try:
+        with open(f"/proc/{master_pid}/task/{master_pid}/children") as f:
+            return [int(pid) for pid in f.read().split()]
+    except OSError:
+        return []
+
+
+def rss_mb(pid):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def sample_rss(master_pid, started, stop, samples):
+    while not stop.is_set():
+        workers = {pid: rss_mb(pid) for pid in worker_pids(master_pid)}
+        workers = {pid: round(rss, 1) for pid, rss in workers.items() if rss is not None}
+        samples.append({
+            't': round(time.monotonic() - started, 1),
+            'workers_mb': workers,
+            'total_mb': round(sum(workers.values()), 1),
+        })
+        stop.wait(1)
+
+
+def start_server(args, workdir):
+    env = dict(os.environ)
+    env.update({
+        'PYTHONPATH': ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+        'EXTRACTION_BACKEND': 'fake',
+        'FAKE_LATENCY_MS': str(args.fake_latency_ms),
+        'FAKE_RATE_LIMIT_RATE': str(args.fake_rate_limit_rate),
+        'FAKE_MALFORMED_RATE': str(args.fake_malformed_rate),
+        'FAKE_SEED': str(args.seed),
+        'DATABASE_URL': f"sqlite:///{os.path.join(workdir, 'load_test.db')}",
+        'MAX_TRIAL_INVOICES': str(10 ** 9),
+        'EXTRACTION_CACHE_ENABLED': 'False',
+    })
+    if args.gemini_rpm:
+        env['GEMINI_RPM'] = str(args.gemini_rpm)
+
+    # The image creates uploads/ at build time; gunicorn itself never does
+    os.makedirs(os.path.join(workdir, 'uploads'), exist_ok=True)
+    subprocess.run([sys.executable, '-c', 'import app; app.init_db()'], cwd=workdir, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    log = open(os.path.join(workdir, 'gunicorn.log'), 'w')
+    server = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f"127.0.0.1:{args.port}",
+         '--workers', str(args.workers), '--worker-class', 'gthread', '--threads', str(args.threads),
+         '--timeout', '300', 'app:app'],
+        cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT
+    )
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    for _ in range(120):
+        if server.poll() is not None:
+            raise RuntimeError(f"gunicorn exited, see {log.name}")
+        try:
+            if requests.get(f"{base_url}/", timeout=2).status_code == 200:
+                return server, base_url
+        except requests.RequestException:
+            pass
+        time.sleep(0.5)
+    server.terminate()
+    raise RuntimeError("gunicorn did not come up within 60s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=120, help='Seconds before users stop starting uploads')
+    parser.add_argument('--mix', default='1:50,5:30,20:15,100:5', help='pages:weight pairs for upload sizes')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--job-timeout', type=float, default=600)
+    parser.add_argument('--workers', type=int, default=4, help='gunicorn workers (Dockerfile: 4)')
+    parser.add_argument('--threads', type=int, default=16, help='gunicorn threads per worker (Dockerfile: 16)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--fake-latency-ms', type=float, default=800)
+    parser.add_argument('--fake-rate-limit-rate', type=float, default=0)
+    parser.add_argument('--fake-malformed-rate', type=float, default=0)
+    parser.add_argument('--gemini-rpm', type=int, help='Override the client-side rate limit')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--url', help='Load an already running server instead of starting one')
+    parser.add_argument('--server-pid', type=int, help='gunicorn master pid for RSS sampling with --url')
+    parser.add_argument('--workdir', help='Scratch directory (default: a new temp dir)')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    workdir = os.path.abspath(args.workdir or tempfile.mkdtemp(prefix='invoice-load-'))
+    os.makedirs(workdir, exist_ok=True)
+    mix = parse_mix(args.mix)
+
+    documents = {}
+    for pages, _ in mix:
+        path = os.path.join(workdir, f"load_{pages}p.pdf")
+        if not os.path.exists(path):
+            build_synthetic_pdf(path, pages, random.Random(args.seed + pages))
+        documents[pages] = path
+
+    server = None
+    if args.url:
+        base_url, master_pid = args.url.rstrip('/'), args.server_pid
+    else:
+        server, base_url = start_server(args, workdir)
+        master_pid = server.pid
+
+    recorder = Recorder()
+    samples = []
+    stop = threading.Event()
+    started = time.monotonic()
+    sampler = None
+    if master_pid:
+        sampler = threading.Thread(target=sample_rss, args=(master_pid, started, stop, samples), daemon=True)
+        sampler.start()
+
+    deadline = started + args.duration
+    users = [
+        threading.Thread(target=run_user, args=(i, base_url, documents, mix, deadline, args.poll_interval,
+                                                args.job_timeout, recorder, args.seed), daemon=True)
+        for i in range(args.users)
+    ]
+    try:
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+    finally:
+        elapsed = time.monotonic() - started
+        stop.set()
+        if sampler:
+            sampler.join()
+        if server:
+            server.terminate()
+            server.wait(timeout=30)
+
+    endpoints, jobs = recorder.summary()
+    completed = [(pages, seconds) for pages, seconds, ok in jobs if ok]
+    pages_done = sum(pages for pages, _ in completed)
+    durations = [seconds for _, seconds in completed]
+    results = {
+        'config': dict(vars(args), workdir=workdir),
+        'elapsed_s': round(elapsed, 1),
+        'endpoints': endpoints,
+        'jobs': {
+            'started': len(jobs),
+            'completed': len(completed),
+            'failed_or_timed_out': len(jobs) - len(completed),
+            'duration_p50_s': round(percentile(durations, 50), 2),
+            'duration_p95_s': round(percentile(durations, 95), 2),
+            'duration_p99_s': round(percentile(durations, 99), 2),
+        },
+        'throughput': {
+            'pages': pages_done,
+            'pages_per_min': round(pages_done / elapsed * 60, 1) if elapsed else 0,
+        },
+        'rss': {
+            'peak_total_mb': max((s['total_mb'] for s in samples), default=None),
+            'peak_worker_mb': max((rss for s in samples for rss in s['workers_mb'].values()), default=None),
+            'samples': samples,
+        },
+    }
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
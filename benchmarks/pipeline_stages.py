@@ -0,0 +1,224 @@
+"""
+Per-stage micro-benchmarks for the extraction pipeline, fully offline.
+
+Every stage runs against the bundled `sample invoices/` plus a synthetic
+multi-hundred-page PDF (alternating born-digital text pages and scanned image
+pages). Model calls go to the FakeBackend, so no API quota is used:
+
+  pdf_to_images      PDF -> page payloads, per source file
+  image_encoding     legacy image_to_base64 vs prepare_image_part per page
+  response_parsing   parse_extraction_response + confidence rules, full and compact formats
+  get_invoices       /get_invoices JSON serialization for a large session
+  export_excel       /export workbook generation for the same session
+  end_to_end         process_file_parallel on the synthetic PDF with a fast fake backend
+
+Seeds are fixed and the app runs in a scratch directory, so repeated runs on
+the same machine produce comparable JSON.
+
+Usage:
+    python benchmarks/pipeline_stages.py
+    python benchmarks/pipeline_stages.py --synthetic-pages 500 --invoices 5000 --output stages.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+import uuid
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fitz  # noqa: E402
+
+import app  # noqa: E402
+from synthetic_pdf import build_synthetic_pdf  # noqa: E402
+
+SEED = 1234
+
+
+def timed(fn, repeat=1):
+    """Run fn `repeat` times; return (last result, list of seconds)"""
+    timings = []
+    result = None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return result, timings
+
+
+def summarize(timings, count=1):
+    median = statistics.median(timings)
+    return {
+        'runs': len(timings),
+        'seconds_median': round(median, 4),
+        'seconds_min': round(min(timings), 4),
+        'per_item_ms': round(median / count * 1000, 3) if count else None,
+        'items_per_second': round(count / median, 1) if median else None,
+    }
+
+
+def bench_pdf_to_images(pdf_paths):
+    results = {}
+    for name, path in pdf_paths.items():
+        with open(path, 'rb') as f:
+            pdf_bytes = f.read()
+        pages, timings = timed(lambda: app.pdf_to_images(pdf_bytes))
+        results[name] = dict(summarize(timings, len(pages)), pages=len(pages),
+                             text_pages=sum(1 for p in pages if app.as_page_payload(p).text))
+    return results
+
+
+def bench_image_encoding(pages):
+    images = [app.as_page_payload(page).image.convert('RGB') for page in pages]
+    _, legacy = timed(lambda: [app.image_to_base64(image) for image in images])
+    # Fresh payloads so nothing is served from a previous encoding
+    _, current = timed(lambda: [app.prepare_image_part(app.PagePayload(image=image)) for image in images])
+    return {
+        'pages': len(images),
+        'image_to_base64': summarize(legacy, len(images)),
+        'prepare_image_part': summarize(current, len(images)),
+    }
+
+
+def bench_response_parsing(fields, responses):
+    results = {}
+    for response_format in ('full', 'compact'):
+        app.RESPONSE_FORMAT = response_format
+        schema = app.compile_schema(fields)
+        backend = app.FakeBackend(latency_ms=0, latency_sigma=0, malformed_rate=0.05, seed=SEED)
+        texts = []
+        for _ in range(responses):
+            _, outcome, body = backend._plan(schema, 1)
+            texts.append(backend._respond([schema.prompt], outcome, body).text)
+
+        def parse_all():
+            parsed = 0
+            for text in texts:
+                try:
+                    app.parse_extraction_response(text, schema)
+                    parsed += 1
+                except Exception:
+                    pass
+            return parsed
+
+        parsed, timings = timed(parse_all, repeat=3)
+        results[response_format] = dict(summarize(timings, len(texts)), parsed=parsed, responses=len(texts))
+    app.RESPONSE_FORMAT = 'full'
+    return results
+
+
+def make_session(fields, invoices, rng):
+    rows = []
+    for i in range(invoices):
+        row = {f.name: (f"{f.name[:3].upper()}-{rng.randint(1000, 99999)}" if rng.random() > 0.2 else None)
+               for f in fields}
+        row['_confidence_scores'] = {f.name: rng.randint(0, 100) for f in fields}
+        row['_overall_confidence'] = rng.randint(40, 99)
+        row['_image_id'] = uuid.UUID(int=rng.getrandbits(128)).hex * 2
+        row['Source_File'] = f"batch_{i // 100}.pdf"
+        row['Page_Number'] = i % 100 + 1
+        rows.append(row)
+    session_id = str(uuid.UUID(int=rng.getrandbits(128)))
+    app.processed_invoices.put(session_id, rows)
+    return session_id
+
+
+def bench_session_routes(session_id, invoices):
+    client = app.app.test_client()
+    listing, get_timings = timed(lambda: client.get(f'/get_invoices/{session_id}'), repeat=5)
+    export, export_timings = timed(lambda: client.get(f'/export/{session_id}'), repeat=3)
+    return (
+        dict(summarize(get_timings, invoices), response_bytes=len(listing.data), status=listing.status_code),
+        dict(summarize(export_timings, invoices), response_bytes=len(export.data), status=export.status_code),
+    )
+
+
+def bench_end_to_end(path, fields, latency_ms):
+    app._extraction_backend = app.FakeBackend(latency_ms=latency_ms, latency_sigma=0.3, seed=SEED)
+    schema = app.compile_schema(fields)
+    results, timings = timed(lambda: app.process_file_parallel(path, os.path.basename(path), schema))
+    return dict(summarize(timings, len(results)), pages=len(results), fake_latency_ms=latency_ms,
+                paths={p: sum(1 for r in results if r.get('_extraction_path') == p) for p in ('text', 'image')})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--samples', default=os.path.join(ROOT, 'sample invoices'))
+    parser.add_argument('--synthetic-pages', type=int, default=300)
+    parser.add_argument('--encode-pages', type=int, default=40, help='Pages used for the encoding stage')
+    parser.add_argument('--responses', type=int, default=2000, help='Fake responses for the parsing stage')
+    parser.add_argument('--invoices', type=int, default=2000, help='Invoices in the synthetic session')
+    parser.add_argument('--latency-ms', type=float, default=20, help='Fake backend latency for end_to_end')
+    parser.add_argument('--text-fast-path', action='store_true', help='Send born-digital pages as text')
+    parser.add_argument('--workdir', help='Scratch directory for app files (default: a new temp dir)')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    samples = os.path.abspath(args.samples)
+    output = os.path.abspath(args.output) if args.output else None
+    workdir = args.workdir or tempfile.mkdtemp(prefix='invoice-bench-')
+    os.makedirs(workdir, exist_ok=True)
+    os.chdir(workdir)
+
+    # Offline and uncached, so every run does the same work
+    app.EXTRACTION_BACKEND = 'fake'
+    app.EXTRACTION_CACHE_ENABLED = False
+    app.TEXT_FAST_PATH = args.text_fast_path
+    app.rate_limiter = app.RateLimiter(max_calls_per_minute=10 ** 6)
+    app.init_db()
+    with app.app.app_context():
+        fields = [SimpleNamespace(name=f.name, description=f.description) for f in app.get_current_fields()]
+
+    rng = random.Random(SEED)
+    synthetic_path = os.path.join(workdir, f'synthetic_{args.synthetic_pages}.pdf')
+    if not os.path.exists(synthetic_path):
+        build_synthetic_pdf(synthetic_path, args.synthetic_pages, rng)
+
+    pdf_paths = {name: os.path.join(samples, name) for name in sorted(os.listdir(samples))
+                 if name.lower().endswith('.pdf')}
+    pdf_paths[os.path.basename(synthetic_path)] = synthetic_path
+
+    results = {
+        'config': vars(args),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'pymupdf': fitz.VersionBind,
+            'cpu_count': os.cpu_count(),
+        },
+        'fields': len(fields),
+        'stages': {},
+    }
+    stages = results['stages']
+    stages['pdf_to_images'] = bench_pdf_to_images(pdf_paths)
+
+    encode_pages = []
+    for path in pdf_paths.values():
+        encode_pages.extend(page for _, page in app.iter_pdf_pages(path))
+        if len(encode_pages) >= args.encode_pages:
+            break
+    stages['image_encoding'] = bench_image_encoding(encode_pages[:args.encode_pages])
+    stages['response_parsing'] = bench_response_parsing(fields, args.responses)
+
+    session_id = make_session(fields, args.invoices, random.Random(SEED))
+    stages['get_invoices'], stages['export_excel'] = bench_session_routes(session_id, args.invoices)
+    stages['end_to_end'] = bench_end_to_end(synthetic_path, fields, args.latency_ms)
+    results['parser'] = app.parse_stats.stats()
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+"""
+Rate limiter benchmark: many extraction threads contending for one limiter.
+
+Compares the token-bucket RateLimiter in app.py with the previous sliding-window
+limiter (which slept while holding its lock) and reports throughput, wait-time
+spread across threads and how long an unrelated caller is blocked on the lock.
+
+Usage:
+    python benchmarks/rate_limiter.py --threads 100 --rpm 500 --duration 30
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app import RateLimiter  # noqa: E402
+
+
+class SlidingWindowRateLimiter:
+    """The original limiter, kept here as the baseline"""
+
+    def __init__(self, max_calls_per_minute=15):
+        self.max_calls = max_calls_per_minute
+        self.calls = deque()
+        self.lock = threading.Lock()
+
+    def wait_if_needed(self, tokens=0):
+        with self.lock:
+            now = time.time()
+            while self.calls and now - self.calls[0] > 60:
+                self.calls.popleft()
+            if len(self.calls) >= self.max_calls:
+                sleep_time = 60 - (now - self.calls[0]) + 1
+                if sleep_time > 0:
+                    time.sleep(sleep_time)
+                    while self.calls and time.time() - self.calls[0] > 60:
+                        self.calls.popleft()
+            self.calls.append(time.time())
+
+    def stats(self):
+        with self.lock:
+            return {'window_calls': len(self.calls)}
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def run(limiter, threads, duration, tokens_per_call):
+    stop_at = time.monotonic() + duration
+    completions = []
+    per_thread_calls = [0] * threads
+    waits = []
+    lock = threading.Lock()
+
+    def worker(index):
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            limiter.wait_if_needed(tokens_per_call)
+            finished = time.monotonic()
+            if finished > stop_at:
+                break
+            with lock:
+                completions.append(finished)
+                waits.append(finished - started)
+            per_thread_calls[index] += 1
+
+    # Probe how long a stats() call (any lock holder) is blocked while saturated
+    probe_latencies = []
+
+    def probe():
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            limiter.stats()
+            probe_latencies.append(time.monotonic() - started)
+            time.sleep(0.1)
+
+    started = time.monotonic()
+    workers = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(threads)]
+    workers.append(threading.Thread(target=probe, daemon=True))
+    for t in workers:
+        t.start()
+    # Sliding-window threads may be asleep holding the lock past the deadline; don't wait for them
+    for t in workers:
+        t.join(timeout=max(0.0, stop_at + 1 - time.monotonic()))
+
+    # Steady-state rate excludes the initial burst (first 10% of the run)
+    steady_from = started + duration * 0.1
+    steady = [t for t in completions if t >= steady_from]
+    return {
+        'calls': len(completions),
+        'calls_per_minute': round(len(completions) / duration * 60, 1),
+        'steady_calls_per_minute': round(len(steady) / (duration * 0.9) * 60, 1),
+        'wait_p50_s': round(percentile(waits, 50), 3),
+        'wait_p95_s': round(percentile(waits, 95), 3),
+        'wait_max_s': round(max(waits), 3) if waits else 0.0,
+        'calls_per_thread_stdev': round(statistics.pstdev(per_thread_calls), 2),
+        'threads_starved': sum(1 for c in per_thread_calls if c == 0),
+        # A probe stuck behind a sleeping lock holder never records a sample
+        'lock_probe_p99_s': round(percentile(probe_latencies, 99), 4),
+        'lock_probe_samples': len(probe_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=100)
+    parser.add_argument('--rpm', type=int, default=500)
+    parser.add_argument('--tpm', type=int, default=0, help='Token budget for the token-bucket limiter (0 = none)')
+    parser.add_argument('--tokens-per-call', type=int, default=2500)
+    parser.add_argument('--duration', type=float, default=30.0, help='Seconds per limiter')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    results = {
+        'config': vars(args),
+        'token_bucket': run(RateLimiter(args.rpm, args.tpm or None), args.threads, args.duration, args.tokens_per_call),
+        'sliding_window': run(SlidingWindowRateLimiter(args.rpm), args.threads, args.duration, args.tokens_per_call),
+    }
+
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
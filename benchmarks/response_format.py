@@ -0,0 +1,175 @@
+"""
+Response format benchmark: output tokens per page for the full and compact
+response formats, on the active schema.
+
+Offline, a deterministic mix of confident, low-confidence and missing fields
+is rendered in both formats. Output tokens are estimated with the same
+4-chars-per-token rule the rate limiter uses, and the compact response is
+parsed back to check that it yields the same field values as the full one. With --live the first N sample pages are sent to Gemini in both
+formats (needs GEMINI_API_KEY) to report real candidate token counts and
+latency.
+
+Usage:
+    python benchmarks/response_format.py
+    python benchmarks/response_format.py --pages 200 --live 3 --output response_format.json
+"""
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import app  # noqa: E402
+
+SAMPLE_VALUES = ["2024-03-18", "INV-004512", "Al-Noor Traders (Pvt) Ltd", "3277876-1", "17-00-3763-456-19",
+                 "125,400.00", "21,318.00", "146,718.00", "Lahore", "2,508"]
+SAMPLE_EVIDENCE = ["handwritten next to printed total, last digit smudged",
+                   "stamp overlaps the second half of the number",
+                   "faint carbon copy text in the header box"]
+
+
+def synthesize_fields(schema, rng):
+    """One page worth of (value, confidence, clarity code, evidence) per field"""
+    page = {}
+    for field in schema:
+        roll = rng.random()
+        if roll < 0.25:
+            page[field.name] = None
+        elif roll < 0.85:
+            page[field.name] = (rng.choice(SAMPLE_VALUES), rng.randint(80, 99), rng.choice("CR"),
+                                f"printed beside the '{field.name.replace('_', ' ')}' label")
+        else:
+            page[field.name] = (rng.choice(SAMPLE_VALUES), rng.randint(35, 65), rng.choice("SV"),
+                                rng.choice(SAMPLE_EVIDENCE))
+    return page
+
+
+def render_full(page):
+    data = {}
+    for name, entry in page.items():
+        if entry is None:
+            data[name] = {"value": None, "confidence": 0, "visual_clarity": "Missing", "visual_evidence": "Not visible"}
+        else:
+            value, confidence, code, evidence = entry
+            data[name] = {"value": value, "confidence": confidence,
+                          "visual_clarity": app.CLARITY_CODES[code], "visual_evidence": evidence}
+    # Models answer the full format pretty-printed, like the prompt's example
+    return json.dumps(data, indent=2)
+
+
+def render_compact(page, threshold):
+    data = {}
+    for name, entry in page.items():
+        if entry is None:
+            data[name] = None
+        else:
+            value, confidence, code, evidence = entry
+            data[name] = [value, confidence, code] + ([evidence] if confidence < threshold else [])
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+
+
+def estimate_tokens(text):
+    return len(text) // 4
+
+
+def set_format(response_format, fields):
+    app.RESPONSE_FORMAT = response_format
+    return app.compile_schema(fields)
+
+
+def measure_offline(fields, pages):
+    rng = random.Random(42)
+    full_tokens, compact_tokens, mismatches = [], [], 0
+    for _ in range(pages):
+        page = synthesize_fields(fields, rng)
+        full_text = render_full(page)
+        compact_text = render_compact(page, app.COMPACT_EVIDENCE_THRESHOLD)
+        full_tokens.append(estimate_tokens(full_text))
+        compact_tokens.append(estimate_tokens(compact_text))
+
+        set_format('full', fields)
+        full_data = app.parse_extraction_response(full_text, fields)
+        set_format('compact', fields)
+        compact_data = app.parse_extraction_response(compact_text, fields)
+        # Confident compact values skip the generic-evidence penalty, so only values must match
+        if any(full_data.get(f.name) != compact_data.get(f.name) for f in fields):
+            mismatches += 1
+
+    full_mean, compact_mean = statistics.mean(full_tokens), statistics.mean(compact_tokens)
+    return {
+        'full': {'output_tokens_per_page_mean': round(full_mean, 1), 'output_tokens_per_page_max': max(full_tokens)},
+        'compact': {'output_tokens_per_page_mean': round(compact_mean, 1),
+                    'output_tokens_per_page_max': max(compact_tokens)},
+        'reduction': round(1 - compact_mean / full_mean, 3),
+        'value_mismatches_after_parse': mismatches,
+    }
+
+
+def load_sample_pages(sample_dir, limit):
+    pages = []
+    for name in sorted(os.listdir(sample_dir)):
+        path = os.path.join(sample_dir, name)
+        extension = name.lower().rsplit('.', 1)[-1]
+        if extension == 'pdf':
+            pages.extend(page for _, page in app.iter_pdf_pages(path))
+        elif extension in ('png', 'jpg', 'jpeg', 'webp'):
+            pages.append(app.PagePayload.from_file(path))
+        if len(pages) >= limit:
+            break
+    return pages[:limit]
+
+
+def measure_live(fields, pages, response_format):
+    schema = set_format(response_format, fields)
+    backend = app.get_extraction_backend()
+    tokens, latencies = [], []
+    for page in pages:
+        started = time.perf_counter()
+        response = backend.generate([schema.prompt, app.prepare_image_part(page)], schema, schema.generation_config)
+        latencies.append(time.perf_counter() - started)
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is not None:
+            tokens.append(usage.candidates_token_count)
+        app.parse_extraction_response(response.text, schema)
+    return {
+        'candidate_tokens_per_page_mean': round(statistics.mean(tokens), 1) if tokens else None,
+        'latency_s_mean': round(statistics.mean(latencies), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pages', type=int, default=100, help='Synthetic pages for the offline estimate')
+    parser.add_argument('--samples', default=os.path.join(ROOT, 'sample invoices'))
+    parser.add_argument('--live', type=int, default=0, help='Send the first N sample pages to Gemini per format')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args()
+
+    app.init_db()
+    with app.app.app_context():
+        fields = [SimpleNamespace(name=f.name, description=f.description) for f in app.get_current_fields()]
+
+    results = {'config': vars(args), 'fields': len(fields),
+               'evidence_threshold': app.COMPACT_EVIDENCE_THRESHOLD,
+               'offline_estimate': measure_offline(fields, args.pages)}
+
+    if args.live:
+        pages = load_sample_pages(args.samples, args.live)
+        results['live'] = {fmt: measure_live(fields, pages, fmt) for fmt in ('full', 'compact')}
+
+    results['parser'] = app.parse_stats.stats()
+    output = json.dumps(results, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+
+
+if __name__ == '__main__':
+    main()
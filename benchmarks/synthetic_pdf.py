@@ -0,0 +1,38 @@
+"""
+Synthetic invoice PDFs for the benchmarks: generated text invoices alternating
+with JPEG "scans" of the same layout, reproducible from the caller's RNG.
+"""
+import io
+
+import fitz
+from PIL import Image, ImageDraw
+
+
+def build_synthetic_pdf(path, pages, rng):
+    """Alternate generated text invoices with JPEG 'scans' of the same layout"""
+    doc = fitz.open()
+    for page_num in range(pages):
+        lines = [
+            "SALES TAX INVOICE",
+            f"Invoice No: INV-{rng.randint(10000, 99999)}    Date: 2024-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}",
+            f"Supplier: Trader {rng.randint(1, 500)} (Pvt) Ltd    NTN {rng.randint(1000000, 9999999)}-1",
+            f"Buyer: Store {rng.randint(1, 90)}    STRN 17-00-{rng.randint(1000, 9999)}-456-19",
+        ] + [f"Item {i}   Qty {rng.randint(1, 50)}   Rate {rng.randint(100, 9000)}.00" for i in range(1, 15)] + [
+            f"Exclusive Value {rng.randint(10000, 900000):,}.00",
+            f"GST 18% {rng.randint(1000, 90000):,}.00",
+            f"Net Amount {rng.randint(10000, 999999):,}.00",
+        ]
+        page = doc.new_page(width=595, height=842)
+        if page_num % 2 == 0:
+            for i, line in enumerate(lines):
+                page.insert_text((50, 60 + i * 18), line, fontsize=10)
+        else:
+            scan = Image.new('RGB', (1240, 1754), (250, 250, 246))
+            draw = ImageDraw.Draw(scan)
+            for i, line in enumerate(lines):
+                draw.text((100, 120 + i * 38), line, fill=(30, 30, 30))
+            buffer = io.BytesIO()
+            scan.save(buffer, format='JPEG', quality=80)
+            page.insert_image(page.rect, stream=buffer.getvalue())
+    doc.save(path)
+    doc.close()
@@ -44,6 +44,18 @@ class UsageStats(db.Model):
     total_calls = db.Column(db.Integer, default=0)
     trial_start_date = db.Column(db.DateTime, default=datetime.utcnow)
 
+class ProcessingJob(db.Model):
+    __tablename__ = 'processing_jobs'
+    session_id = db.Column(db.String(36), primary_key=True)
+    status = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class ProcessingTrace(db.Model):
+    __tablename__ = 'processing_traces'
+    session_id = db.Column(db.String(36), primary_key=True)
+    events = db.Column(db.Text, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
 # --- Seeding Logic ---
 
 def seed_database():
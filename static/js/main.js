@@ -6,6 +6,10 @@ let currentSessionId = null;
 let dataTable = null;
 let currentInvoiceIndex = 0;
 let totalInvoices = 0;
+// Rows already in the table; /get_invoices?since= returns only the ones after it
+let invoicesCursor = 0;
+let invoicesRequest = null;
+let invoicesPending = false;
 // Initialize with default schema from HTML or fallback
 // Initialize with schema from server or default fallback
 let currentSchema = []; // Will store objects {id, name, description}
@@ -175,6 +179,7 @@ function initializeEventListeners() {
   // Buttons
   $("#processBtn").on("click", processFiles);
   $("#exportBtn").on("click", exportToExcel);
+  $("#confidenceFilter").on("change", () => dataTable && dataTable.ajax.reload());
   $("#processMoreBtn").on("click", resetApp);
   $("#prevInvoiceBtn").on("click", showPreviousInvoice);
   $("#nextInvoiceBtn").on("click", showNextInvoice);
@@ -345,10 +350,12 @@ function processFiles() {
     success: function (response) {
       if (response?.success && response.session_id) {
         currentSessionId = response.session_id;
-        totalInvoices = response.total_invoices || 0;
-        
-        // Start polling for progress
-        startProgressPolling(currentSessionId);
+        totalInvoices = 0;
+        invoicesCursor = 0;
+        displayInvoices([]);
+
+        // Start tracking progress (SSE with polling fallback)
+        startProgressTracking(currentSessionId);
       } else {
         const msg = response?.error || "Processing failed.";
         showAlert("danger", msg);
@@ -366,47 +373,55 @@ function processFiles() {
   });
 }
 
-function startProgressPolling(sessionId) {
-  let lastPercentage = 0;
+function startProgressTracking(sessionId) {
+  // Prefer the server-pushed stream; fall back to polling if it's unavailable
+  if (window.EventSource) {
+    startProgressStream(sessionId);
+  } else {
+    startProgressPolling(sessionId);
+  }
+}
+
+function startProgressStream(sessionId) {
+  const source = new EventSource(`/api/progress/${sessionId}/stream`);
+  let receivedProgress = false;
+  let lastProcessed = 0;
+
+  source.addEventListener("progress", function (e) {
+    receivedProgress = true;
+    const status = JSON.parse(e.data);
+    // Page events only come from the worker running the job; the processed
+    // count reaches every worker through the shared job store
+    if (status.processed > lastProcessed && !status.completed) {
+      lastProcessed = status.processed;
+      loadInvoices(sessionId);
+    }
+    handleProgressStatus(sessionId, status, () => source.close());
+  });
+
+  source.onerror = function () {
+    // EventSource reconnects on its own after a normal stream rollover; switch
+    // to polling if the stream never worked or the server refused a reconnect
+    if (!receivedProgress || source.readyState === EventSource.CLOSED) {
+      source.close();
+      startProgressPolling(sessionId);
+    }
+  };
+}
 
+function startProgressPolling(sessionId) {
+  let lastProcessed = 0;
   const pollInterval = setInterval(() => {
     $.ajax({
       url: `/api/progress/${sessionId}`,
       type: "GET",
       success: function (status) {
-        if (status.error && !status.completed) {
-          clearInterval(pollInterval);
-          showAlert("danger", status.error);
-          $("#progressSection").hide();
-          $("#processBtn").prop("disabled", false);
-          return;
-        }
-
-        const percentage = status.percentage !== undefined ? status.percentage : 0;
-
-        // Smooth animation - increment gradually towards target
-        if (percentage > lastPercentage) {
-          lastPercentage = percentage;
-        }
-
-        updateProgress(
-          percentage,
-          status.processed || 0,
-          status.total || 0,
-          status.message || "Processing..."
-        );
-
-        if (status.completed) {
-          clearInterval(pollInterval);
-          // Ensure we show 100%
-          updateProgress(100, status.total, status.total, "Complete!");
-          if (status.error) {
-            showAlert("danger", "Processing error: " + status.error);
-          } else {
-            fetchUsage(); // Update usage stats after processing
-            setTimeout(() => loadInvoices(sessionId), 500);
-          }
+        // Polling gets no per-page events; fetch new rows whenever the count moves
+        if (status.processed > lastProcessed && !status.completed) {
+          lastProcessed = status.processed;
+          loadInvoices(sessionId);
         }
+        handleProgressStatus(sessionId, status, () => clearInterval(pollInterval));
       },
       error: function () {
         clearInterval(pollInterval);
@@ -418,6 +433,37 @@ function startProgressPolling(sessionId) {
   }, 500); // Poll every 500ms for smoother updates
 }
 
+function handleProgressStatus(sessionId, status, stop) {
+  if (status.error && !status.completed) {
+    stop();
+    showAlert("danger", status.error);
+    $("#progressSection").hide();
+    $("#processBtn").prop("disabled", false);
+    return;
+  }
+
+  const percentage = status.percentage !== undefined ? status.percentage : 0;
+
+  updateProgress(
+    percentage,
+    status.processed || 0,
+    status.total || 0,
+    status.message || "Processing..."
+  );
+
+  if (status.completed) {
+    stop();
+    // Ensure we show 100%
+    updateProgress(100, status.total, status.total, "Complete!");
+    if (status.error) {
+      showAlert("danger", "Processing error: " + status.error);
+    } else {
+      fetchUsage(); // Update usage stats after processing
+      loadInvoices(sessionId);
+    }
+  }
+}
+
 // ======================
 // Load & Display Invoices
 // ======================
@@ -426,15 +472,29 @@ function loadInvoices(sessionId) {
     showAlert("danger", "Session ID not found. Please try again.");
     return;
   }
+  // One request at a time; pages finishing meanwhile are picked up by a follow-up
+  if (invoicesRequest) {
+    invoicesPending = true;
+    return;
+  }
 
-  $.ajax({
-    url: `/get_invoices/${sessionId}`,
+  invoicesRequest = $.ajax({
+    url: `/get_invoices/${sessionId}?since=${invoicesCursor}`,
     type: "GET",
     success: function (response) {
+      if (sessionId !== currentSessionId) return;
       if (response?.success) {
-        displayInvoices(response.invoices || []);
-        $("#progressSection").hide();
-        $("#resultsSection").show().addClass("fade-in");
+        invoicesCursor = response.cursor;
+        totalInvoices = response.cursor;
+        $("#resultsSection").show();
+        if (response.completed) {
+          // Finished sessions are paged, sorted and filtered on the server
+          showSessionTable(sessionId);
+          $("#progressSection").hide();
+          $("#resultsSection").addClass("fade-in");
+        } else {
+          appendInvoices(response.invoices || []);
+        }
       } else {
         const msg = response?.error || "Failed to load invoices.";
         showAlert("danger", msg);
@@ -450,12 +510,50 @@ function loadInvoices(sessionId) {
       }
       showAlert("danger", message);
     },
+    complete: function () {
+      invoicesRequest = null;
+      if (invoicesPending && sessionId === currentSessionId) {
+        invoicesPending = false;
+        loadInvoices(sessionId);
+      }
+    },
   });
 }
 
 // ======================
 // Display Invoices in Table
 // ======================
+// Row field behind each table column (the last column is the View button)
+function tableFields() {
+  const schemaFields = currentSchema.filter(f => f.is_active).map(f => f.name);
+  return ["Source_File", "Page_Number", "_overall_confidence", ...schemaFields];
+}
+
+function buildInvoiceCells(invoice) {
+  const cells = [invoice.Source_File || "", invoice.Page_Number || ""];
+
+  // Add confidence badge
+  const confidence = invoice._overall_confidence || 0;
+  cells.push(getConfidenceBadge(confidence));
+
+  const schemaFields = currentSchema.filter(f => f.is_active).map(f => f.name);
+
+  schemaFields.forEach((field) => {
+    cells.push(invoice[field] || "-");
+  });
+
+  cells.push(`
+            <button class="px-4 py-2 bg-brand-red text-white rounded-lg hover:bg-promo-red text-sm font-semibold transition shadow-md" onclick="viewInvoice(${invoice.row_id})">
+                <i class="fas fa-eye mr-1"></i>View
+            </button>
+        `);
+  return cells;
+}
+
+function buildInvoiceRow(invoice) {
+  return "<tr>" + buildInvoiceCells(invoice).map((cell) => `<td>${cell}</td>`).join("") + "</tr>";
+}
+
 function displayInvoices(invoices) {
   $("#invoiceCount").text(invoices.length);
 
@@ -464,33 +562,33 @@ function displayInvoices(invoices) {
   const tableBody = $("#invoicesTable tbody");
   tableBody.empty();
 
-  invoices.forEach((invoice, index) => {
-    let row = "<tr>";
-    row += `<td>${invoice.Source_File || ""}</td>`;
-    row += `<td>${invoice.Page_Number || ""}</td>`;
-    
-    // Add confidence badge
-    const confidence = invoice._overall_confidence || 0;
-    row += `<td>${getConfidenceBadge(confidence)}</td>`;
-
-    const schemaFields = currentSchema.filter(f => f.is_active).map(f => f.name);
-
-    schemaFields.forEach((field) => {
-      const value = invoice[field] || "-";
-      row += `<td>${value}</td>`;
-    });
-
-    row += `<td>
-            <button class="px-4 py-2 bg-brand-red text-white rounded-lg hover:bg-promo-red text-sm font-semibold transition shadow-md" onclick="viewInvoice(${index})">
-                <i class="fas fa-eye mr-1"></i>View
-            </button>
-        </td>`;
-    row += "</tr>";
+  invoices.forEach((invoice) => tableBody.append(buildInvoiceRow(invoice)));
 
-    tableBody.append(row);
+  dataTable = $("#invoicesTable").DataTable({
+    pageLength: 10,
+    lengthMenu: [
+      [10, 25, 50, -1],
+      [10, 25, 50, "All"],
+    ],
+    order: [[0, "asc"]],
+    language: {
+      search: "_INPUT_",
+      searchPlaceholder: "Search invoices...",
+    },
+    columnDefs: [{ targets: "_all", className: "text-nowrap" }],
   });
+}
 
+function showSessionTable(sessionId) {
+  if (dataTable) dataTable.destroy();
+  $("#invoicesTable tbody").empty();
+  $("#confidenceFilter").removeClass("hidden");
+
+  const fields = tableFields();
   dataTable = $("#invoicesTable").DataTable({
+    serverSide: true,
+    processing: true,
+    searchDelay: 400,
     pageLength: 10,
     lengthMenu: [
       [10, 25, 50, -1],
@@ -501,10 +599,54 @@ function displayInvoices(invoices) {
       search: "_INPUT_",
       searchPlaceholder: "Search invoices...",
     },
-    columnDefs: [{ targets: "_all", className: "text-nowrap" }],
+    columnDefs: [
+      { targets: "_all", className: "text-nowrap" },
+      { targets: -1, orderable: false },
+    ],
+    ajax: function (request, callback) {
+      const order = request.order[0] || { column: 0, dir: "asc" };
+      const params = {
+        offset: request.start,
+        sort: (order.dir === "desc" ? "-" : "") + fields[order.column],
+      };
+      if (request.length > 0) params.limit = request.length;
+      if (request.search.value) params.q = request.search.value;
+      const filter = $("#confidenceFilter").val();
+      if (filter) params.filter = filter;
+
+      $.ajax({
+        url: `/get_invoices/${sessionId}`,
+        type: "GET",
+        data: params,
+        success: function (response) {
+          $("#invoiceCount").text(response.total);
+          callback({
+            draw: request.draw,
+            recordsTotal: response.total,
+            recordsFiltered: response.filtered,
+            data: (response.invoices || []).map(buildInvoiceCells),
+          });
+        },
+        error: function () {
+          showAlert("danger", "Failed to load invoices.");
+          callback({ draw: request.draw, recordsTotal: 0, recordsFiltered: 0, data: [] });
+        },
+      });
+    },
   });
 }
 
+function appendInvoices(invoices) {
+  if (!dataTable) {
+    displayInvoices(invoices);
+    return;
+  }
+  invoices.forEach((invoice) => dataTable.row.add($(buildInvoiceRow(invoice))[0]));
+  // Keep the page the user is looking at
+  dataTable.draw(false);
+  $("#invoiceCount").text(dataTable.rows().count());
+}
+
 // ======================
 // View Single Invoice Modal
 // ======================
@@ -527,9 +669,10 @@ function viewInvoice(index) {
 
 function showInvoiceModal(invoiceData, index) {
   $("#modalRowNumber").text(`Row ${index}`);
+  // Prefer the cacheable image endpoint; older sessions still embed base64
   $("#modalInvoiceImage").attr(
     "src",
-    `data:image/png;base64,${invoiceData.image}`,
+    invoiceData.image_url || `data:image/png;base64,${invoiceData.image}`,
   );
 
   const dataContainer = $("#modalInvoiceData");
@@ -624,6 +767,7 @@ function resetApp() {
     dataTable.destroy();
     dataTable = null;
   }
+  $("#confidenceFilter").val("").addClass("hidden");
 
   $("html, body").animate({ scrollTop: 0 }, 500);
 }